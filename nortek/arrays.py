@@ -4,186 +4,671 @@ import numpy.random
 import scipy.stats
 import scipy.signal
 import scipy
-AF = None
+import copy
+import hashlib
+import functools
+import multiprocessing.pool
+import warnings
 
 # implement logging in this module
 
+def adaptiveOutlierMask( series, thresholdFactor = 3.5 ):
+	# adaptive outlier removal run on every row of series, a ( series,
+	# samples ) array, at once. Returns the mask of the samples kept. Each
+	# pass estimates the spread below and above the median of the finite
+	# samples from the kept samples at the ranks of -1 and +1 standard
+	# deviations of a Student's t distribution, and drops the kept samples
+	# beyond thresholdFactor times that spread. A row is done when a pass
+	# drops nothing, or when half of its samples or fewer are left.
+	# Samples are only ever dropped from the two ends of a row's sorted
+	# values, so the rows are sorted once and the kept samples of a row are
+	# the sorted range first:stop, NaN sorting last.
+	numberOfSeries, numberOfSamples = series.shape
+	if not series.size:
+		return numpy.isfinite( series )
+	rows = numpy.arange( numberOfSeries )
+	order = numpy.argsort( series, axis = 1, kind = 'mergesort' )
+	sortedSeries = series[ rows[ :, numpy.newaxis ], order ]
+	first = numpy.zeros( numberOfSeries, numpy.int64 )
+	stop = numpy.isfinite( sortedSeries ).sum( axis = 1 )
+	midpoint = ( sortedSeries[ rows, numpy.maximum( stop - 1, 0 ) // 2 ] + 
+				 sortedSeries[ rows, stop // 2 ] ) / 2.
+	active = stop > 0.5 * numberOfSamples
+	while active.any():
+		index = numpy.flatnonzero( active )
+		activeSeries = sortedSeries[ index ]
+		numberOfGoodSamples = stop[ index ] - first[ index ]
+		lowRank = numpy.floor( scipy.stats.t.cdf( -1, numberOfGoodSamples ) * numberOfGoodSamples )
+		highRank = numpy.ceil( scipy.stats.t.cdf( 1, numberOfGoodSamples ) * numberOfGoodSamples )
+		lowRank = first[ index ] + lowRank.astype( numpy.int64 )
+		highRank = first[ index ] + numpy.minimum( highRank.astype( numpy.int64 ), numberOfGoodSamples - 1 )
+		belowMedianSTDEstimate = midpoint[ index ] - activeSeries[ numpy.arange( index.size ), lowRank ]
+		aboveMedianSTDEstimate = activeSeries[ numpy.arange( index.size ), highRank ] - midpoint[ index ]
+		lowerLimit = midpoint[ index ] - thresholdFactor * numpy.abs( aboveMedianSTDEstimate )
+		upperLimit = midpoint[ index ] + thresholdFactor * numpy.abs( belowMedianSTDEstimate )
+		with numpy.errstate( invalid = 'ignore' ):
+			newFirst = numpy.maximum( first[ index ], 
+				( activeSeries <= lowerLimit[ :, numpy.newaxis ] ).sum( axis = 1 ) )
+			newStop = numpy.maximum( newFirst, numpy.minimum( stop[ index ], 
+				( activeSeries < upperLimit[ :, numpy.newaxis ] ).sum( axis = 1 ) ) )
+		active[ index ] = ( ( newFirst != first[ index ] ) | ( newStop != stop[ index ] ) ) & \
+			( newStop - newFirst > 0.5 * numberOfSamples )
+		first[ index ], stop[ index ] = newFirst, newStop
+	ranks = numpy.arange( numberOfSamples )
+	goodIndices = numpy.empty( series.shape, bool )
+	goodIndices[ rows[ :, numpy.newaxis ], order ] = ( ranks >= first[ :, numpy.newaxis ] ) & \
+		( ranks < stop[ :, numpy.newaxis ] )
+	return goodIndices
+
+def fillGaps( values, good, axis = -1 ):
+	# a copy of values with the samples where good is False interpolated
+	# linearly between the good samples on either side in their series along
+	# axis, and set to the mean of the series' good samples ahead of its
+	# first and past its last good sample. Series without good samples
+	# become NaN. The series are laid end to end and split into runs of
+	# consecutive gaps, which gives the good samples around every gap of all
+	# the series in one pass over the gaps alone. The ends of the series are
+	# set after.
+	filled = numpy.array( values, dtype = float )
+	# the mask as rows of series, a view
+	goodSeries = numpy.rollaxis( good, axis, good.ndim )
+	numberOfSamples = goodSeries.shape[ -1 ]
+	gapPositions = numpy.flatnonzero( ~goodSeries )
+	if not gapPositions.size:
+		return filled
+
+	# samples of a series are this far apart in filled
+	stride = int( numpy.prod( filled.shape[ axis % good.ndim + 1: ] ) )
+
+	def offsets( positions ):
+		# offsets in filled of the positions of the rows of series
+		rows, samples = numpy.divmod( positions, numberOfSamples )
+		outer, inner = numpy.divmod( rows, stride )
+		return ( outer * numberOfSamples + samples ) * stride + inner
+
+	flatFilled = filled.reshape( -1 )
+	gapOffsets = offsets( gapPositions )
+	flatFilled[ gapOffsets ] = 0
+	numberOfGoodSamples = good.sum( axis = axis ).reshape( -1 )
+	with numpy.errstate( invalid = 'ignore', divide = 'ignore' ):
+		means = filled.sum( axis = axis ).reshape( -1 ) / numberOfGoodSamples
+	startsRun = numpy.ones( gapPositions.shape, bool )
+	startsRun[ 1: ] = numpy.diff( gapPositions ) != 1
+	endsRun = numpy.append( startsRun[ 1: ], True )
+	run = numpy.cumsum( startsRun ) - 1
+	before = gapPositions[ startsRun ][ run ] - 1
+	after = gapPositions[ endsRun ][ run ] + 1
+	between = ( before >= 0 ) & ( after < goodSeries.size )
+	fraction = ( gapPositions - before )[ between ] / ( after - before )[ between ].astype( float )
+	before, after = flatFilled[ offsets( before[ between ] ) ], flatFilled[ offsets( after[ between ] ) ]
+	flatFilled[ gapOffsets[ between ] ] = before + ( after - before ) * fraction
+	firstGood = goodSeries.argmax( axis = -1 ).reshape( -1 )
+	lastGood = numberOfSamples - 1 - goodSeries[ ..., ::-1 ].argmax( axis = -1 ).reshape( -1 )
+	rows, columns = numpy.divmod( gapPositions, numberOfSamples )
+	atEnds = ( columns < firstGood[ rows ] ) | ( columns > lastGood[ rows ] ) | ( numberOfGoodSamples[ rows ] == 0 )
+	flatFilled[ gapOffsets[ atEnds ] ] = means[ rows[ atEnds ] ]
+	return filled
+
 class GenericDataArray(dict):
 	# base class for single sample volume data (e.g. Vectrino, Vector, current meters)
 	# sample rate is a scalar
 	# shape is an 2-tuple, the first entry is the number of cells, 
 	# the second entry is the number of samples,
 	# finel is the number of channels/beams/components
+	# data is an already filled array, it is used as is and shape is ignored
+	# dtype is the type of the array allocated when data is not given
 	def __init__( self,
 				  sampleRate = 1,
-				  shape = ( 1, 1, 1 ) ):
+				  shape = ( 1, 1, 1 ),
+				  data = None,
+				  dtype = numpy.float64 ):
 		#super( GenericDataArray, self ).__init__()
 		dict.__init__( self )
 		self.sampleRate = sampleRate
-		self[ 'data' ] = numpy.empty( shape )
+		if data is None:
+			data = numpy.empty( shape, dtype )
+		self[ 'data' ] = data
+		shape = data.shape
 		if len( shape ) == 1:
 			self.numberOfSamples = shape[ 0 ]
 		else:
 			self.numberOfSamples = shape[ 1 ]
 		
-	def calculateStatistics( self, onAxis = 1, useScreenedData = False ):
-		self.mean = scipy.stats.nanmean( self[ 'data' ], onAxis )
-		self.median = scipy.stats.nanmedian( self[ 'data' ], onAxis )
-		self.var = scipy.stats.nanstd( self[ 'data' ], onAxis )**2
+	def calculateStatistics( self, onAxis = 1, useScreenedData = False, ensemblesPerBlock = 4096 ):
+		# data in memory gets exact statistics. Data that is only decoded on
+		# request, such as a MappedDataArray, is fed to StreamingStatistics
+		# ensemblesPerBlock ensembles at a time instead of being decoded whole.
+		data = self[ 'data' ]
+		if isinstance( data, numpy.ndarray ):
+			with warnings.catch_warnings():
+				warnings.simplefilter( 'ignore', RuntimeWarning )
+				self.mean = numpy.nanmean( data, onAxis )
+				self.median = numpy.nanmedian( data, onAxis )
+				self.var = numpy.nanvar( data, onAxis, ddof = 1 )
+			return
+		statistics = StreamingStatistics( onAxis )
+		index = [ slice( None ) ] * len( data.shape )
+		# an empty array still gives one, empty, block
+		for blockStart in range( 0, max( data.shape[ onAxis ], 1 ), ensemblesPerBlock ):
+			index[ onAxis ] = slice( blockStart, blockStart + ensemblesPerBlock )
+			statistics.update( data[ tuple( index ) ] )
+		self.mean = statistics.mean
+		self.median = statistics.median()
+		self.var = statistics.variance()
 
 	def calculateHistograms( self, bins = None ):
 		self.histograms = Histogram( self[ 'data' ], bins )
 
-	def adaptiveOutlierRemoval( self, thresholdFactor = 3.5 ):
-		if "mean" not in self:
-			self.calculateStatistics()
-		self[ 'goodIndices' ] = numpy.isfinite( self[ 'data' ] )
-		for currentCell in range( 0, self[ 'data' ].shape[ 0 ], 1 ):
-			for currentChannel in range( 0, self[ 'data' ].shape[ 2 ], 1 ):
-				converge = False
-				midpointWorking = self[ 'median' ][ currentCell, currentChannel ]
-				# initilization for the first pass through the loop
-				sortedIndices = self[ 'data' ][ currentCell, :, currentChannel ].argsort().flatten()
-				numberOfGoodSamples = numpy.sum( self[ 'goodIndices' ][ currentCell, :, currentChannel ] )
-			
-				while converge is False and numberOfGoodSamples > 0.5 * self[ 'data' ].shape[ 1 ]:
-					# estimate the standard deviation based on student's t distribution
-					probabilityLow = scipy.stats.t.cdf( -1, numberOfGoodSamples )
-					probabilityHi = scipy.stats.t.cdf( 1, numberOfGoodSamples )
-
-					probabilityLowIndex = int( numpy.floor( probabilityLow * numberOfGoodSamples ) )
-					probabilityHiIndex = int( numpy.ceil( probabilityHi * numberOfGoodSamples ) )
-
-					if ( numpy.isfinite( probabilityLowIndex ) and numpy.isfinite( probabilityHiIndex ) ):
-						belowMedianSTDEstimate = midpointWorking - \
-							self[ 'data' ][ currentCell, sortedIndices[ probabilityLowIndex ], currentChannel ]
-						aboveMedianSTDEstimate = self[ 'data' ][ currentCell, sortedIndices[ probabilityHiIndex ], currentChannel ] - \
-							midpointWorking
-
-						lowerLimit = midpointWorking - thresholdFactor * numpy.abs( aboveMedianSTDEstimate )
-						upperLimit = midpointWorking + thresholdFactor * numpy.abs( belowMedianSTDEstimate )
-
-						outlierIndices = numpy.logical_or( self[ 'data' ][ currentCell, 
-																		   self[ 'goodIndices' ][ currentCell, :, currentChannel ], 
-																		   currentChannel ] <= lowerLimit, 
-														   self[ 'data' ][ currentCell, 
-																		   self[ 'goodIndices' ][ currentCell, :, currentChannel ], 
-																		   currentChannel ] >= upperLimit ).flatten()
-						self[ 'goodIndices' ][ currentCell, outlierIndices, currentChannel ] = False
-
-						formerNumberOfGoodSamples = numberOfGoodSamples
-						numberOfGoodSamples = numpy.sum( self[ 'goodIndices' ][ currentCell, :, currentChannel ] )
-						numberOfPointsRemoved = int( formerNumberOfGoodSamples - numberOfGoodSamples )
-						#print "Removed %i points" , numberOfPointsRemoved
-						if numberOfPointsRemoved is 0:
-							converge = True
-
-	def calculateTemporalSpectrum( self, numberOfWindows = 1 ):
-		if "mean" not in self:
+	def adaptiveOutlierRemoval( self, thresholdFactor = 3.5, numberOfThreads = 1 ):
+		# flags the outliers of every cell and channel, see adaptiveOutlierMask,
+		# and keeps the samples left in goodIndices. With numberOfThreads above
+		# 1 the series are split between a pool of threads, numpy releases the
+		# GIL while it sorts and compares.
+		data = numpy.asarray( self[ 'data' ] )
+		# one row per cell and channel, the samples along the rows
+		series = numpy.rollaxis( data, 1, data.ndim )
+		seriesShape = series.shape
+		series = series.reshape( int( numpy.prod( seriesShape[ :-1 ] ) ), seriesShape[ -1 ] )
+		numberOfChunks = min( numberOfThreads, series.shape[ 0 ] )
+		if numberOfChunks > 1:
+			pool = multiprocessing.pool.ThreadPool( numberOfChunks )
+			try:
+				goodIndices = numpy.concatenate( pool.map( 
+					functools.partial( adaptiveOutlierMask, thresholdFactor = thresholdFactor ),
+					numpy.array_split( series, numberOfChunks ) ) )
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			goodIndices = adaptiveOutlierMask( series, thresholdFactor )
+		self[ 'goodIndices' ] = numpy.ascontiguousarray( 
+			numpy.rollaxis( goodIndices.reshape( seriesShape ), -1, 1 ) )
+
+	def __setitem__( self, key, value ):
+		# assigning the data or the mask drops the gap filled data kept
+		if key in ( 'data', 'goodIndices' ):
+			self._gapFilledKey = self._gapFilledData = None
+		dict.__setitem__( self, key, value )
+
+	def gapFilledData( self ):
+		# the data with the samples outside goodIndices filled in, see
+		# fillGaps, all the cells and channels at once. The result is read
+		# only and kept until the data or the mask are assigned again, or the
+		# mask is changed in place, so repeated spectra of the same screened
+		# data fill the gaps once. Changes made to the data in place are not
+		# noticed: assign the data again after them, self[ 'data' ] =
+		# self[ 'data' ] will do.
+		data = self[ 'data' ]
+		if 'goodIndices' in self:
+			goodIndices = numpy.asarray( self[ 'goodIndices' ] )
+		else:
+			goodIndices = numpy.isfinite( numpy.asarray( data ) )
+		key = ( goodIndices.shape, hashlib.md5( numpy.packbits( goodIndices ) ).hexdigest() )
+		if getattr( self, '_gapFilledKey', None ) == key:
+			return self._gapFilledData
+		filled = fillGaps( data, goodIndices, axis = 1 )
+		filled.flags.writeable = False
+		self._gapFilledKey, self._gapFilledData = key, filled
+		return filled
+
+	def calculateTemporalSpectrum( self, numberOfWindows = 1, overlap = 0, taper = None ):
+		# one-sided power spectral density of every cell and channel, averaged
+		# over numberOfWindows windows of equal length overlapping by the
+		# fraction overlap, 0.5 for Welch's method. The windows are spread to
+		# cover every sample. taper is a window for scipy.signal.get_window,
+		# 'hann' for instance, None leaves the windows as they are. The psd
+		# integrates to the mean square of the windows, psdCheck is that
+		# integral over the variance of the series. Samples outside
+		# goodIndices are interpolated first, see gapFilledData. All the
+		# windows of all the series go through a single rfft.
+		if not hasattr( self, 'mean' ):
 			self.calculateStatistics()
+		if 'goodIndices' not in self:
+			self[ 'goodIndices' ] = numpy.isfinite( self[ 'data' ] )
+		data = self.gapFilledData()
+		# ( cells, channels, samples ), or ( cells, samples )
+		series = numpy.rollaxis( data, 1, data.ndim )
+		numberOfSamples = series.shape[ -1 ]
+		windowLength = int( numberOfSamples / ( 1 + ( numberOfWindows - 1 ) * ( 1 - overlap ) ) )
+		windowStarts = numpy.round( numpy.linspace( 0, numberOfSamples - windowLength, numberOfWindows ) )
+		windows = series[ ..., windowStarts.astype( numpy.int64 )[ :, numpy.newaxis ] + numpy.arange( windowLength ) ]
+		if taper is None:
+			weights = numpy.ones( windowLength )
+		else:
+			weights = scipy.signal.get_window( taper, windowLength )
+			windows *= weights
+		spectra = numpy.fft.rfft( windows, axis = -1 )
+		psd = ( spectra.real ** 2 + spectra.imag ** 2 ).mean( axis = -2 ) / \
+			( self.sampleRate * numpy.sum( weights ** 2 ) )
+		# the negative frequencies, folded onto the positive ones
+		psd[ ..., 1:( windowLength + 1 ) // 2 ] *= 2
+		df = self.sampleRate / float( windowLength )
 		self[ 'spectrum' ] = {}
-		ensemble = numpy.arange( 0, self[ 'data' ].shape[ 1 ], 1 )
-		windowLength = self[ 'data' ].shape[ 1 ] / numberOfWindows
-		if self[ 'data' ].ndim == 3:
-			numberOfChannels = self[ 'data' ].shape[ 2 ]
-			self[ 'spectrum' ][ 'psd' ] = numpy.empty( ( self[ 'data' ].shape[ 0 ],
-														 windowLength,
-														 numberOfChannels ) )
-			self[ 'spectrum' ][ 'psdCheck' ] = numpy.empty( ( self[ 'data' ].shape[ 0 ],
-														  	  numberOfChannels ) )
+		self[ 'spectrum' ][ 'psd' ] = numpy.rollaxis( psd, -1, 1 )
+		self[ 'spectrum' ][ 'f' ] = numpy.fft.rfftfreq( windowLength, 1. / self.sampleRate )
+		self[ 'spectrum' ][ 'psdCheck' ] = psd.sum( axis = -1 ) * df / series.var( axis = -1 )
+		self[ 'spectrum' ][ 'nyquistFrequency' ] = self.sampleRate / 2.
+		self[ 'spectrum' ][ 'nyquistIndex' ] = windowLength // 2
+
+class GrowableArray(object):
+	# buffer for records decoded one at a time when the number of records is
+	# not known in advance. The record axis doubles in length whenever a record
+	# lands past the end, so filling n records costs O(n) copying overall.
+	# trim() returns a compact copy holding only the requested records,
+	# view() the same records without copying them.
+	def __init__( self,
+				  shape = ( 1, 0, 1 ),
+				  axis = 1,
+				  dtype = numpy.float64,
+				  fillValue = numpy.nan,
+				  initialLength = 1024 ):
+		self.axis = axis
+		self.fillValue = fillValue
+		self.length = 0
+		shape = list( shape )
+		shape[ axis ] = max( initialLength, 1 )
+		self.buffer = numpy.empty( shape, dtype )
+		self.buffer.fill( fillValue )
+
+	def _index( self, index ):
+		fullIndex = [ slice( None ) ] * self.buffer.ndim
+		fullIndex[ self.axis ] = index
+		return tuple( fullIndex )
+
+	def reserve( self, length ):
+		capacity = self.buffer.shape[ self.axis ]
+		if length <= capacity:
+			return
+		shape = list( self.buffer.shape )
+		shape[ self.axis ] = max( length, 2 * capacity )
+		newBuffer = numpy.empty( shape, self.buffer.dtype )
+		newBuffer.fill( self.fillValue )
+		newBuffer[ self._index( slice( 0, capacity ) ) ] = self.buffer
+		self.buffer = newBuffer
+
+	# index is a single record or an integer array of records, in which case
+	# values holds one entry per record along the record axis
+	def put( self, index, values ):
+		if numpy.size( index ) == 0:
+			return
+		lastIndex = int( numpy.max( index ) )
+		self.reserve( lastIndex + 1 )
+		self.buffer[ self._index( index ) ] = values
+		self.length = max( self.length, lastIndex + 1 )
+
+	def append( self, values ):
+		self.put( self.length, values )
+
+	def trim( self, length = None ):
+		if length is None:
+			length = self.length
+		self.reserve( length )
+		if length == self.buffer.shape[ self.axis ]:
+			return self.buffer
+		return self.buffer[ self._index( slice( 0, length ) ) ].copy()
+
+	# like trim() without the copy, the view goes stale once the buffer has
+	# to grow
+	def view( self, length = None ):
+		if length is None:
+			length = self.length
+		self.reserve( length )
+		return self.buffer[ self._index( slice( 0, length ) ) ]
+
+class MappedDataArray(object):
+	# read-only stand-in for a ( 1, numberOfEnsembles, channels ) float array
+	# whose samples stay raw in a memory-mapped file or in a compact copy of
+	# the records. records hands out one field
+	# of the records for an array of record numbers (see
+	# structures.MappedRecords) and ensembles holds the ensemble each record
+	# belongs to. Indexing decodes only the samples it touches, applies
+	# function, scale and offset (per channel) to them and returns a normal
+	# array. Ensembles without a record read as fillValue.
+	def __init__( self,
+				  records,
+				  field,
+				  ensembles,
+				  numberOfEnsembles,
+				  dtype = numpy.float64,
+				  fillValue = numpy.nan ):
+		self.records = records
+		self.field = field
+		self.function = None
+		self.scale = 1
+		self.offset = 0
+		self.dtype = numpy.dtype( dtype )
+		self.fillValue = fillValue
+		ensembles = numpy.asarray( ensembles, dtype = numpy.int64 )
+		self.shape = ( 1, numberOfEnsembles, records.dtype[ field ].shape[ 0 ] )
+		if ensembles.size == numberOfEnsembles and \
+		   numpy.array_equal( ensembles, numpy.arange( numberOfEnsembles ) ):
+			self.recordOfEnsemble = None
 		else:
-			numberOfChannels = 1
-			self[ 'spectrum' ][ 'psd' ] = numpy.empty( ( self[ 'data' ].shape[ 0 ],
-														 windowLength ) )
-			self[ 'spectrum' ][ 'psdCheck' ] = numpy.empty( ( self[ 'data' ].shape[ 0 ], ) )
-		
-		df = self.sampleRate / numpy.float( windowLength )
-		self[ 'spectrum' ][ 'f' ] = numpy.linspace( 0, self.sampleRate, windowLength, endpoint = False )
-
-		for currentCell in range( 0, self[ 'data' ].shape[ 0 ], 1 ):
-			for currentChannel in range( 0, numberOfChannels, 1 ):
-				T = self[ 'data' ][ currentCell, :, currentChannel ]
-				if 'goodIndices' not in self:
-					self[ 'goodIndices' ] = numpy.isfinite( self[ 'data' ] )
-				if numpy.sum( self[ 'goodIndices' ][ currentCell, :, currentChannel ] ) != len( T ):
-					interpolateT = scipy.interpolate.interp1d( ensemble[ self[ 'goodIndices' ][ currentCell, :, currentChannel ] ],
-													T[ self[ 'goodIndices' ][ currentCell, :, currentChannel ] ],
-													kind = 'linear',
-													copy = False,
-													bounds_error = False,
-													fill_value = T[ self[ 'goodIndices' ][ currentCell, :, currentChannel ] ].mean() )
-					T = interpolateT( ensemble )
-				startIndexInWindow = 0
-				endIndexInWindow = windowLength
-				window = 0
-				Stt = numpy.zeros( ( numberOfWindows, windowLength ) )
-				for window in range( 0, numberOfWindows, 1 ): 
-					subsetOfT = T[ startIndexInWindow:endIndexInWindow ]
-					fftOfT = numpy.fft.fft( subsetOfT )
-					windowStt = fftOfT * fftOfT.conjugate()
-					Stt[ window, : ] = windowStt.real
-					startIndexInWindow = endIndexInWindow
-					endIndexInWindow = startIndexInWindow + windowLength
-				Stt = numpy.mean( Stt, axis = 0 )
-				# Normalize so that the integral equals the rms fluctuation squared (variance)
-				self[ 'spectrum' ][ 'psd' ][ currentCell, :, currentChannel ] = Stt / ( self.sampleRate * windowLength )
-				self[ 'spectrum' ][ 'psdCheck' ][ currentCell, currentChannel ] = ( numpy.sum( self[ 'spectrum' ][ 'psd' ][ currentCell, :, currentChannel ] ) * \
-														df ) / T.var()
-				self[ 'spectrum' ][ 'nyquistFrequency' ] = self.sampleRate / 2
-				self[ 'spectrum' ][ 'nyquistIndex' ] = windowLength / 2
+			inRange = ( ensembles >= 0 ) & ( ensembles < numberOfEnsembles )
+			self.recordOfEnsemble = -numpy.ones( ( numberOfEnsembles, ), numpy.int64 )
+			self.recordOfEnsemble[ ensembles[ inRange ] ] = numpy.flatnonzero( inRange )
+
+	@property
+	def ndim( self ):
+		return len( self.shape )
+
+	@property
+	def size( self ):
+		return self.shape[ 0 ] * self.shape[ 1 ] * self.shape[ 2 ]
+
+	def __len__( self ):
+		return self.shape[ 0 ]
+
+	def __array__( self, dtype = None ):
+		if dtype is None:
+			return self[ ... ]
+		return self[ ... ].astype( dtype )
+
+	def derived( self, field = None, function = None, scale = 1, offset = 0 ):
+		# another array over the same records, e.g. a different field or a
+		# quantity calculated from this one
+		derivedArray = copy.copy( self )
+		if field is not None:
+			derivedArray.field = field
+		derivedArray.function = function
+		derivedArray.scale = scale
+		derivedArray.offset = offset
+		return derivedArray
+
+	def _decode( self, ensembles ):
+		values = numpy.empty( ensembles.shape + ( self.shape[ 2 ], ), self.dtype )
+		values.fill( self.fillValue )
+		if self.recordOfEnsemble is None:
+			present = slice( None )
+			rows = ensembles
+		else:
+			rows = self.recordOfEnsemble[ ensembles ]
+			present = rows >= 0
+			rows = rows[ present ]
+		raw = self.records.field( self.field, rows ).astype( self.dtype )
+		if self.function is not None:
+			raw = self.function( raw )
+		values[ present ] = raw * self.scale + self.offset
+		return values
+
+	def __getitem__( self, index ):
+		if not isinstance( index, tuple ):
+			index = ( index, )
+		if all( isinstance( i, ( slice, int, numpy.integer ) ) or i is Ellipsis for i in index ):
+			# basic indexing: decode the ensembles it selects, then apply the
+			# index to that block
+			if any( i is Ellipsis for i in index ):
+				ellipsis = [ i is Ellipsis for i in index ].index( True )
+				index = index[ :ellipsis ] + ( slice( None ), ) * ( 4 - len( index ) ) + index[ ellipsis + 1: ]
+			index = index + ( slice( None ), ) * ( 3 - len( index ) )
+			ensembles = numpy.arange( self.shape[ 1 ] )[ index[ 1 ] ]
+			block = self._decode( numpy.atleast_1d( ensembles ) )[ numpy.newaxis ]
+			if numpy.ndim( ensembles ) == 0:
+				return block[ index[ 0 ], 0, index[ 2 ] ]
+			return block[ index[ 0 ], :, index[ 2 ] ]
+		# advanced indexing: find the ensemble and channel of every selected
+		# sample and decode those
+		ensembles = numpy.broadcast_to( 
+			numpy.arange( self.shape[ 1 ] ).reshape( 1, -1, 1 ), self.shape )[ index ]
+		channels = numpy.broadcast_to( 
+			numpy.arange( self.shape[ 2 ] ).reshape( 1, 1, -1 ), self.shape )[ index ]
+		uniqueEnsembles, samples = numpy.unique( ensembles, return_inverse = True )
+		block = self._decode( uniqueEnsembles )
+		return block[ samples.ravel(), channels.ravel() ].reshape( ensembles.shape )
+
+class StreamingStatistics(object):
+	# mean, variance and quantiles of every series of data fed one block at a
+	# time, so that statistics can be taken over more data than fits in
+	# memory. The blocks are split along onAxis, the ensembles of a
+	# ( cells, ensembles, channels ) array by default, and the results have
+	# the shape of a block without that axis. NaN and infinite samples are
+	# skipped.
+	# The mean and the sum of squared deviations from it are updated with
+	# the pairwise form of Welford's algorithm. The quantiles come from a
+	# sketch of at most sketchSize weighted centroids per series: while fewer
+	# samples than that have been fed it holds all of them and the quantiles
+	# are exact, after that each centroid stands for about 1 / sketchSize of
+	# the samples, which bounds the error in rank. Accumulators fed with
+	# different parts of the data, by several workers or from several files,
+	# are combined with merge, and they pickle.
+	def __init__( self, onAxis = 1, sketchSize = 1024 ):
+		self.onAxis = onAxis
+		self.sketchSize = sketchSize
+		self.shape = None
+		self.count = None
+		self.mean = None
+		self.sumOfSquares = None
+		# ( series, points ), sorted by value, empty points are NaN with a
+		# weight of 0
+		self.centroids = None
+		self.weights = None
+
+	def update( self, block ):
+		block = numpy.asarray( block, numpy.float64 )
+		shape = block.shape[ :self.onAxis ] + block.shape[ self.onAxis + 1: ]
+		series = numpy.rollaxis( block, self.onAxis, block.ndim ).reshape( 
+			int( numpy.prod( shape ) ), block.shape[ self.onAxis ] )
+		finite = numpy.isfinite( series )
+		series = numpy.where( finite, series, numpy.nan )
+		count = finite.sum( axis = 1 )
+		with numpy.errstate( invalid = 'ignore', divide = 'ignore' ):
+			mean = numpy.nansum( series, axis = 1 ) / count
+			deviation = numpy.where( finite, series - mean[ :, numpy.newaxis ], 0 )
+		self.combine( shape, count, mean, numpy.sum( deviation ** 2, axis = 1 ), series, 
+			finite.astype( numpy.float64 ) )
+		return self
+
+	def merge( self, other ):
+		if other.shape is not None:
+			self.combine( other.shape, other.count.ravel(), other.mean.ravel(), 
+				other.sumOfSquares.ravel(), other.centroids, other.weights )
+		return self
+
+	def combine( self, shape, count, mean, sumOfSquares, values, weights ):
+		if self.shape is None:
+			self.shape = shape
+			self.count = numpy.zeros( shape, numpy.int64 )
+			self.mean = numpy.full( shape, numpy.nan )
+			self.sumOfSquares = numpy.zeros( shape )
+			self.centroids = numpy.empty( ( count.size, 0 ) )
+			self.weights = numpy.empty( ( count.size, 0 ) )
+		elif shape != self.shape:
+			raise ValueError( 'Blocks of shape %s without axis %d do not match the %s of the statistics' % 
+				( shape, self.onAxis, self.shape ) )
+		selfCount = self.count.ravel()
+		selfMean = self.mean.ravel()
+		total = selfCount + count
+		with numpy.errstate( invalid = 'ignore', divide = 'ignore' ):
+			delta = mean - selfMean
+			combinedMean = selfMean + delta * count / total
+			combinedSumOfSquares = self.sumOfSquares.ravel() + sumOfSquares + \
+				delta ** 2 * selfCount * count / total
+		self.mean = numpy.where( count == 0, selfMean, 
+			numpy.where( selfCount == 0, mean, combinedMean ) ).reshape( shape )
+		self.sumOfSquares = numpy.where( ( count == 0 ) | ( selfCount == 0 ), 
+			self.sumOfSquares.ravel() + sumOfSquares, combinedSumOfSquares ).reshape( shape )
+		self.count = total.reshape( shape )
+		self.compress( numpy.concatenate( ( self.centroids, values ), axis = 1 ), 
+			numpy.concatenate( ( self.weights, weights ), axis = 1 ) )
+
+	def compress( self, values, weights ):
+		# sorts the points of every series and, past sketchSize points, merges
+		# neighbours into sketchSize centroids of about equal weight
+		order = numpy.argsort( values, axis = 1, kind = 'mergesort' )
+		values = numpy.take_along_axis( values, order, axis = 1 )
+		weights = numpy.take_along_axis( weights, order, axis = 1 )
+		numberOfPoints = numpy.count_nonzero( weights, axis = 1 ).max() if weights.size else 0
+		if numberOfPoints <= self.sketchSize:
+			self.centroids = values[ :, :numberOfPoints ]
+			self.weights = weights[ :, :numberOfPoints ]
+			return
+		cumulativeWeight = numpy.cumsum( weights, axis = 1 )
+		with numpy.errstate( invalid = 'ignore', divide = 'ignore' ):
+			group = ( cumulativeWeight - weights / 2 ) / cumulativeWeight[ :, -1: ] * self.sketchSize
+		group = numpy.clip( numpy.nan_to_num( group ), 0, self.sketchSize - 1 ).astype( numpy.intp )
+		# one bincount over all the series, the centroids of each offset by
+		# its series number
+		group += self.sketchSize * numpy.arange( values.shape[ 0 ] )[ :, numpy.newaxis ]
+		groupWeight = numpy.bincount( group.ravel(), weights.ravel(), 
+			minlength = values.shape[ 0 ] * self.sketchSize )
+		groupSum = numpy.bincount( group.ravel(), numpy.where( weights > 0, values * weights, 0 ).ravel(), 
+			minlength = groupWeight.size )
+		with numpy.errstate( invalid = 'ignore', divide = 'ignore' ):
+			centroids = ( groupSum / groupWeight ).reshape( values.shape[ 0 ], self.sketchSize )
+		# the empty centroids sort last
+		order = numpy.argsort( centroids, axis = 1, kind = 'mergesort' )
+		self.centroids = numpy.take_along_axis( centroids, order, axis = 1 )
+		self.weights = numpy.take_along_axis( groupWeight.reshape( centroids.shape ), order, axis = 1 )
+
+	def variance( self, ddof = 1 ):
+		# unbiased by default, as scipy.stats.nanstd was
+		with numpy.errstate( invalid = 'ignore', divide = 'ignore' ):
+			return numpy.where( self.count > ddof, self.sumOfSquares / ( self.count - ddof ), numpy.nan )
+
+	def quantile( self, q ):
+		# the q quantile of every series, 0 <= q <= 1, interpolated linearly
+		# between the centroids each placed at the mean rank of its samples.
+		# While the sketch holds every sample this is numpy.percentile
+		numberOfSeries = self.centroids.shape[ 0 ]
+		# two empty padding points leave two points per series to interpolate
+		# between, even without any samples
+		values = numpy.concatenate( ( self.centroids, numpy.full( ( numberOfSeries, 2 ), numpy.nan ) ), axis = 1 )
+		weights = numpy.concatenate( ( self.weights, numpy.zeros( ( numberOfSeries, 2 ) ) ), axis = 1 )
+		numberOfPoints = numpy.count_nonzero( weights, axis = 1 )
+		cumulativeWeight = numpy.cumsum( weights, axis = 1 )
+		with numpy.errstate( invalid = 'ignore', divide = 'ignore' ):
+			position = ( cumulativeWeight - weights / 2 - 0.5 ) / ( cumulativeWeight[ :, -1: ] - 1 )
+		position[ ~numpy.isfinite( position ) ] = 0
+		position[ weights == 0 ] = 2
+		# one searchsorted over all the series, the positions of each offset
+		# by three times its series number
+		offset = 3 * numpy.arange( numberOfSeries )
+		upper = numpy.searchsorted( ( position + offset[ :, numpy.newaxis ] ).ravel(), q + offset ) - \
+			numpy.arange( numberOfSeries ) * values.shape[ 1 ]
+		upper = numpy.clip( upper, 1, numpy.maximum( numberOfPoints - 1, 1 ) )[ :, numpy.newaxis ]
+		lowerValue, upperValue = [ numpy.take_along_axis( values, index, axis = 1 )[ :, 0 ] 
+			for index in ( upper - 1, upper ) ]
+		lowerPosition, upperPosition = [ numpy.take_along_axis( position, index, axis = 1 )[ :, 0 ] 
+			for index in ( upper - 1, upper ) ]
+		with numpy.errstate( invalid = 'ignore', divide = 'ignore' ):
+			fraction = numpy.clip( ( q - lowerPosition ) / ( upperPosition - lowerPosition ), 0, 1 )
+			value = numpy.where( numberOfPoints > 1, 
+				lowerValue + fraction * ( upperValue - lowerValue ), lowerValue )
+		return value.reshape( self.shape )
+
+	def median( self ):
+		return self.quantile( 0.5 )
 
 class Histogram(dict):
+	# histograms of every cell and channel of a ( cells, samples, channels )
+	# array, binned all at once. All the series share one bin layout, so the
+	# results are dense ( cells, bins, channels ) arrays: self[ 'binEdges' ]
+	# ( with one more edge than bins ), self[ 'binCenters' ] and
+	# self[ 'densityInBin' ]. binEdges, binCenters and densityInBin hold the
+	# same arrays as lists of [ cell ][ channel ] views.
+	# bins is one of the named layouts below, an array of bin edges shared by
+	# all the series, a number of bins spanning the range of each series, or
+	# None for bins of the optimal width of each series, see
+	# optimalHistogramBins. Only the finite samples are counted, and the
+	# densities are those of numpy.histogram( ..., density = True ).
+	namedBins = { 'correlation': ( 0, 100, 101 ),
+		'vectrinoSNR': ( 0, 35, 35 ),
+		'vectorSNR': ( 0, 45, 45 ),
+		'vProSNR': ( 1, 60, 60 ),
+		'amplitude': ( 0, 255, 256 ) }
+	blockSize = 65536
+
 	def __init__(self, dataArray, bins = None ):
 		dict.__init__( self )
-		self.binEdges = []
-		self.binCenters = []
-		self.densityInBin = []
-		if bins is 'correlation':
-			bins = numpy.linspace( 0, 100, 101 )
-		elif bins is 'vectrinoSNR':
-			bins = numpy.linspace( 0, 35, 35 )
-		elif bins is 'vectorSNR':
-			bins = numpy.linspace( 0, 45, 45 )
-		elif bins is 'vProSNR':
-			bins = numpy.linspace( 1, 60, 60 )
-		elif bins is 'amplitude':
-			bins = numpy.linspace( 0, 255, 256 )
-		for cellNumber in range( 0, dataArray.shape[ 0 ], 1 ):
-			self.binEdges.append( [] )
-			self.binCenters.append( [] )
-			self.densityInBin.append( [] )
-			for channelNumber in range( 0, dataArray.shape[ -1 ], 1 ):
-				if bins == None:
-					binEdges, binCenters = self.optimalHistogramBins( dataArray[ cellNumber, :, channelNumber ] )
-					densityInBin, otherBinEdges = numpy.histogram( 
-							dataArray[ cellNumber, :, channelNumber ], 
-							binEdges, 
-							density = True )			
-				elif isinstance( bins, ( int, numpy.ndarray ) ): # number of bins or binEdges specified
-					densityInBin, binEdges = numpy.histogram( 							
-							dataArray[ cellNumber, :, channelNumber ], 
-							bins, 
-							density = True )
-					binWidth = ( binEdges[ 1 ] - binEdges[ 0 ] ) / 2.
-					binCenters = numpy.linspace( binEdges[ 0 ] + binWidth, 
-												 binEdges[ -1 ] - binWidth, 
-												 densityInBin.shape[ 0 ] )
-#				if cellNumber == 0 and channelNumber == 0:
-# 					self[ 'binEdges' ] = numpy.empty( ( dataArray.shape[ 0 ],
-# 														  binEdges.shape[ 0 ],
-# 														  dataArray.shape[ -1 ] ) )
-# 					self[ 'binCenters' ] = numpy.empty( ( dataArray.shape[ 0 ],
-# 														  binCenters.shape[ 0 ],
-# 														  dataArray.shape[ -1 ] ) )
-# 					self[ 'densityInBin' ] = numpy.empty( ( dataArray.shape[ 0 ],
-# 														  densityInBin.shape[ 0 ],
-# 														  dataArray.shape[ -1 ] ) )
-# 				self[ 'binEdges' ][ cellNumber, :, channelNumber ] = binEdges
-# 				self[ 'binCenters' ][ cellNumber, :, channelNumber ] = binCenters
-# 				self[ 'densityInBin' ][ cellNumber, :, channelNumber ] = densityInBin
-				self.binEdges[ cellNumber ].append( binEdges )
-				self.binCenters[ cellNumber ].append( binCenters )
-				self.densityInBin[ cellNumber ].append( densityInBin )
+		data = numpy.asarray( dataArray, numpy.float64 )
+		numberOfCells, numberOfSamples, numberOfChannels = data.shape
+		if isinstance( bins, str ):
+			bins = numpy.linspace( *self.namedBins[ bins ] )
+		if bins is None:
+			binEdges = self.optimalHistogramBins( data )
+		elif numpy.ndim( bins ) == 0:
+			binEdges = self.uniformHistogramBins( data, int( bins ) )
+		else:
+			binEdges = numpy.asarray( bins, numpy.float64 )
+		if binEdges.ndim == 1:
+			binEdges = numpy.broadcast_to( binEdges.reshape( 1, -1, 1 ), 
+					( numberOfCells, binEdges.shape[ 0 ], numberOfChannels ) )
+			seriesEdges = binEdges[ 0, :, 0 ]
+		else:
+			# the edges of each series one after the other
+			seriesEdges = binEdges.transpose( 0, 2, 1 ).reshape( numberOfCells * numberOfChannels, -1 )
+		numberOfBins = binEdges.shape[ 1 ] - 1
+		# one bincount over all the series, the bins of each offset by its
+		# series number. The samples go a block at a time, each block copied
+		# to one row per series so that the work runs along the samples
+		binOffset = numberOfBins * numpy.arange( numberOfCells * numberOfChannels ).reshape( -1, 1 )
+		counts = numpy.zeros( binOffset.size * numberOfBins, numpy.int64 )
+		blockLength = max( self.blockSize // binOffset.size, 1 )
+		for start in range( 0, numberOfSamples, blockLength ):
+			series = numpy.ascontiguousarray( data[ :, start:start + blockLength ].transpose( 0, 2, 1 ) )
+			binIndex, inRange = self.binIndex( series.reshape( binOffset.size, -1 ), seriesEdges )
+			counts += numpy.bincount( ( binIndex + binOffset )[ inRange ], 
+					minlength = counts.size )
+		counts = counts.reshape( numberOfCells, numberOfChannels, numberOfBins ).transpose( 0, 2, 1 )
+		with numpy.errstate( invalid = 'ignore', divide = 'ignore' ):
+			self[ 'densityInBin' ] = ( counts / numpy.diff( binEdges, axis = 1 ) / 
+					counts.sum( axis = 1, keepdims = True ) )
+		self[ 'binEdges' ] = numpy.array( binEdges )
+		self[ 'binCenters' ] = ( binEdges[ :, 1: ] + binEdges[ :, :-1 ] ) / 2.
+		for name in ( 'binEdges', 'binCenters', 'densityInBin' ):
+			setattr( self, name, [ [ self[ name ][ cellNumber, :, channelNumber ] 
+					for channelNumber in range( numberOfChannels ) ] 
+					for cellNumber in range( numberOfCells ) ] )
+
+	def binIndex( self, series, binEdges ):
+		# bin of every sample of series, a ( series, samples ) array, and
+		# whether the sample falls in the bins at all. binEdges are shared by
+		# all the series, or are evenly spaced edges of each, ( series,
+		# bins + 1 ). The bins are half open except the last, which also holds
+		# its upper edge, as with numpy.histogram
+		numberOfBins = binEdges.shape[ -1 ] - 1
+		lowEdge = binEdges[ ..., :1 ]
+		highEdge = binEdges[ ..., -1: ]
+		with numpy.errstate( invalid = 'ignore', divide = 'ignore' ):
+			inRange = ( series >= lowEdge ) & ( series <= highEdge )
+			if binEdges.ndim == 1:
+				binIndex = numpy.searchsorted( binEdges, series, side = 'right' ) - 1
+				return numpy.minimum( binIndex, numberOfBins - 1, out = binIndex ), inRange
+			# find the bin arithmetically, then correct the rounding against
+			# the edges as numpy.histogram does
+			binIndex = ( series - lowEdge ) * ( numberOfBins / ( highEdge - lowEdge ) )
+			binIndex = numpy.clip( binIndex.astype( numpy.intp ), 0, numberOfBins - 1 )
+			edgeIndex = binIndex + ( numberOfBins + 1 ) * numpy.arange( binEdges.shape[ 0 ] ).reshape( -1, 1 )
+			binIndex -= series < binEdges.take( edgeIndex )
+			binIndex += series >= binEdges.take( edgeIndex + 1 )
+		return numpy.minimum( binIndex, numberOfBins - 1, out = binIndex ), inRange
+
+	def finiteRange( self, data ):
+		# smallest and largest finite sample of every series of data, NaN for
+		# a series without any, ( cells, 1, channels )
+		if not data.shape[ 1 ]:
+			low = numpy.full( data.shape[ :1 ] + ( 1, ) + data.shape[ 2: ], numpy.nan )
+			return low, low.copy( )
+		with numpy.errstate( invalid = 'ignore' ):
+			low = numpy.fmin.reduce( data, axis = 1, keepdims = True )
+			high = numpy.fmax.reduce( data, axis = 1, keepdims = True )
+			if numpy.isinf( low ).any( ) or numpy.isinf( high ).any( ):
+				finite = numpy.where( numpy.isfinite( data ), data, numpy.nan )
+				low = numpy.fmin.reduce( finite, axis = 1, keepdims = True )
+				high = numpy.fmax.reduce( finite, axis = 1, keepdims = True )
+		return low, high
+
+	def uniformHistogramBins( self, data, bins ):
+		# bins evenly spaced edges over the finite range of every series of
+		# data, ( cells, bins + 1, channels ). A constant series gets a range of
+		# one around its value, as with numpy.histogram
+		low, high = self.finiteRange( data )
+		constant = low == high
+		low = numpy.where( constant, low - 0.5, low )
+		high = numpy.where( constant, high + 0.5, high )
+		binEdges = low + ( high - low ) * numpy.linspace( 0, 1, bins + 1 ).reshape( 1, -1, 1 )
+		binEdges[ :, -1: ] = high
+		return binEdges
 
 	def optimalHistogramBins( self, data ):
 		################################################################################
@@ -195,39 +680,50 @@ class Histogram(dict):
 		# Recent developments in nonparametric density estimation. 
 		# Journal of the American Statistical Association, 86(413):205-224.
 		################################################################################
-		data = data.flatten()
-
-		n = max(data.shape) - sum( numpy.isnan( data ) )
-
-		# need to estimate the IQR
-		interQuartileRange = AF.iqr( data )
-		binwidth = 2.0 * interQuartileRange * n ** (-1.0 / 3.0 )
-		# have one bin centered at the median and extend to either end of the data as
-		# appropriate
-		medianValue = numpy.median( data )
-		dataMinimumValue = min( data )
-		bins = int( ( medianValue - dataMinimumValue - binwidth / 2.0 ) / binwidth )
-		binCenters = medianValue - numpy.arange( bins ) * binwidth
-
-		dataMaximumValue = max( data )
-		bins = int( ( medianValue + dataMaximumValue - binwidth / 2.0 ) / binwidth )
-		binCenters2ndHalf = medianValue + numpy.arange( 1, bins + 1 ) * binwidth 
-		binCenters = numpy.append( binCenters, binCenters2ndHalf )
-	
-		binCenters.sort( )
-		binEdges = binCenters - binwidth / 2
-		# add one last bin edge so we get the right values to plot against binCenters
-		binEdges = numpy.append( binEdges, binEdges[-1] + binwidth/2 )
-		return binEdges, binCenters
+		# bin edges for every series of data, ( cells, bins + 1, channels ).
+		# Each series gets bins of its own optimal width with one bin centered
+		# at its median. The bins are numbered from the median bin of each
+		# series and all the series span the same numbers, enough for the
+		# extremes of every series, so bin j is the same number of widths from
+		# the median in all of them.
+		with numpy.errstate( invalid = 'ignore', divide = 'ignore' ), warnings.catch_warnings( ):
+			warnings.simplefilter( 'ignore', RuntimeWarning )
+			finite = numpy.where( numpy.isfinite( data ), data, numpy.nan )
+			n = numpy.isfinite( finite ).sum( axis = 1, keepdims = True )
+			if not finite.shape[ 1 ]:
+				finite = numpy.full( finite.shape[ :1 ] + ( 1, ) + finite.shape[ 2: ], numpy.nan )
+			lowerQuartile, medianValue, upperQuartile = numpy.nanpercentile( 
+					finite, [ 25, 50, 75 ], axis = 1, keepdims = True )
+			dataMinimumValue, dataMaximumValue = self.finiteRange( finite )
+			binwidth = 2.0 * ( upperQuartile - lowerQuartile ) * n ** ( -1.0 / 3.0 )
+			# a series with half its samples or more at one value has no spread
+			# to go by, use its range instead
+			binwidth = numpy.where( binwidth > 0, binwidth, 
+					( dataMaximumValue - dataMinimumValue ) * n ** ( -1.0 / 3.0 ) )
+			binwidth = numpy.where( binwidth > 0, binwidth, 1.0 )
+			firstBin = numpy.floor( ( dataMinimumValue - medianValue ) / binwidth + 0.5 )
+			lastBin = numpy.floor( ( dataMaximumValue - medianValue ) / binwidth + 0.5 )
+			if numpy.isfinite( firstBin ).any( ):
+				firstBin = numpy.nanmin( firstBin )
+				lastBin = numpy.nanmax( lastBin )
+			else:
+				firstBin = lastBin = 0
+		binNumbers = numpy.arange( firstBin, lastBin + 2 ) - 0.5
+		return medianValue + binwidth * binNumbers.reshape( 1, -1, 1 )
 
 class VelocityDataArray(GenericDataArray):
-	def __init__(self, sampleRate = 1, shape = (0, 0, 0), coordinateSystem = None ):
+	def __init__(self, sampleRate = 1, shape = (0, 0, 0), coordinateSystem = None, data = None, dtype = numpy.float64 ):
 		dict.__init__( self )
 		self.sampleRate = sampleRate
-		self[ 'data' ] = numpy.nan * numpy.zeros( shape )
-		self.numberOfSamples = shape[ 1 ]
+		if data is None:
+			data = numpy.empty( shape, dtype )
+			data.fill( numpy.nan )
+		self[ 'data' ] = data
+		self.numberOfSamples = data.shape[ 1 ]
 		self.dataIsInCoordinateSystem = coordinateSystem
-		self.calculateStatistics()
+		# memory-mapped data is only decoded on request
+		if isinstance( data, numpy.ndarray ):
+			self.calculateStatistics()
 
 	def calculateScreenedStatistics( self ):
 		self.screenedMean = {}
@@ -1,25 +1,260 @@
 import os
+import sys
 import re
+import glob
+import tempfile
+import multiprocessing
+import hashlib
 import nortek.structures
+import nortek.arrays
+import functools
 import logging
 import pdb
 import struct 
+import pickle
+import shutil
+import sqlite3
 import numpy
 import math
+import time
 import matplotlib
+import scipy.io
+try:
+    import h5py
+except ImportError:
+    h5py = None
 
 class DataFile(dict):
-    def __init__(self, filepath, instrument_type="unknown"):
+    instrument_type = 'unknown'
+    # records handled per block when decoding with array operations
+    _recordsPerChunk = 2 ** 20
+    # bytes searched per block for sync bytes
+    _bytesPerChunk = 2 ** 26
+    # smallest part of a file scanned by each process of a parallel scan
+    _bytesPerSegment = 2 ** 24
+
+    # bytes read at each step of a search for a record
+    _probeWindow = 512
+
+    # bumped whenever the layout of the record index changes
+    _recordIndexVersion = 2
+    # bumped whenever the layout of the decoded state cache changes
+    _cacheVersion = 1
+
+    def __init__(self, filepath, instrument_type=None, memoryMapped=False,
+                 recordIndex=False, readData=True, processes=1, dtype=numpy.float64,
+                 cache=False):
+        """instrument_type, when given, replaces the instrument type of the
+        class, which also names the logger.
+
+        With memoryMapped the file is mapped instead of read into memory
+        and, where the instrument supports it, the data arrays are views into
+        the map that are only decoded when indexed.
+
+        recordIndex keeps the record offsets found by the scan of the file
+        so that the next open can skip it: True stores them in a sidecar
+        file next to the source, a directory name stores them in that cache
+        directory. The index is rebuilt when the source's size or
+        modification time changes. AD2CP files do not take the option.
+
+        With readData False only the header is read, the data can then be
+        streamed with iter_chunks.
+
+        processes splits the scan of a large file for its records between
+        that many worker processes. dtype is the float type of the data
+        arrays, numpy.float32 halves their memory.
+
+        cache keeps the decoded arrays and configurations, placed like the
+        record index, and the next open maps the arrays from it instead of
+        parsing the file. The arrays are copy-on-write maps, changing them
+        leaves the cache as it is. The cache is rebuilt when the source's
+        size or modification time, the options or the library version
+        change."""
         dict.__init__(self)
-        self.instrument_type = instrument_type
+        if instrument_type is not None:
+            self.instrument_type = instrument_type
+        self.memoryMapped = memoryMapped
         self.filesize = os.path.getsize(filepath)
         self.pathToSource, self.filename = os.path.split(filepath)
         self.filename, self.sourceExtension = os.path.splitext(self.filename)
         self.filepath = filepath
+        self.logger = logging.getLogger("Nortek." + self.instrument_type)
+        self.checksumErrors = {}
+        self._lazyKeys = {}
+        self.processes = processes
+        self.dtype = numpy.dtype(dtype)
+        self.recordIndexPath = self.sidecar_path(recordIndex, '.idx.npz')
+        self.cachePath = self.sidecar_path(cache, '.cache') if readData else None
+        self.recordIndex = None
+        if self.load_cache():
+            return
+        self.recordIndex = self.load_record_index()
         self.read_header()
+        if readData:
+            self.load_data()
+        self.cleanup()
+        if self.cachePath is not None:
+            self.save_cache()
+
+    def sidecar_path(self, location, suffix):
+        """Where a file derived from the source is kept: next to the source
+        when location is True, in the directory location otherwise."""
+        if not location:
+            return None
+        elif location is True:
+            return self.filepath + suffix
+        sourceKey = hashlib.md5(os.path.abspath(self.filepath).encode('utf-8')).hexdigest()
+        return os.path.join(location, self.filename + '-' + sourceKey + suffix)
+
+    def _source_signature(self):
+        return (os.path.abspath(self.filepath), self.filesize, os.path.getmtime(self.filepath))
+
+    def load_record_index(self):
+        """Return the stored record index, or None if there is none or it no
+        longer matches the source file."""
+        if self.recordIndexPath is None or not os.path.exists(self.recordIndexPath):
+            return None
+        try:
+            with open(self.recordIndexPath, 'rb') as indexFile:
+                stored = dict(numpy.load(indexFile).items())
+        except (IOError, OSError, ValueError) as error:
+            self.logger.warning("Ignoring unreadable record index %s: %s", self.recordIndexPath, error)
+            return None
+        if (int(stored[ 'version' ]) != self._recordIndexVersion or
+            (str(stored[ 'sourcePath' ]), int(stored[ 'sourceSize' ]), float(stored[ 'sourceMtime' ]))
+                != self._source_signature()):
+            return None
+        recordIndex = {'positions': {}, 'checksumErrors': {}}
+        for key, value in stored.items():
+            if key.startswith('positions_'):
+                recordIndex[ 'positions' ][ chr(int(key[ 10: ], 16)) ] = value
+            elif key.startswith('checksumErrors_'):
+                recordIndex[ 'checksumErrors' ][ chr(int(key[ 15: ], 16)) ] = value
+            elif value.ndim == 0:
+                recordIndex[ key ] = value[ () ]
+            else:
+                recordIndex[ key ] = value
+        return recordIndex
+
+    def save_record_index(self, recordPositions, **extra):
+        """Store the record offsets (and any extra arrays, such as ensemble
+        numbers) found while reading the file."""
+        sourcePath, sourceSize, sourceMtime = self._source_signature()
+        stored = dict(extra,
+                      version=self._recordIndexVersion,
+                      sourcePath=sourcePath,
+                      sourceSize=sourceSize,
+                      sourceMtime=sourceMtime,
+                      startOfConfiguration=self.startOfConfiguration,
+                      endOfConfiguration=self.endOfConfiguration)
+        for id in recordPositions:
+            stored[ 'positions_%02x' % ord(id) ] = recordPositions[ id ]
+        for id in self.checksumErrors:
+            stored[ 'checksumErrors_%02x' % ord(id) ] = self.checksumErrors[ id ]
+        temporaryPath = self.recordIndexPath + '.tmp'
+        try:
+            with open(temporaryPath, 'wb') as indexFile:
+                numpy.savez(indexFile, **stored)
+            if os.path.exists(self.recordIndexPath):
+                os.remove(self.recordIndexPath)
+            os.rename(temporaryPath, self.recordIndexPath)
+        except (IOError, OSError) as error:
+            self.logger.warning("Could not write record index %s: %s", self.recordIndexPath, error)
+
+    def cache_options(self):
+        """The options that change the decoded state, a cache written with
+        other options is rebuilt."""
+        return (self.dtype.str,)
+
+    def cache_signature(self):
+        return (self._cacheVersion, nortek.__version__, sys.version_info[ 0 ],
+                self._source_signature(), self.cache_options())
+
+    def load_cache(self):
+        """Restore the decoded state from the cache with its arrays mapped
+        from the cache files. Returns False if there is no cache or it no
+        longer matches the source file, the options or the library."""
+        if self.cachePath is None or not os.path.isdir(self.cachePath):
+            return False
+        try:
+            with open(os.path.join(self.cachePath, 'state.pkl'), 'rb') as stateFile:
+                unpickler = _CacheUnpickler(stateFile, self.cachePath)
+                if unpickler.load() != self.cache_signature():
+                    return False
+                state = unpickler.load()
+        except (IOError, OSError, ValueError, EOFError, pickle.UnpicklingError) as error:
+            self.logger.warning("Ignoring unreadable cache %s: %s", self.cachePath, error)
+            return False
+        dict.update(self, state[ 'values' ])
+        self.checksumErrors = state[ 'checksumErrors' ]
+        self.startOfConfiguration = state[ 'startOfConfiguration' ]
+        self.endOfConfiguration = state[ 'endOfConfiguration' ]
+        return True
+
+    def save_cache(self):
+        """Store the decoded state: every array in a .npy file of its own,
+        which load_cache maps, and the rest, the configurations included,
+        pickled in state.pkl."""
+        structures = getattr(self, '_structureName', {})
+        state = {'values': dict((key, value) for key, value in self.items() if key not in structures),
+                 'checksumErrors': self.checksumErrors,
+                 'startOfConfiguration': self.startOfConfiguration,
+                 'endOfConfiguration': self.endOfConfiguration}
+        temporaryPath = self.cachePath + '.tmp'
+        try:
+            if os.path.isdir(temporaryPath):
+                shutil.rmtree(temporaryPath)
+            os.makedirs(temporaryPath)
+            with open(os.path.join(temporaryPath, 'state.pkl'), 'wb') as stateFile:
+                pickler = _CachePickler(stateFile, temporaryPath)
+                pickler.dump(self.cache_signature())
+                pickler.dump(state)
+            if os.path.isdir(self.cachePath):
+                shutil.rmtree(self.cachePath)
+            os.rename(temporaryPath, self.cachePath)
+        except (IOError, OSError, TypeError, pickle.PicklingError) as error:
+            shutil.rmtree(temporaryPath, ignore_errors=True)
+            self.logger.warning("Could not write cache %s: %s", self.cachePath, error)
+
+    def set_lazy(self, key, loader):
+        """Make self[key] the result of loader(), called the first time the
+        key is looked up and cached from then on."""
+        self._lazyKeys[ key ] = loader
+
+    def __missing__(self, key):
+        if key not in self._lazyKeys:
+            raise KeyError(key)
+        value = self._lazyKeys.pop(key)()
+        self[ key ] = value
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._lazyKeys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return list(dict.keys(self)) + [ key for key in self._lazyKeys
+                                         if not dict.__contains__(self, key) ]
+
+    def get(self, key, default=None):
+        return self[ key ] if key in self else default
+
+    def items(self):
+        return [ (key, self[ key ]) for key in self.keys() ]
+
+    def values(self):
+        return [ self[ key ] for key in self.keys() ]
+
+    def load_data(self):
+        """Count the data records in a first pass over the file, then
+        allocate the arrays and fill them in a second pass."""
         self.read_data(assignToArrays=False)
         self.read_data(assignToArrays=True)
-        self.cleanup()
 
     def reportChecksum(self, instrumentDataFile, id):
         checksumErrorReadPosition = instrumentDataFile.tell() - self[id]._sizeInBytes			
@@ -29,11 +264,201 @@ class DataFile(dict):
                          self._structureName[id])
         instrumentDataFile.seek(checksumErrorReadPosition + 1)
 
+    def start_scan(self, size, start=0, stop=None, processes=1):
+        """Hand the scan of the first size bytes of the file for its records
+        to worker processes that map the file themselves, split into up to
+        processes segments, and return what locate_records takes as scan.
+        The caller can read the file while they work. Returns None when the
+        data is too small to be split."""
+        end = size if stop is None else min(stop, size)
+        numberOfSegments = min(processes, (end - start) // self._bytesPerSegment)
+        if numberOfSegments < 2:
+            return None
+        sizesInBytes = dict((id, self[ id ]._sizeInBytes) for id in self._structureName)
+        boundaries = numpy.linspace(start, end, numberOfSegments + 1).astype(numpy.int64)
+        tasks = [ (self.filepath, size, sizesInBytes, int(segmentStart), int(segmentStop),
+                   self._bytesPerChunk, self._recordsPerChunk)
+                  for segmentStart, segmentStop in zip(boundaries[ :-1 ], boundaries[ 1: ]) ]
+        pool = multiprocessing.Pool(numberOfSegments)
+        return pool, pool.map_async(_find_records_in_segment, tasks, chunksize=1)
+
+    def locate_records(self, data, start=0, baseOffset=0, stop=None, processes=1, scan=None):
+        """Find every record in data[start:] whose checksum passes and return
+        their byte offsets as sorted arrays keyed on structure id. All the
+        sync positions are found with array operations. A sync pattern inside
+        an accepted record is never taken as the start of another record, so
+        the boundaries match those of a byte-by-byte scan. When data is only
+        part of the file, baseOffset is its offset in the file and is added
+        to the positions of checksum errors. Records starting at or after
+        stop are left out.
+
+        With processes above 1 data must be the file from its first byte.
+        The scan is then split into that many segments, each checked by a
+        worker process that maps the file. The candidates of all the
+        segments are settled together, so the result is the same. scan is
+        a scan already started with start_scan for the same arguments."""
+        if isinstance(data, numpy.ndarray):
+            buffer = data
+        else:
+            buffer = numpy.frombuffer(data, numpy.uint8)
+        sizesInBytes = dict((id, self[ id ]._sizeInBytes) for id in self._structureName)
+        if scan is None:
+            scan = self.start_scan(buffer.size, start, stop, processes)
+        if scan is not None:
+            pool, pending = scan
+            try:
+                segments = pending.get()
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            segments = [ nortek.structures.findRecords(buffer, sizesInBytes, start, stop,
+                                                       self._bytesPerChunk, self._recordsPerChunk) ]
+        positions, sizes, ids, failures = [], [], [], []
+        for id in self._structureName:
+            valid = numpy.concatenate([ segment[ id ][ 0 ] for segment in segments ])
+            positions.append(valid)
+            sizes.append(numpy.repeat(sizesInBytes[ id ], valid.size))
+            ids.append(numpy.repeat(ord(id), valid.size))
+            failures.append((id, numpy.concatenate([ segment[ id ][ 1 ] for segment in segments ])))
+        positions = numpy.concatenate(positions)
+        order = numpy.argsort(positions, kind='mergesort')
+        positions = positions[ order ]
+        ends = positions + numpy.concatenate(sizes)[ order ]
+        ids = numpy.concatenate(ids)[ order ]
+
+        keep = nortek.structures.resolveOverlaps(positions, ends)
+        positions, ends, ids = positions[ keep ], ends[ keep ], ids[ keep ]
+
+        # failed checksums inside accepted records are data, not errors
+        for id, failed in failures:
+            enclosing = numpy.searchsorted(positions, failed, side='right') - 1
+            inRecord = enclosing >= 0
+            inRecord[ inRecord ] = failed[ inRecord ] < ends[ enclosing[ inRecord ] ]
+            self.checksumErrors[ id ] = failed[ ~inRecord ] + baseOffset
+            for position in self.checksumErrors[ id ]:
+                self.logger.info("Checksum error in file %s at byte %d, structure type is %s",
+                                 self.filename,
+                                 position,
+                                 self._structureName[id])
+        return dict((id, positions[ ids == ord(id) ]) for id in self._structureName)
+
+    def iter_record_blocks(self):
+        """Read the data section in blocks of about _bytesPerChunk bytes and
+        yield each block with the positions of the records located in it, as
+        returned by locate_records. A record is never split between blocks."""
+        longestRecord = max(self[ id ]._sizeInBytes for id in self._structureName)
+        with open(self.filepath, 'rb') as instrumentDataFile:
+            blockStart = self.endOfConfiguration
+            instrumentDataFile.seek(blockStart)
+            data = instrumentDataFile.read(self._bytesPerChunk)
+            while data:
+                atEnd = blockStart + len(data) >= self.filesize
+                stop = None if atEnd else max(len(data) - longestRecord, 1)
+                positions = self.locate_records(data, baseOffset=blockStart, stop=stop)
+                yield data, positions
+                if atEnd:
+                    break
+                # the next block starts after the last record located here
+                carry = max([ stop ] + [ positions[ id ][ -1 ] + self[ id ]._sizeInBytes
+                                         for id in positions if positions[ id ].size ])
+                blockStart += carry
+                data = data[ carry: ] + instrumentDataFile.read(self._bytesPerChunk)
+
+    def streamed_ensembles(self, lastEnsemble):
+        """The number of ensembles in a stream whose last record went to
+        lastEnsemble."""
+        return lastEnsemble + 1
+
+    def iter_chunks(self, ensemblesPerChunk=4096):
+        """Yield the data in blocks of ensemblesPerChunk ensembles, so files
+        larger than memory can be processed. Each block is a dict holding the
+        ensemble numbers under 'ensemble' and an array shaped (cells,
+        ensembles, beams) per data type, NaN (NaT for times) where an
+        ensemble is missing from the file. Only the last block can be
+        shorter.
+
+        The data come from iter_decoded_records, which the instrument
+        classes that can be streamed define: it yields the records in file
+        order as batches of (ensemble numbers, dict of data type arrays
+        shaped (cells, records, beams)). Arrays with one value per record,
+        1-D or with the records along axis 1, are passed on as well."""
+        chunk = None
+        chunkStart = 0
+        lastEnsemble = -1
+        template = {}
+        try:
+            for ensembles, values in self.iter_decoded_records():
+                if not ensembles.size:
+                    continue
+                template = dict(template, **values)
+                for part in numpy.split(numpy.arange(ensembles.size),
+                                        numpy.flatnonzero(numpy.diff(ensembles // ensemblesPerChunk)) + 1):
+                    while chunkStart + ensemblesPerChunk <= ensembles[ part[ 0 ] ]:
+                        yield chunk or self.empty_chunk(chunkStart, ensemblesPerChunk, template)
+                        chunk = None
+                        chunkStart += ensemblesPerChunk
+                    behind = ensembles[ part ] < chunkStart
+                    if behind.any():
+                        # only happens when the counters of a damaged file jump back
+                        self.logger.warning("Skipped %d records of %s whose ensembles were in a block already yielded",
+                                            behind.sum(), self.filename)
+                        part = part[ ~behind ]
+                        if not part.size:
+                            continue
+                    if chunk is None:
+                        chunk = self.empty_chunk(chunkStart, ensemblesPerChunk, template)
+                    for dataType in values:
+                        if dataType not in chunk:
+                            # a data type the records before did not have
+                            chunk[ dataType ] = self.empty_chunk(chunkStart, ensemblesPerChunk,
+                                                                 {dataType: values[ dataType ]})[ dataType ]
+                        onAxis = (slice(None),) * min(values[ dataType ].ndim - 1, 1)
+                        chunk[ dataType ][ onAxis + (ensembles[ part ] - chunkStart,) ] = values[ dataType ][ onAxis + (part,) ]
+                lastEnsemble = max(lastEnsemble, ensembles.max())
+            numberOfEnsembles = self.streamed_ensembles(lastEnsemble)
+        finally:
+            self.cleanup()
+        while chunkStart < numberOfEnsembles:
+            chunk = chunk or self.empty_chunk(chunkStart, ensemblesPerChunk, template)
+            length = min(ensemblesPerChunk, numberOfEnsembles - chunkStart)
+            yield dict((key, value[ :, :length ] if value.ndim > 1 else value[ :length ])
+                       for key, value in chunk.items())
+            chunk = None
+            chunkStart += ensemblesPerChunk
+
+    def stream_statistics(self, ensemblesPerChunk=4096, sketchSize=1024):
+        """Per-cell and per-beam statistics of every data type, and of the
+        per-record sensor arrays such as 'state/heading', taken over the
+        blocks of iter_chunks so that the whole file never has to be in
+        memory. Returns a nortek.arrays.StreamingStatistics per data type;
+        those of several files or parts of a file can be merged."""
+        statistics = {}
+        for chunk in self.iter_chunks(ensemblesPerChunk):
+            for dataType, values in chunk.items():
+                # the ensembles, times and other 1-D columns have no cells
+                if values.ndim > 1 and values.dtype.kind == 'f':
+                    if dataType not in statistics:
+                        statistics[ dataType ] = nortek.arrays.StreamingStatistics(sketchSize=sketchSize)
+                    statistics[ dataType ].update(values)
+        return statistics
+
+    def empty_chunk(self, chunkStart, ensemblesPerChunk, template):
+        chunk = dict((dataType, numpy.empty(values.shape[ :1 ] + (ensemblesPerChunk,) + values.shape[ 2: ]
+                                            if values.ndim > 1 else (ensemblesPerChunk,), values.dtype))
+                     for dataType, values in template.items())
+        for values in chunk.values():
+            values.fill(numpy.datetime64('NaT') if values.dtype.kind == 'M' else numpy.nan)
+        chunk[ 'ensemble' ] = numpy.arange(chunkStart, chunkStart + ensemblesPerChunk)
+        return chunk
+
     def read_header(self):
         """Hardware configuration A505
         Head configuration A504
         User configuration A500"""
         with open(self.filepath, 'rb') as instrumentDataFile:
+            if self.recordIndex is not None:
+                instrumentDataFile.seek(self.recordIndex[ 'startOfConfiguration' ])
             while True:
                 sync = instrumentDataFile.read(1)
                 if not sync:
@@ -42,6 +467,7 @@ class DataFile(dict):
                     id = instrumentDataFile.read(1)
                     if id == '\x05':
                         instrumentDataFile.seek(instrumentDataFile.tell() - 2)
+                        self.startOfConfiguration = instrumentDataFile.tell()
                         hardwareConfiguration = nortek.structures.Header(
                                 instrumentDataFile.read(48)) # always
                         headConfiguration = nortek.structures.Header(
@@ -60,28 +486,325 @@ class DataFile(dict):
                             self[ 'userConfiguration' ].interpretBinaryData(self[ 'type' ])
                             break
                         else:
-                            pdb.set_trace()
-                            # there were problems, try to figure out what
-                            print("""Checksum failure in the header. Checksum values are 
-								hardware: {}
-								head: {}
-								user: {}
-								Data file position is {}""".format(
-									self[ 'hardwareConfiguration' ].checksum,
-									self[ 'headConfiguration' ].checksum,
-									self[ 'userConfiguration' ].checksum,
-									instrumentDataFile.tell()))
+                            raise ValueError("Checksum failure in the header of {}, checksums are "
+                                             "hardware: {}, head: {}, user: {}, data file position is {}".format(
+                                                     self.filename,
+                                                     hardwareConfiguration.checksum,
+                                                     headConfiguration.checksum,
+                                                     userConfiguration.checksum,
+                                                     instrumentDataFile.tell()))
+
+    def probe(self):
+        """Describe a file opened with readData False from its configuration
+        and the records at its two ends, without decoding the data: instrument
+        type, serial number, sample rate, coordinate system, number of records
+        and the time they span, from the deployment start time of the
+        configuration and the sample rate."""
+        userConfiguration = self.get('userConfiguration', {})
+        sampleRate = userConfiguration.get('sampleRate')
+        numberOfRecords, exact = self.count_records()
+        startTime = endTime = None
+        if 'deploymentStartTime' in userConfiguration:
+            startTime = nortek.structures.clockTimestamp(userConfiguration[ 'deploymentStartTime' ])
+        if startTime is not None and sampleRate and numberOfRecords is not None:
+            endTime = startTime + numpy.timedelta64(int(round(1e6 * numberOfRecords / sampleRate)), 'us')
+        return {'filepath': os.path.abspath(self.filepath),
+                'filesize': self.filesize,
+                'mtime': os.path.getmtime(self.filepath),
+                'instrumentType': self.get('type', self.instrument_type),
+                'serialNumber': self.get('hardwareConfiguration', {}).get('serialNumber'),
+                'sampleRate': sampleRate,
+                'coordinateSystem': userConfiguration.get('coordinateSystem'),
+                'numberOfRecords': numberOfRecords,
+                'numberOfRecordsExact': exact,
+                'startTime': startTime,
+                'endTime': endTime}
+
+    def count_records(self):
+        """Number of data records as far as probe can tell, None when it
+        takes a full read, and whether that number is exact rather than an
+        estimate. The count comes from the records at the two ends of the
+        file, so records in between that fail their checksum make it an
+        estimate."""
+        return None, False
+
+    def locate_end_record(self, instrumentDataFile, id, fromEnd=False):
+        """File offset of the first valid record of type id, or with fromEnd
+        of the last one, None if there is none. Only a window at that end of
+        the data section is read, grown until it holds a record."""
+        length = 128 * self._probeWindow
+        while True:
+            start = self.endOfConfiguration
+            if fromEnd:
+                start = max(start, self.filesize - length)
+            instrumentDataFile.seek(start)
+            positions = self.locate_records(instrumentDataFile.read(length), baseOffset=start)[ id ]
+            if positions.size or length >= self.filesize - self.endOfConfiguration:
+                break
+            length *= 4
+        if not positions.size:
+            return None
+        return start + int(positions[ -1 if fromEnd else 0 ])
 
     def cleanup(self):
         pass
     
     def exportToMatlabV5(self, matlabFile = None):
-        pass
+        """Write the data to a compressed MATLAB v5 file, by default next to
+        the source with a .mat extension, and return its path. Arrays keep
+        their shape, nested data becomes structs. The v5 format needs each
+        variable in memory whole, use exportToMatlabV7p3 for large files."""
+        if matlabFile is None:
+            matlabFile = os.path.join(self.pathToSource, self.filename + '.mat')
+        startTime = time.time()
+        variables = {}
+        bytesWritten = 0
+        blocks = {}
+        for block in self.export_blocks():
+            for path, values in block.items():
+                blocks.setdefault(path, []).append(matlab_values(values))
+        for path, values in blocks.items():
+            values = numpy.concatenate(values, axis=min(values[ 0 ].ndim - 1, 1))
+            bytesWritten += values.nbytes
+            level = variables
+            names = [ matlab_name(name) for name in path.split('/') ]
+            for name in names[ :-1 ]:
+                level = level.setdefault(name, {})
+            level[ names[ -1 ] ] = values
+        self.merge_matlab_header(variables, self.export_header())
+        scipy.io.savemat(matlabFile, variables, do_compression=True, oned_as='column',
+                         long_field_names=True)
+        self.report_export(matlabFile, bytesWritten, startTime)
+        return matlabFile
+
+    def merge_matlab_header(self, variables, header):
+        for key, value in header.items():
+            name = matlab_name(key)
+            if hasattr(value, 'keys'):
+                self.merge_matlab_header(variables.setdefault(name, {}), value)
+            elif isinstance(value, (bytes, type(u''))):
+                value = self.export_string(value)
+                variables[ name ] = numpy.frombuffer(value.tostring(), numpy.uint8) \
+                    if isinstance(value, numpy.void) else value
+            else:
+                variables[ name ] = matlab_values(value)
+
+    def exportToMatlabV7p3(self, matlabFile = None, ensemblesPerChunk=4096, compression='gzip'):
+        """Write the data to a MATLAB v7.3 file, by default next to the
+        source with a .mat extension, and return its path. A v7.3 file is an
+        HDF5 file, it is written block by block as by exportToHDF5 so memory
+        stays bounded. Arrays keep their shape in MATLAB, nested data becomes
+        structs and names that are not valid in MATLAB get an x in front."""
+        if h5py is None:
+            raise ImportError("Exporting to MATLAB v7.3 needs h5py")
+        if matlabFile is None:
+            matlabFile = os.path.join(self.pathToSource, self.filename + '.mat')
+        startTime = time.time()
+        with h5py.File(matlabFile, 'w', userblock_size=512) as exportFile:
+            bytesWritten = self.write_hdf5(exportFile, ensemblesPerChunk, compression, matlab=True)
+        # MATLAB recognizes the file by the header in the user block
+        description = 'MATLAB 7.3 MAT-file, Platform: Python, Created on: {} HDF5 schema 1.00 .'.format(
+                time.strftime('%a %b %d %H:%M:%S %Y'))
+        with open(matlabFile, 'r+b') as exportFile:
+            exportFile.write(description.ljust(116).encode('ascii') + b'\x00' * 8 + b'\x00\x02IM')
+        self.report_export(matlabFile, bytesWritten, startTime)
+        return matlabFile
+
+    def exportToHDF5(self, hdf5File = None, ensemblesPerChunk=4096, compression='gzip'):
+        """Write the data to hdf5File, by default next to the source with an
+        .h5 extension, and return its path. The data arrays, their quality
+        masks and the per-ensemble arrays go block by block into datasets
+        chunked along the ensembles in blocks of ensemblesPerChunk, so a
+        time window is read back from a few chunks. The configurations and
+        other header data become groups of attributes. A file opened with
+        readData False is streamed and never held in memory whole."""
+        if h5py is None:
+            raise ImportError("Exporting to HDF5 needs h5py")
+        if hdf5File is None:
+            hdf5File = os.path.join(self.pathToSource, self.filename + '.h5')
+        startTime = time.time()
+        with h5py.File(hdf5File, 'w') as exportFile:
+            bytesWritten = self.write_hdf5(exportFile, ensemblesPerChunk, compression)
+        self.report_export(hdf5File, bytesWritten, startTime)
+        return hdf5File
+
+    def report_export(self, exportPath, bytesWritten, startTime):
+        duration = max(time.time() - startTime, 1e-6)
+        self.logger.info("Exported %s to %s, %.1f MB of data in %.2f s (%.1f MB/s)",
+                         self.filename, exportPath, bytesWritten / 1e6, duration,
+                         bytesWritten / 1e6 / duration)
+
+    def write_hdf5(self, exportFile, ensemblesPerChunk=4096, compression='gzip', matlab=False):
+        """Write the data into an open h5py File or Group, see exportToHDF5.
+        With matlab the layout is that of a MATLAB v7.3 file. Returns the
+        number of bytes of data written."""
+        bytesWritten = 0
+        for block in self.export_blocks(ensemblesPerChunk):
+            for path, values in block.items():
+                values = numpy.asarray(values)
+                if values.dtype.kind == 'M':
+                    values = values.astype('datetime64[us]').astype(numpy.int64)
+                    units = 'microseconds since 1970-01-01'
+                else:
+                    units = None
+                axis = min(values.ndim - 1, 1)
+                if matlab:
+                    path = '/'.join(matlab_name(name) for name in path.split('/'))
+                    matlabClass = _matlabClasses[ values.dtype.name ]
+                    axis = values.ndim - 1 - axis if values.ndim > 1 else 1
+                    values = matlab_layout(values).astype(numpy.uint8 if matlabClass == 'logical' else values.dtype)
+                length = values.shape[ axis ]
+                if path not in exportFile:
+                    shape = list(values.shape)
+                    shape[ axis ] = 0
+                    maxshape = list(values.shape)
+                    maxshape[ axis ] = None
+                    chunks = list(values.shape)
+                    chunks[ axis ] = ensemblesPerChunk
+                    dataset = exportFile.create_dataset(path, tuple(shape), values.dtype,
+                                                        maxshape=tuple(maxshape),
+                                                        chunks=tuple(chunks),
+                                                        compression=compression,
+                                                        shuffle=compression is not None)
+                    if units is not None:
+                        dataset.attrs[ 'units' ] = units
+                    if matlab:
+                        set_matlab_class(dataset, matlabClass)
+                dataset = exportFile[ path ]
+                start = dataset.shape[ axis ]
+                dataset.resize(start + length, axis)
+                index = [ slice(None) ] * values.ndim
+                index[ axis ] = slice(start, start + length)
+                dataset[ tuple(index) ] = values
+                bytesWritten += values.nbytes
+        if matlab:
+            self.write_matlab_header(exportFile, self.export_header())
+        else:
+            self.write_hdf5_header(exportFile, self.export_header())
+        return bytesWritten
+
+    def write_hdf5_header(self, group, header):
+        for key, value in header.items():
+            key = str(key)
+            if hasattr(value, 'keys'):
+                self.write_hdf5_header(group.require_group(key), value)
+            elif isinstance(value, numpy.ndarray):
+                group.create_dataset(key, data=value)
+            elif isinstance(value, (bytes, type(u''))):
+                group.attrs[ key ] = self.export_string(value)
+            else:
+                group.attrs[ key ] = value
+
+    def write_matlab_header(self, group, header):
+        # MATLAB only sees datasets and groups, so every value becomes one
+        for name in group:
+            if isinstance(group[ name ], h5py.Group):
+                set_matlab_class(group[ name ], 'struct')
+        for key, value in header.items():
+            name = matlab_name(key)
+            if hasattr(value, 'keys'):
+                subgroup = group.require_group(name)
+                set_matlab_class(subgroup, 'struct')
+                self.write_matlab_header(subgroup, value)
+                continue
+            if isinstance(value, (bytes, type(u''))):
+                value = self.export_string(value)
+                if isinstance(value, numpy.void):
+                    values = numpy.frombuffer(value.tostring(), numpy.uint8)
+                    matlabClass = 'uint8'
+                else:
+                    values = numpy.array([ ord(character) for character in value ], numpy.uint16)
+                    matlabClass = 'char'
+            else:
+                values = matlab_values(value)
+                matlabClass = _matlabClasses[ values.dtype.name ]
+            if values.size == 0:
+                # MATLAB keeps the dimensions of an empty array as its data
+                dataset = group.create_dataset(name, data=numpy.array(matlab_layout(values).shape, numpy.uint64))
+                dataset.attrs[ 'MATLAB_empty' ] = numpy.uint8(1)
+            elif matlabClass == 'char':
+                # a row of characters
+                dataset = group.create_dataset(name, data=values.reshape(-1, 1))
+            else:
+                dataset = group.create_dataset(
+                        name, data=matlab_layout(values).astype(numpy.uint8 if matlabClass == 'logical' else values.dtype))
+            set_matlab_class(dataset, matlabClass)
+
+    def export_string(self, value):
+        """Text fields without their padding, binary fields as opaque bytes."""
+        if isinstance(value, bytes):
+            text = value.rstrip(b'\x00')
+            if text and all(32 <= ord(character) < 127 for character in text.decode('latin-1')):
+                return text.decode('ascii')
+            return numpy.void(value) if value else u''
+        return value
+
+    def export_series(self, source=None, path=''):
+        """The arrays with one entry per ensemble, keyed on their export path:
+        the data of the data arrays, with the ensembles along axis 1, their
+        quality masks, and 1-D arrays as long as 'ensemble'."""
+        if source is None:
+            source = self
+        numberOfEnsembles = len(self[ 'ensemble' ])
+        series = {}
+        for key, value in source.items():
+            if isinstance(value, nortek.arrays.GenericDataArray):
+                for name, values in value.items():
+                    if getattr(values, 'ndim', 0) > 1 and values.shape[ 1 ] == numberOfEnsembles:
+                        series[ path + key + '/' + name ] = values
+            elif isinstance(value, dict):
+                series.update(self.export_series(value, path + key + '/'))
+            elif isinstance(value, numpy.ndarray) and value.ndim == 1 and value.size == numberOfEnsembles:
+                series[ path + key ] = value
+        return series
+
+    def export_header(self, source=None, path='', series=None):
+        """The configurations, numbers and small arrays that export_series
+        leaves out, nested as in the file."""
+        if source is None:
+            source = self
+            series = self.export_series() if 'ensemble' in self else {}
+        header = {}
+        for key, value in source.items():
+            if path + str(key) in series or isinstance(value, nortek.arrays.GenericDataArray):
+                continue
+            if hasattr(value, 'keys'):
+                value = self.export_header(value, path + str(key) + '/', series)
+                if value:
+                    header[ key ] = value
+            elif isinstance(value, (numpy.ndarray, numpy.generic, int, float, bool, bytes, type(u''))) and \
+                 numpy.asarray(value).dtype.kind != 'O':
+                header[ key ] = value
+        return header
 
-    def exportToMatlabV7p3(self, matlabFile = None):
+    def export_blocks(self, ensemblesPerChunk=4096):
+        """Yield the arrays of export_series in blocks of ensemblesPerChunk
+        ensembles. Files opened with readData False are streamed with
+        iter_chunks instead, which gives the ensembles, the data arrays and
+        the per-record columns, with what read_stream_header and
+        derive_stream_block add. Those take the paths of a full export: the
+        data of the data arrays under '/data', 1-D arrays as they are."""
+        if 'ensemble' not in self:
+            self.read_stream_header()
+            for chunk in self.iter_chunks(ensemblesPerChunk):
+                self.derive_stream_block(chunk)
+                yield dict((key if values.ndim == 1 else key + '/data', values)
+                           for key, values in chunk.items())
+            return
+        series = self.export_series()
+        for blockStart in range(0, len(self[ 'ensemble' ]), ensemblesPerChunk):
+            block = slice(blockStart, blockStart + ensemblesPerChunk)
+            yield dict((path, values[ :, block ] if values.ndim > 1 else values[ block ])
+                       for path, values in series.items())
+
+    def read_stream_header(self):
+        """Read what a streamed export writes besides the data blocks, for
+        the header."""
         pass
 
-    def exportToHDF5(self, hdf5File = None):
+    def derive_stream_block(self, chunk):
+        """Add the data types computed from others to a block of
+        iter_chunks."""
         pass
 
     def truncateDatasetBasedOnTimeRange(self, timeRange = (None,)):
@@ -102,47 +825,571 @@ class VectrinoFile(DataFile):
     _plotStyles = {'colors': { 0: 'black', 1: 'red', 2: 'green', 3: 'blue' },
                    'markers': { 0: '^', 1: '^', 2: '^', 3: '^' } }
 
-    def read_data(self, assignToArrays = False):
-        if assignToArrays is False:
-            self[ '\x50' ] = nortek.structures.VectrinoVelocityHeader_binary()
-            self[ '\x51' ] = nortek.structures.VectrinoVelocityData_binary()
-            self[ '\x07' ] = nortek.structures.VectrinoProbeCheck_binary()
-            self[ '\x0f' ] = nortek.structures.VectrinoFileInfo_binary()
-            self[ '\x02' ] = nortek.structures.VectrinoDistanceMeasurement_binary()
+    def __init__(self, filepath, instrument_type=None, memoryMapped=False,
+                 recordIndex=False, ensembles=None, times=None, readData=True,
+                 processes=1, follow=False, compact=False, dtype=numpy.float64, cache=False):
+        """ensembles, a slice of ensemble numbers, or times, a (start, stop)
+        pair in seconds from the first sample, read only that part of the
+        file. The stop is excluded, either end can be None and neither can be
+        negative.
+
+        follow is for a file that is still being recorded: the parser state
+        is kept and refresh() adds the records written since the last read.
+
+        With compact only the raw velocity records are kept in memory, 22
+        bytes per ensemble, and the data arrays are scaled to dtype when
+        indexed, as for a memory-mapped file."""
+        if ensembles is not None and ensembles.step not in (None, 1):
+            raise ValueError("Only a contiguous range of ensembles can be read")
+        for bound in (ensembles.start, ensembles.stop) if ensembles is not None else times or ():
+            if bound is not None and bound < 0:
+                raise ValueError("Ensembles and times are counted from the start of the file, "
+                                 "they can not be negative")
+        if follow and (memoryMapped or compact or recordIndex or cache or
+                       ensembles is not None or times is not None):
+            raise ValueError("A followed file is read whole into memory")
+        self.ensembleRange = ensembles
+        self.timeRange = times
+        self.follow = follow
+        self.compact = compact
+        DataFile.__init__(self, filepath, instrument_type, memoryMapped, recordIndex, readData,
+                          processes, dtype, cache)
+
+    def cache_options(self):
+        ensembles = self.ensembleRange
+        return DataFile.cache_options(self) + (
+            None if ensembles is None else (ensembles.start, ensembles.stop), self.timeRange)
+
+    def load_data(self):
+        if self.follow:
+            self.start_following()
+            self.refresh()
         else:
+            self.read_data()
+
+    def requested_ensembles(self):
+        """The first ensemble and the ensemble to stop at (None for the end
+        of the file) asked for through ensembles or times, or None if the
+        whole file is read."""
+        if self.timeRange is not None:
+            sampleRate = self[ 'userConfiguration' ][ 'sampleRate' ]
+            return tuple(None if time is None else int(math.ceil(time * sampleRate - 1e-9))
+                         for time in self.timeRange)
+        elif self.ensembleRange is not None:
+            return (self.ensembleRange.start, self.ensembleRange.stop)
+        return None
+
+    def create_structures(self):
+        self[ '\x50' ] = nortek.structures.VectrinoVelocityHeader_binary()
+        self[ '\x51' ] = nortek.structures.VectrinoVelocityData_binary()
+        self[ '\x07' ] = nortek.structures.VectrinoProbeCheck_binary()
+        self[ '\x0f' ] = nortek.structures.VectrinoFileInfo_binary()
+        self[ '\x02' ] = nortek.structures.VectrinoDistanceMeasurement_binary()
+
+    def read_data(self):
+        """Read the data section as one buffer and locate every record with
+        array operations. Velocity records are decoded in bulk through the
+        packed dtype of VectrinoVelocityData_binary, the other record types
+        are rare and go through their structures one at a time. When the file
+        is memory-mapped the velocity records are left in the map and the
+        data arrays decode them when indexed, when it is compact they are
+        copied out of the file the same way."""
+        self.create_structures()
+        if not self.memoryMapped:
             self['\x51'].allocateDataArrays(self)
-            self['\x07'].allocateDataArrays(self)
-            self['\x02'].allocateDataArrays(self)
+        self['\x07'].allocateDataArrays(self)
+        self['\x02'].allocateDataArrays(self)
+        velocityStructure = self['\x51']
+        recordDtype = velocityStructure.recordDtype()
+        requestedEnsembles = self.requested_ensembles()
 
         with open(os.path.join(self.pathToSource, self.filename + self.sourceExtension), 'rb') as instrumentDataFile:
+            if self.memoryMapped:
+                data = numpy.memmap(instrumentDataFile, numpy.uint8, mode='r')
+            else:
+                data = None
+            if requestedEnsembles is not None and self.recordIndex is None and self.recordIndexPath is not None:
+                # scan the whole file once so that this and later range reads are exact
+                self.recordIndex = self.index_records(instrumentDataFile, data)
+            if requestedEnsembles is not None:
+                data, velocityPositions, ensembles, recordPositions = self.read_ensemble_range(
+                        instrumentDataFile, requestedEnsembles, data)
+            else:
+                scan = None
+                if data is None:
+                    if self.recordIndex is None:
+                        # the workers map the file, it is read meanwhile
+                        scan = self.start_scan(self.filesize, self.endOfConfiguration,
+                                               processes=self.processes)
+                    data = instrumentDataFile.read()
+                if self.recordIndex is None:
+                    recordPositions = self.locate_records(data, self.endOfConfiguration,
+                                                          processes=self.processes, scan=scan)
+                    ensembles = None
+                else:
+                    recordPositions = self.recordIndex[ 'positions' ]
+                    self.checksumErrors = self.recordIndex[ 'checksumErrors' ]
+                    ensembles = self.recordIndex[ 'ensembles' ]
+                    velocityStructure.ensembleCounter = int(self.recordIndex[ 'ensembleCounter' ])
+                    velocityStructure.ensembleCycleCounter = int(self.recordIndex[ 'ensembleCycleCounter' ])
+                velocityPositions = recordPositions[ '\x51' ]
+            self.read_other_records(instrumentDataFile, recordPositions)
+        if ensembles is None:
+            buffer = data if self.memoryMapped else numpy.frombuffer(data, numpy.uint8)
+            ensembles = velocityStructure.ensembleIndices(
+                    buffer[ velocityPositions + recordDtype.fields[ 'count' ][ 1 ] ])
+        if self.memoryMapped:
+            velocityStructure.mapDataArrays(
+                    nortek.structures.MappedRecords(data, velocityPositions, recordDtype),
+                    self,
+                    ensembles,
+                    self.dtype)
+        elif self.compact:
+            records = nortek.structures.readRecords(
+                    numpy.frombuffer(data, numpy.uint8), velocityPositions, recordDtype.itemsize)
+            velocityStructure.mapDataArrays(
+                    nortek.structures.MappedRecords(records.reshape(-1),
+                                                    numpy.arange(velocityPositions.size) * recordDtype.itemsize,
+                                                    recordDtype),
+                    self,
+                    ensembles,
+                    self.dtype)
+        else:
+            # keep the raw records and decode each quantity on first use
+            self[ 'ensemble' ] = numpy.arange(velocityStructure.firstEnsemble,
+                                              velocityStructure.firstEnsemble + velocityStructure.ensembleCounter,
+                                              1)
+            for dataType in ('velocity', 'amplitude', 'correlation'):
+                self.set_lazy(dataType, functools.partial(self.decode_velocity_records,
+                                                          velocityStructure,
+                                                          data,
+                                                          velocityPositions,
+                                                          ensembles,
+                                                          dataType))
+        self.set_lazy('snr', self.calculate_snr)
+        self.set_lazy('gaps', functools.partial(self.find_gaps,
+                                                ensembles,
+                                                velocityStructure.firstEnsemble,
+                                                velocityStructure.ensembleCounter))
+        self['\x07'].finalizeDataArrays(self)
+        self['\x02'].finalizeDataArrays(self)
+        if self.recordIndexPath is not None and self.recordIndex is None and requestedEnsembles is None:
+            self.save_record_index(recordPositions,
+                                   ensembles=ensembles,
+                                   ensembleCounter=velocityStructure.ensembleCounter,
+                                   ensembleCycleCounter=velocityStructure.ensembleCycleCounter)
+
+    def read_ensemble_range(self, instrumentDataFile, requestedEnsembles, mappedFile=None):
+        """Read only the bytes holding the requested (first, stop) ensembles.
+        Returns those bytes (a slice of mappedFile if given), the offsets of
+        the velocity records in them, the row each record is stored at and
+        the file offsets of the other records.
+
+        With a record index the range is exact. Without one, the velocity
+        records are taken to follow each other at a fixed size, so the
+        ensemble at any offset can be found by binary search. The ensemble
+        numbers then match those of a full read as long as fewer than 256
+        samples were dropped ahead of the range, and only the records ahead
+        of the first velocity record (velocity header, probe checks) are
+        read besides the range."""
+        velocityStructure = self['\x51']
+        sizeInBytes = velocityStructure._sizeInBytes
+        countOffset = velocityStructure.recordDtype().fields[ 'count' ][ 1 ]
+        first, stop = requestedEnsembles
+        first = max(first or 0, 0)
+        if self.recordIndex is not None:
+            positions = self.recordIndex[ 'positions' ]
+            self.checksumErrors = self.recordIndex[ 'checksumErrors' ]
+            recordPositions = dict((id, positions[ id ]) for id in positions if id != '\x51')
+            lastEnsemble = int(self.recordIndex[ 'ensembleCounter' ])
+            stop = lastEnsemble if stop is None else min(stop, lastEnsemble)
+            ensembles = self.recordIndex[ 'ensembles' ]
+            inRange = (ensembles >= first) & (ensembles < stop)
+            velocityPositions = positions[ '\x51' ][ inRange ]
+            ensembles = ensembles[ inRange ] - first
+            if velocityPositions.size:
+                spanStart, spanStop = velocityPositions[ 0 ], velocityPositions[ -1 ] + sizeInBytes
+            else:
+                spanStart = spanStop = self.endOfConfiguration
+        else:
+            recordPositions, firstRecord = self.locate_leading_records(instrumentDataFile)
+            leadingErrors = dict(self.checksumErrors)
+            spanStart, startCounter = self.find_ensemble(instrumentDataFile, first, firstRecord)
+            spanStop = self.filesize
+            if stop is not None:
+                stopOffset, stopCounter = self.find_ensemble(instrumentDataFile, stop, firstRecord)
+                if stopOffset is not None:
+                    # locate_records wants a byte past the last record
+                    spanStop = stopOffset + sizeInBytes + 1
+            if spanStart is None:
+                spanStart = spanStop = self.filesize
+        if mappedFile is not None:
+            data = mappedFile[ spanStart:spanStop ]
+        else:
+            instrumentDataFile.seek(spanStart)
+            data = instrumentDataFile.read(spanStop - spanStart)
+        if self.recordIndex is None:
+            velocityPositions = self.locate_records(data, baseOffset=spanStart)[ '\x51' ]
+            for id in leadingErrors:
+                self.checksumErrors[ id ] = numpy.union1d(leadingErrors[ id ], self.checksumErrors[ id ])
+            buffer = data if mappedFile is not None else numpy.frombuffer(data, numpy.uint8)
+            if spanStart == firstRecord[ 0 ] or startCounter is None:
+                velocityStructure.resetCounters()
+            else:
+                # continue the counters from the record ahead of the range,
+                # the first record read is stored at that record's counter
+                # and is left out below
+                velocityStructure.ensembleCounter = startCounter - 1
+                velocityStructure.ensembleCycleCounter = (startCounter - 1) // 256
+            ensembles = velocityStructure.ensembleIndices(buffer[ velocityPositions + countOffset ])
+            if stop is not None and spanStop != self.filesize and velocityStructure.ensembleCounter != stopCounter:
+                self.logger.warning("Velocity records of %s are not back to back, the ensemble numbers "
+                                    "of the range read may be off, use a record index for exact ranges",
+                                    self.filename)
+            if spanStart != firstRecord[ 0 ] and startCounter is not None and ensembles.size:
+                ensembles[ 0 ] = -1
+            if stop is None or spanStop == self.filesize:
+                stop = velocityStructure.ensembleCounter if stop is None else min(stop, velocityStructure.ensembleCounter)
+            inRange = (ensembles >= first) & (ensembles < stop)
+            velocityPositions = velocityPositions[ inRange ]
+            ensembles = ensembles[ inRange ] - first
+        else:
+            velocityPositions = velocityPositions - spanStart
+        velocityStructure.firstEnsemble = first
+        velocityStructure.ensembleCounter = max(stop - first, 0)
+        return data, velocityPositions, ensembles, recordPositions
+
+    def index_records(self, instrumentDataFile, mappedFile=None):
+        """Locate every record of the file without decoding any, store the
+        record index and return it."""
+        velocityStructure = self['\x51']
+        scan = None
+        if mappedFile is None:
+            scan = self.start_scan(self.filesize, self.endOfConfiguration, processes=self.processes)
+            instrumentDataFile.seek(0)
+            data = numpy.frombuffer(instrumentDataFile.read(), numpy.uint8)
+        else:
+            data = mappedFile
+        recordPositions = self.locate_records(data, self.endOfConfiguration,
+                                              processes=self.processes, scan=scan)
+        velocityStructure.resetCounters()
+        ensembles = velocityStructure.ensembleIndices(
+                data[ recordPositions[ '\x51' ] + velocityStructure.recordDtype().fields[ 'count' ][ 1 ] ])
+        recordIndex = {'positions': recordPositions,
+                       'checksumErrors': dict(self.checksumErrors),
+                       'ensembles': ensembles,
+                       'ensembleCounter': velocityStructure.ensembleCounter,
+                       'ensembleCycleCounter': velocityStructure.ensembleCycleCounter}
+        self.save_record_index(recordPositions,
+                               ensembles=ensembles,
+                               ensembleCounter=velocityStructure.ensembleCounter,
+                               ensembleCycleCounter=velocityStructure.ensembleCycleCounter)
+        return recordIndex
+
+    def locate_leading_records(self, instrumentDataFile):
+        """Locate the records between the configuration and the first
+        velocity record. Returns their file offsets and the offset and count
+        of that first velocity record, (None, None) if there is none."""
+        length = 128 * self._probeWindow
+        while True:
             instrumentDataFile.seek(self.endOfConfiguration)
-            while True:
-                sync = instrumentDataFile.read(1)
-                if not sync:
-                    break
-                elif sync == '\xa5':
-                    id = instrumentDataFile.read(1)
-                    if not id:
-                        break
-                    elif id in self._structureName:
-                        if (instrumentDataFile.tell() + self[ id ]._sizeInBytes - 2) < self.filesize:
-                            self[ id ]._structureStart = instrumentDataFile.tell() - 2
-                            self[ id ]._structureStop = self[ id ]._structureStart + self[ id ]._sizeInBytes
-                            instrumentDataFile.readinto(self[ id ])
-                            if not self[ id ].calculateChecksum(instrumentDataFile):
-                                if not assignToArrays: # only report these on the first pass
-                                    self.reportChecksum(instrumentDataFile, id)
-                            elif not assignToArrays:
-                                self[ id ].incrementCounters()
-                            elif assignToArrays:
-                                self[ id ].moveIntoDataArrays(self)
-            if assignToArrays and 'velocityHeader' in self:
-                for beamNumber in range(4):
-                    self[ 'snr' ][ 'data' ][ :, :, beamNumber ] = \
-                    20 * numpy.log10(self[ 'amplitude' ][ 'data' ][ :, :, beamNumber ]) \
-                    - numpy.log10(self[ 'velocityHeader' ][ 'noise' ][ 'amplitude' ][ beamNumber + 1 ])
+            data = instrumentDataFile.read(length)
+            positions = self.locate_records(data, baseOffset=self.endOfConfiguration)
+            if positions[ '\x51' ].size or self.endOfConfiguration + len(data) >= self.filesize:
+                break
+            length *= 4
+        if not positions[ '\x51' ].size:
+            return (dict((id, positions[ id ] + self.endOfConfiguration) for id in positions),
+                    (None, None))
+        firstPosition = positions[ '\x51' ][ 0 ]
+        count = numpy.frombuffer(data, numpy.uint8)[
+                firstPosition + self['\x51'].recordDtype().fields[ 'count' ][ 1 ] ]
+        return (dict((id, positions[ id ][ positions[ id ] < firstPosition ] + self.endOfConfiguration)
+                     for id in positions),
+                (firstPosition + self.endOfConfiguration, int(count)))
+
+    def find_ensemble(self, instrumentDataFile, ensemble, firstRecord):
+        """Binary search for the first velocity record whose ensemble counter
+        is at least ensemble. firstRecord is the offset and count of the
+        first velocity record of the file. Returns the offset and counter of
+        the record found, (None, None) if the file ends before."""
+        firstOffset, firstCount = firstRecord
+        if firstOffset is None:
+            return None, None
+        sizeInBytes = self['\x51']._sizeInBytes
+        low, high = 0, (self.filesize - firstOffset) // sizeInBytes
+        found = (None, None)
+        while low < high:
+            middle = (low + high) // 2
+            offset, counter = self.probe_velocity_record(
+                    instrumentDataFile, firstOffset + middle * sizeInBytes, firstOffset, firstCount)
+            if offset is not None and counter < ensemble:
+                low = middle + 1
+            else:
+                found = (offset, counter)
+                high = middle
+        return found
+
+    def probe_velocity_record(self, instrumentDataFile, offset, firstOffset, firstCount):
+        """Offset and ensemble counter of the first valid velocity record at
+        or after offset, (None, None) if there is none. The 8 bit count of
+        the record only gives the counter modulo 256, the rest comes from
+        the number of records between it and the first one."""
+        velocityStructure = self['\x51']
+        sizeInBytes = velocityStructure._sizeInBytes
+        countOffset = velocityStructure.recordDtype().fields[ 'count' ][ 1 ]
+        while offset + sizeInBytes < self.filesize:
+            instrumentDataFile.seek(offset)
+            buffer = numpy.frombuffer(instrumentDataFile.read(self._probeWindow), numpy.uint8)
+            candidates = numpy.flatnonzero((buffer[ :-1 ] == 0xa5) & (buffer[ 1: ] == 0x51))
+            candidates = candidates[ (candidates + sizeInBytes <= buffer.size) &
+                                     (offset + candidates + sizeInBytes < self.filesize) ]
+            valid, failed = nortek.structures.validateChecksums(buffer, candidates, sizeInBytes)
+            if valid.any():
+                position = candidates[ valid ][ 0 ]
+                return offset + position, self.velocity_counter(
+                        offset + position, buffer[ position + countOffset ], firstOffset, firstCount)
+            offset += max(buffer.size - sizeInBytes, 1)
+        return None, None
+
+    def velocity_counter(self, offset, count, firstOffset, firstCount):
+        """Ensemble counter of the velocity record at offset with the 8 bit
+        count given, the records being taken to follow the first one, at
+        firstOffset, back to back."""
+        estimate = firstCount + (offset - firstOffset) // self['\x51']._sizeInBytes
+        return estimate + (int(count) - estimate) % 256
+
+    def count_records(self):
+        """The number of ensembles, dropped samples included, from the
+        counters of the first and the last velocity records, and whether it
+        is exact. The other records found in windows at the two ends are
+        taken out of the bytes between them. If what is left is not a whole
+        number of velocity records, there are other records in between that
+        the windows missed: the count is then the counter closest to the
+        number of velocity records those bytes would hold, an estimate."""
+        self.create_structures()
+        sizeInBytes = self['\x51']._sizeInBytes
+        countOffset = self['\x51'].recordDtype().fields[ 'count' ][ 1 ]
+        exact = True
+        with open(self.filepath, 'rb') as instrumentDataFile:
+            recordPositions, (firstOffset, firstCount) = self.locate_leading_records(instrumentDataFile)
+            lastOffset = self.locate_end_record(instrumentDataFile, '\x51', fromEnd=True)
+            if firstOffset is None or lastOffset is None:
+                numberOfRecords = 0
+            else:
+                instrumentDataFile.seek(lastOffset + countOffset)
+                count = struct.unpack('<B', instrumentDataFile.read(1))[ 0 ]
+                otherBytes = 0
+                for id, positions in self.locate_window_records(instrumentDataFile, firstOffset, lastOffset).items():
+                    if id != '\x51':
+                        otherBytes += positions.size * self[ id ]._sizeInBytes
+                estimate = firstCount + (lastOffset - firstOffset - otherBytes) // sizeInBytes
+                if (lastOffset - firstOffset - otherBytes) % sizeInBytes:
+                    exact = False
+                    numberOfRecords = estimate + (int(count) - estimate + 128) % 256 - 128
+                    self.logger.warning("Velocity records of %s are not back to back, its number of "
+                                        "ensembles is estimated", self.filename)
+                else:
+                    numberOfRecords = self.velocity_counter(lastOffset, count, firstOffset, firstCount)
+        self.cleanup()
+        return numberOfRecords, exact
+
+    def locate_window_records(self, instrumentDataFile, firstOffset, lastOffset):
+        """The records from firstOffset to lastOffset that are found in a
+        window at each end of that span, by structure id."""
+        length = 128 * self._probeWindow
+        windows = [ (firstOffset, min(firstOffset + length, lastOffset)) ]
+        if lastOffset - length > windows[ 0 ][ 1 ]:
+            windows.append((lastOffset - length, lastOffset))
+        else:
+            windows = [ (firstOffset, lastOffset) ]
+        found = {}
+        for start, stop in windows:
+            instrumentDataFile.seek(start)
+            positions = self.locate_records(instrumentDataFile.read(stop - start), baseOffset=start)
+            for id in positions:
+                found.setdefault(id, []).append(positions[ id ] + start)
+        return dict((id, numpy.concatenate(positions)) for id, positions in found.items())
+
+    def iter_decoded_records(self):
+        """Yield the velocity, amplitude and correlation of the velocity
+        records block by block, numbered as in a full read, and keep the
+        runs of lost samples in 'gaps' as it goes. The other record types
+        are skipped, read_stream_header reads those ahead of the data."""
+        self.create_structures()
+        velocityStructure = self['\x51']
+        recordDtype = velocityStructure.recordDtype()
+        self[ 'gaps' ] = self.find_gaps(numpy.zeros((0,), numpy.int64))
+        lastEnsemble = -1
+        for data, positions in self.iter_record_blocks():
+            records = nortek.structures.readRecords(
+                    numpy.frombuffer(data, numpy.uint8),
+                    positions[ '\x51' ],
+                    recordDtype.itemsize).view(recordDtype)[ :, 0 ]
+            ensembles = velocityStructure.ensembleIndices(records[ 'count' ])
+            if ensembles.size:
+                gaps = self.find_gaps(ensembles - (lastEnsemble + 1), lastEnsemble + 1)
+                for key in gaps:
+                    self[ 'gaps' ][ key ] = numpy.concatenate((self[ 'gaps' ][ key ], gaps[ key ]))
+                lastEnsemble = ensembles[ -1 ]
+            yield ensembles, dict((dataType, records[ dataType ][ numpy.newaxis ].astype(self.dtype))
+                                  for dataType in ('velocity', 'amplitude', 'correlation'))
+
+    def read_stream_header(self):
+        """Decode the records ahead of the first velocity record, the
+        velocity header, probe checks and distance measurements, as a full
+        read does."""
+        self.create_structures()
+        self['\x07'].allocateDataArrays(self)
+        self['\x02'].allocateDataArrays(self)
+        with open(self.filepath, 'rb') as instrumentDataFile:
+            recordPositions, firstRecord = self.locate_leading_records(instrumentDataFile)
+            self.read_other_records(instrumentDataFile, recordPositions)
+        self['\x07'].finalizeDataArrays(self)
+        self['\x02'].finalizeDataArrays(self)
+        self.cleanup()
+
+    def derive_stream_block(self, chunk):
+        chunk[ 'snr' ] = self.snr_from_amplitude(chunk[ 'amplitude' ])
+
+    def read_other_records(self, instrumentDataFile, recordPositions, baseOffset=0):
+        """Decode the records that are not velocity records, at the offsets
+        given plus baseOffset, one at a time in file order."""
+        for position, id in sorted((position, id) for id in ('\x50', '\x07', '\x0f', '\x02')
+                                   for position in recordPositions[ id ]):
+            self[ id ]._structureStart = baseOffset + position
+            self[ id ]._structureStop = baseOffset + position + self[ id ]._sizeInBytes
+            instrumentDataFile.seek(baseOffset + position + 2)
+            instrumentDataFile.readinto(self[ id ])
+            self[ id ].moveIntoDataArrays(self)
+
+    def streamed_ensembles(self, lastEnsemble):
+        return self['\x51'].ensembleCounter
+
+    def decode_velocity_records(self, velocityStructure, data, positions, ensembles, dataType):
+        """Decode one quantity of all the velocity records found by read_data
+        and return its data array."""
+        numberOfEnsembles = velocityStructure.ensembleCounter
+        velocityStructure.allocateDataArrays(self, (dataType,), self.dtype)
+        velocityStructure.ensembleCounter = numberOfEnsembles
+        buffer = numpy.frombuffer(data, numpy.uint8)
+        recordDtype = velocityStructure.recordDtype()
+        for chunkStart in range(0, positions.size, self._recordsPerChunk):
+            chunk = slice(chunkStart, chunkStart + self._recordsPerChunk)
+            records = nortek.structures.readRecords(
+                    buffer, positions[ chunk ], recordDtype.itemsize).view(recordDtype)[ :, 0 ]
+            velocityStructure.moveRecordsIntoDataArrays(records, self, ensembles[ chunk ])
+        velocityStructure.finalizeDataArrays(self)
+        return dict.__getitem__(self, dataType)
+
+    def find_gaps(self, ensembles, firstEnsemble=0, numberOfEnsembles=None):
+        """The ensembles without a velocity record: 'ensemble' holds the
+        first ensemble and 'length' the number of ensembles of each run of
+        lost samples. ensembles are the rows the records are stored at."""
+        bounds = [ [ -1 ], ensembles ]
+        if numberOfEnsembles is not None:
+            bounds.append([ numberOfEnsembles ])
+        starts, lengths = nortek.structures.counterGaps(numpy.concatenate(bounds).astype(numpy.int64))
+        return {'ensemble': starts + firstEnsemble, 'length': lengths}
+
+    def calculate_snr(self):
+        """Signal to noise ratio from the amplitude and the noise level in the
+        velocity header."""
+        amplitude = self[ 'amplitude' ]
+        if 'velocityHeader' not in self:
+            if isinstance(amplitude[ 'data' ], nortek.arrays.MappedDataArray):
+                # no noise level without a velocity header, stays NaN
+                return nortek.arrays.GenericDataArray(
+                        amplitude.sampleRate, data=amplitude[ 'data' ].derived(scale=numpy.nan))
+            return nortek.arrays.GenericDataArray(amplitude.sampleRate,
+                                                  shape=amplitude[ 'data' ].shape,
+                                                  dtype=amplitude[ 'data' ].dtype)
+        if isinstance(amplitude[ 'data' ], nortek.arrays.MappedDataArray):
+            return nortek.arrays.GenericDataArray(
+                    amplitude.sampleRate,
+                    data=amplitude[ 'data' ].derived(function=numpy.log10, scale=20, offset=-self.noise_level()))
+        return nortek.arrays.GenericDataArray(amplitude.sampleRate,
+                                              data=self.snr_from_amplitude(amplitude[ 'data' ]))
+
+    def noise_level(self):
+        """log10 of the noise amplitude of each beam in the velocity
+        header."""
+        return numpy.log10([ self[ 'velocityHeader' ][ 'noise' ][ 'amplitude' ][ beamNumber + 1 ]
+                             for beamNumber in range(4) ])
+
+    def snr_from_amplitude(self, amplitude):
+        """Signal to noise ratio of an amplitude array shaped (cells,
+        ensembles, beams), NaN without a velocity header."""
+        if 'velocityHeader' not in self:
+            return numpy.full(amplitude.shape, numpy.nan, amplitude.dtype)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return 20 * numpy.log10(amplitude) - self.noise_level().astype(amplitude.dtype)
+
+    def start_following(self):
+        self.create_structures()
+        self['\x51'].allocateDataArrays(self, dtype=self.dtype)
+        self['\x07'].allocateDataArrays(self)
+        self['\x02'].allocateDataArrays(self)
+        self[ 'gaps' ] = self.find_gaps(numpy.zeros((0,), numpy.int64))
+        # file offset the next refresh reads from, just past the last record
+        self.followPosition = self.endOfConfiguration
+        self.lastEnsemble = -1
+
+    def refresh(self):
+        """Read what was written to a followed file since the last call,
+        starting after the last record decoded, and extend the data arrays
+        with its records. A record that is not completely written yet is
+        left for the next call. Returns the number of new velocity
+        records.
+
+        The velocity, amplitude and correlation arrays stay the same objects
+        from one call to the next, their 'data' is replaced, so look 'data'
+        up again after a call rather than keeping it. The velocity
+        statistics only take in the new ensembles, the median is then
+        approximate (see StreamingStatistics). snr is derived again when
+        next asked for, look it up again as well."""
+        if not self.follow:
+            raise ValueError("Only a file opened with follow can be refreshed")
+        velocityStructure = self['\x51']
+        recordDtype = velocityStructure.recordDtype()
+        checksumErrors = self.checksumErrors
+        self.checksumErrors = {}
+        with open(self.filepath, 'rb') as instrumentDataFile:
+            instrumentDataFile.seek(self.followPosition)
+            data = instrumentDataFile.read()
+            recordPositions = self.locate_records(data, baseOffset=self.followPosition)
+            recordEnd = max([ 0 ] + [ recordPositions[ id ][ -1 ] + self[ id ]._sizeInBytes
+                                      for id in recordPositions if recordPositions[ id ].size ])
+            self.read_other_records(instrumentDataFile, recordPositions, self.followPosition)
+        records = nortek.structures.readRecords(
+                numpy.frombuffer(data, numpy.uint8),
+                recordPositions[ '\x51' ],
+                recordDtype.itemsize).view(recordDtype)[ :, 0 ]
+        ensembles = velocityStructure.moveRecordsIntoDataArrays(records, self)
+        if ensembles.size:
+            gaps = self.find_gaps(ensembles - (self.lastEnsemble + 1), self.lastEnsemble + 1)
+            for key in gaps:
+                self[ 'gaps' ][ key ] = numpy.concatenate((self[ 'gaps' ][ key ], gaps[ key ]))
+            self.lastEnsemble = ensembles[ -1 ]
+        velocityStructure.finalizeDataArrays(self, keepBuffers=True)
+        self['\x07'].finalizeDataArrays(self, keepBuffers=True)
+        self['\x02'].finalizeDataArrays(self, keepBuffers=True)
+        self.pop('snr', None)
+        self.set_lazy('snr', self.calculate_snr)
+        # errors past the last record are looked at again next time
+        for id in self.checksumErrors:
+            checksumErrors[ id ] = numpy.concatenate(
+                    [ checksumErrors.get(id, numpy.zeros((0,), numpy.int64)),
+                      self.checksumErrors[ id ][ self.checksumErrors[ id ] < self.followPosition + recordEnd ] ])
+        self.checksumErrors = checksumErrors
+        self.filesize = self.followPosition + len(data)
+        self.followPosition += recordEnd
+        return records.size
 
     def cleanup(self):
+        if self.follow:
+            # refresh needs the structures and their counters
+            return
         for key in ('\x51', '\x0f', '\x07', '\x02', '\x50'):
             if key in self:
                 self.pop(key, None)
@@ -164,10 +1411,24 @@ class AD2CP(DataFile):
 	_structureName = {'\x15': 'Burst Data Record',
 					  '\x16': 'Current Profile Data Record',
 					  '\xa0': 'String Data Record' }
+	_headerSizeInBytes = 10
+	_dataRecordIDs = [ ord('\x15'), ord('\x16') ]
 	
-	def __init__(self, filepath = None):
-		UserDict.UserDict.__init__(self)
+	def __init__(self, filepath = None, readData = True, datenums = False, recordType = None):
+		"""time holds datetime64[us] values, or matplotlib date numbers
+		with datenums.
+
+		The data arrays hold one type of data record, recordType, '\x15' for
+		burst or '\x16' for current profile data records. By default it is
+		the type of the first data record in the file, the records of the
+		other type are then skipped with a warning; open the file again with
+		that recordType to read them."""
+		dict.__init__(self)
+		self.recordType = recordType
+		self.datenums = datenums
 		self.logger = logging.getLogger("Nortek." + self.instrument_type)
+		self.checksumErrors = {}
+		self._lazyKeys = {}
 		self.sourceReachable = False
 		if filepath:
 			try:    
@@ -176,90 +1437,327 @@ class AD2CP(DataFile):
 					self.filesize = os.path.getsize(filepath)
 					self.pathToSource, self.filename = os.path.split(filepath)
 					self.filename, self.sourceExtension = os.path.splitext(self.filename)
-				
-					self.logger.info('Reading data for %s from file %s', self.instrument_type, self.filename)
-					self.read_header(assignToArrays = False)
-					self.read_header(assignToArrays = True)
+					self.filepath = filepath
+					if readData:
+						self.logger.info('Reading data for %s from file %s', self.instrument_type, self.filename)
+						self.load_data()
+						if datenums and 'time' in self:
+							self[ 'time' ] = nortek.structures.datenums(self[ 'time' ])
 			except EnvironmentError as error:
 				self.logger.error("Looking for file %s, received error: " % error.filename + error.strerror)
 		else:
 			self.logger.error('No source file specified.')
 
-	def read_header(self, assignToArrays = False):
-		# each data record has it's own header
-		with open(os.path.join(self.pathToSource, self.filename + self.sourceExtension), 'rb') as instrumentDataFile:
-			while True:
-				sync = instrumentDataFile.read(1)
-				if not sync:
+	def load_data(self):
+		"""Locate the data records of the whole file with array operations
+		and decode the records sharing a layout (version, size, data
+		configuration, beams and cells) in one batch each."""
+		with open(self.filepath, 'rb') as instrumentDataFile:
+			data = instrumentDataFile.read()
+		buffer = numpy.frombuffer(data, numpy.uint8)
+		positions, ids, sizes = self.locate_data_records(buffer)
+		id = self.data_record_type(ids)
+		if id is None:
+			return
+		selected = ids == ord(id)
+		self.report_skipped_records(id, numpy.in1d(ids, self._dataRecordIDs).sum() - selected.sum())
+		dataStarts = positions[ selected ] + self._headerSizeInBytes
+		if not dataStarts.size:
+			return
+		self.read_first_data_record(id, buffer, dataStarts[ 0 ], sizes[ selected ][ 0 ])
+		self.decode_data_records(id, buffer, dataStarts, sizes[ selected ], self)
+
+	def read_first_data_record(self, id, buffer, dataStart, sizeInBytes):
+		# the first data record read gives the header data, the number of
+		# beams and cells of the data arrays and is kept as self[ id ]
+		recordStructure = nortek.structures.generateAD2CP_DataRecord_binary(buffer[ dataStart ], sizeInBytes)
+		self[ id ] = recordStructure.from_buffer_copy(buffer, dataStart)
+		self[ id ].numberOfBeams = self[ id ].cellsCSbeams.numberOfBeams
+		self[ id ].numberOfCells = self[ id ].cellsCSbeams.numberOfCells
+		self[ id ].moveHeader(self)
+
+	def decode_data_records(self, id, buffer, dataStarts, sizes, ad2cpInstrument):
+		# allocate the data arrays of ad2cpInstrument, for every data type
+		# found in the records, and decode the records starting at dataStarts
+		# of buffer into them, one ensemble each. Records of a layout that
+		# does not fit the arrays are left as NaN.
+		layouts = list(self.iter_data_record_layouts(id, buffer, dataStarts, sizes))
+		recordStructure = self[ id ]
+		for dataType in ('velocity', 'amplitude', 'correlation'):
+			setattr(recordStructure.configuration, 'includes' + dataType.capitalize(),
+					any(dataType in (dataBlocks.dtype.names or ()) for version, records, dataBlocks, rows in layouts))
+		recordStructure.ensembleCounter = dataStarts.size
+		recordStructure.allocateDataArrays(int(recordStructure.version), ad2cpInstrument)
+		recordStructure.ensembleCounter = dataStarts.size
+		for version, records, dataBlocks, rows in layouts:
+			recordStructure.moveRecordsIntoDataArrays(version, records, dataBlocks, rows, ad2cpInstrument)
+
+	def iter_data_record_layouts(self, id, buffer, dataStarts, sizes):
+		# the records starting at dataStarts of buffer grouped by layout, as
+		# ( version, records viewed through structureDtype, their data blocks,
+		# their rows in dataStarts )
+		versions = buffer[ dataStarts ]
+		layouts = numpy.zeros(dataStarts.shape, [ ('version', numpy.uint8), ('size', numpy.int64) ])
+		layouts[ 'version' ], layouts[ 'size' ] = versions, sizes
+		for version, sizeInBytes in numpy.unique(layouts):
+			inLayout = numpy.flatnonzero((versions == version) & (sizes == sizeInBytes))
+			recordStructure = nortek.structures.generateAD2CP_DataRecord_binary(version, sizeInBytes)
+			recordDtype = nortek.structures.structureDtype(recordStructure)
+			if recordDtype.itemsize > sizeInBytes:
+				continue
+			rows = nortek.structures.readRecords(buffer, dataStarts[ inLayout ], sizeInBytes)
+			records = numpy.ascontiguousarray(rows[ :, :recordDtype.itemsize ]).view(recordDtype)[ :, 0 ]
+			fieldTypes = dict(recordStructure._fields_)
+			configuration = nortek.structures.unpackBitfields(fieldTypes[ 'configuration' ], records[ 'configuration' ])
+			cellsCSbeams = nortek.structures.unpackBitfields(fieldTypes[ 'cellsCSbeams' ], records[ 'cellsCSbeams' ])
+			blockLayouts = numpy.column_stack([ configuration[ 'includesVelocity' ],
+												configuration[ 'includesAmplitude' ],
+												configuration[ 'includesCorrelation' ],
+												cellsCSbeams[ 'numberOfBeams' ],
+												cellsCSbeams[ 'numberOfCells' ] ])
+			for blockLayout in numpy.unique(blockLayouts.view([ ('', blockLayouts.dtype) ] * 5)):
+				blockLayout = tuple(int(value) for value in blockLayout)
+				inBlockLayout = numpy.flatnonzero((blockLayouts == blockLayout).all(axis=1))
+				numberOfBeams, numberOfCells = blockLayout[ 3: ]
+				if (numberOfBeams, numberOfCells) != (self[ id ].numberOfBeams, self[ id ].numberOfCells):
+					self.logger.warning('Skipped %d %s records of %d beams and %d cells in %s',
+										inBlockLayout.size, self._structureName[ id ],
+										numberOfBeams, numberOfCells, self.filename)
+					continue
+				dataBlockStructure = nortek.structures.generateAD2CP_DataBlock_binary(
+					nortek.structures.AD2CPConfiguration(*blockLayout[ :3 ]),
+					numberOfBeams,
+					numberOfCells)
+				blockDtype = numpy.dtype(dataBlockStructure)
+				if recordDtype.itemsize + blockDtype.itemsize > sizeInBytes:
+					continue
+				dataBlocks = numpy.ascontiguousarray(
+						rows[ inBlockLayout, recordDtype.itemsize:recordDtype.itemsize + blockDtype.itemsize ]
+						).view(blockDtype)[ :, 0 ]
+				yield int(version), records[ inBlockLayout ], dataBlocks, inLayout[ inBlockLayout ]
+
+	def data_record_type(self, ids):
+		# the id of the data records read, recordType or that of the first
+		# data record among ids, None when there is none
+		if self.recordType is not None:
+			return self.recordType
+		dataRecords = numpy.in1d(ids, self._dataRecordIDs)
+		if not dataRecords.any():
+			return None
+		return chr(ids[ dataRecords ][ 0 ])
+
+	def report_skipped_records(self, id, numberOfSkippedRecords):
+		if numberOfSkippedRecords:
+			otherID = '\x16' if id == '\x15' else '\x15'
+			self.logger.warning('Skipped %d %ss of %s, open it with recordType %r to read them',
+								numberOfSkippedRecords, self._structureName[ otherID ], self.filename, otherID)
+
+	def probe(self):
+		"""Describe the file from its first and last data records without
+		reading the rest. There is no configuration record, the time span
+		comes from the timestamps of the two records. The records can vary
+		in size, so the number of records is estimated from the bytes
+		between them and the sample rate from that and the time span. The
+		estimate counts record slots of the size of the first record: the
+		records of the other data record type, string records and records
+		that fail their checksum take slots as well, while a full read
+		only loads the valid records of one type."""
+		metadata = {'filepath': os.path.abspath(self.filepath),
+					'filesize': self.filesize,
+					'mtime': os.path.getmtime(self.filepath),
+					'instrumentType': self.instrument_type,
+					'serialNumber': None,
+					'sampleRate': None,
+					'coordinateSystem': None,
+					'numberOfRecords': 0,
+					'numberOfRecordsExact': True,
+					'startTime': None,
+					'endTime': None}
+		with open(self.filepath, 'rb') as instrumentDataFile:
+			first = self.read_end_data_record(instrumentDataFile)
+			if first is None:
+				return metadata
+			last = self.read_end_data_record(instrumentDataFile, first[ 1 ], fromEnd=True)
+		firstOffset, id, sizeInBytes, recordStructure, firstRecord = first
+		lastOffset, lastRecord = last[ 0 ], last[ 4 ]
+		cellsCSbeams = nortek.structures.unpackBitfields(
+				dict(recordStructure._fields_)[ 'cellsCSbeams' ], firstRecord[ 'cellsCSbeams' ])
+		metadata[ 'coordinateSystem' ] = { 0: 'ENU', 1: 'XYZ', 2: 'Beam' }.get(
+				int(cellsCSbeams[ 'coordinateSystem' ][ 0 ]))
+		metadata[ 'numberOfRecords' ] = (lastOffset - firstOffset) // (self._headerSizeInBytes + sizeInBytes) + 1
+		metadata[ 'numberOfRecordsExact' ] = False
+		metadata[ 'startTime' ] = nortek.structures.ad2cpTimestamps(firstRecord)[ 0 ]
+		metadata[ 'endTime' ] = nortek.structures.ad2cpTimestamps(lastRecord)[ 0 ]
+		span = (metadata[ 'endTime' ] - metadata[ 'startTime' ]) / numpy.timedelta64(1, 's')
+		if span > 0:
+			metadata[ 'sampleRate' ] = (metadata[ 'numberOfRecords' ] - 1) / span
+		return metadata
+
+	def read_end_data_record(self, instrumentDataFile, id = None, fromEnd = False):
+		# the first burst or current profile data record of the file (of type
+		# id if given), or with fromEnd the last one, found in a window at that
+		# end of the file grown until it holds one. Returns its file offset,
+		# id, data size, record structure and the record viewed through the
+		# structure's dtype, or None if there is none.
+		ids = [ ord(id) ] if id else [ ord('\x15'), ord('\x16') ]
+		length = 64 * 1024
+		while True:
+			start = max(self.filesize - length, 0) if fromEnd else 0
+			instrumentDataFile.seek(start)
+			buffer = numpy.frombuffer(instrumentDataFile.read(length), numpy.uint8)
+			positions, recordIds, sizes = self.locate_data_records(buffer, baseOffset = start)
+			selected = numpy.flatnonzero(numpy.in1d(recordIds, ids))
+			if selected.size or length >= self.filesize:
+				break
+			length *= 4
+		if not selected.size:
+			return None
+		index = selected[ -1 if fromEnd else 0 ]
+		dataStart = positions[ index ] + self._headerSizeInBytes
+		recordStructure = nortek.structures.generateAD2CP_DataRecord_binary(buffer[ dataStart ], sizes[ index ])
+		recordDtype = nortek.structures.structureDtype(recordStructure)
+		record = buffer[ dataStart:dataStart + recordDtype.itemsize ].copy().view(recordDtype)
+		return (start + int(positions[ index ]), chr(recordIds[ index ]), int(sizes[ index ]),
+				recordStructure, record)
+
+	def locate_data_records(self, buffer, stop = None, baseOffset = 0):
+		"""Byte offsets, ids and data sizes of the records whose header and
+		data checksums pass, with the same boundaries as a byte-by-byte scan.
+		Records starting at or after stop are left out. When buffer is only
+		part of the file, baseOffset is its offset in the file and is added
+		to the positions reported."""
+		headerSize = self._headerSizeInBytes
+		positions, ids, sizes, checksums = self.read_data_record_headers(buffer, stop)
+		inFile = positions + headerSize + sizes <= buffer.size
+		for position in positions[ ~inFile ]:
+			self.logger.info('Truncated %s structure at file position %d.',
+							 self._structureName.get(chr(buffer[ position + 2 ]), 'unknown'), baseOffset + position)
+		positions, ids, sizes, checksums = positions[ inFile ], ids[ inFile ], sizes[ inFile ], checksums[ inFile ]
+		valid = numpy.zeros(positions.shape, bool)
+		for sizeInBytes in numpy.unique(sizes):
+			ofSize = numpy.flatnonzero(sizes == sizeInBytes)
+			valid[ ofSize ], failed = nortek.structures.validateChecksums(
+					buffer, positions[ ofSize ] + headerSize, sizeInBytes, checksums[ ofSize ],
+					recordsPerChunk=max(1, self._bytesPerChunk // max(sizeInBytes, 1)))
+		keep = nortek.structures.resolveOverlaps(positions[ valid ], (positions + headerSize + sizes)[ valid ])
+		accepted = numpy.flatnonzero(valid)[ keep ]
+		ends = positions[ accepted ] + headerSize + sizes[ accepted ]
+		failed = numpy.flatnonzero(~valid)
+		enclosing = numpy.searchsorted(positions[ accepted ], positions[ failed ], side='right') - 1
+		inRecord = enclosing >= 0
+		inRecord[ inRecord ] = positions[ failed ][ inRecord ] < ends[ enclosing[ inRecord ] ]
+		for position, id in zip(positions[ failed ][ ~inRecord ], ids[ failed ][ ~inRecord ]):
+			self.logger.info("Checksum error in file %s at byte %d, structure type is %s",
+							 self.filename,
+							 baseOffset + position,
+							 self._structureName.get(chr(id), 'unknown'))
+		return positions[ accepted ], ids[ accepted ], sizes[ accepted ]
+
+	def read_data_record_headers(self, buffer, stop = None):
+		# offsets, ids, data sizes and data checksums of the record headers
+		# of buffer that start before stop and pass their checksum
+		headerSize = self._headerSizeInBytes
+		candidates = numpy.flatnonzero((buffer[ :-1 ] == 0xa5) & (buffer[ 1: ] == headerSize))
+		candidates = candidates[ candidates + headerSize <= buffer.size ]
+		if stop is not None:
+			candidates = candidates[ candidates < stop ]
+		validHeaders, failed = nortek.structures.validateChecksums(buffer, candidates, headerSize)
+		headers = nortek.structures.readRecords(buffer, candidates[ validHeaders ], headerSize)
+		return (candidates[ validHeaders ],
+				headers[ :, 2 ],
+				headers[ :, 4:6 ].copy().view('<u2')[ :, 0 ].astype(numpy.int64),
+				headers[ :, 6:8 ].copy().view('<u2')[ :, 0 ])
+
+	def incomplete_record_start(self, buffer):
+		# offset of the first record of buffer whose header passes but whose
+		# data runs past the end of buffer, or the first offset at which a
+		# header does not fit: where a block that ends before the end of the
+		# file stops. The data size field limits how far back such a record
+		# can start.
+		headerSize = self._headerSizeInBytes
+		tailStart = max(buffer.size - headerSize - 0xffff, 0)
+		positions, ids, sizes, checksums = self.read_data_record_headers(buffer[ tailStart: ])
+		incomplete = positions[ positions + headerSize + sizes > buffer.size - tailStart ]
+		if incomplete.size:
+			return tailStart + int(incomplete[ 0 ])
+		return buffer.size - headerSize + 1
+
+	def iter_data_record_blocks(self):
+		# read the file in blocks of about _bytesPerChunk bytes and yield each
+		# as a uint8 buffer with the offsets, ids and data sizes of the records
+		# located in it, as locate_data_records returns them. A record is
+		# never split between blocks, a block is grown when the record at its
+		# start does not fit in it.
+		headerSize = self._headerSizeInBytes
+		with open(self.filepath, 'rb') as instrumentDataFile:
+			blockStart = 0
+			data = instrumentDataFile.read(self._bytesPerChunk)
+			while data:
+				buffer = numpy.frombuffer(data, numpy.uint8)
+				atEnd = blockStart + len(data) >= self.filesize
+				stop = None if atEnd else self.incomplete_record_start(buffer)
+				if not atEnd and stop <= 0:
+					data += instrumentDataFile.read(self._bytesPerChunk)
+					continue
+				positions, ids, sizes = self.locate_data_records(buffer, stop, blockStart)
+				yield buffer, positions, ids, sizes
+				if atEnd:
 					break
-				elif sync == '\xa5':
-					sizeOfHeader = instrumentDataFile.read(1)
-					sizeOfHeader = struct.unpack('<B', sizeOfHeader)
-					self.sizeOfHeader = sizeOfHeader[ 0 ]
-					if self.sizeOfHeader > 10:
-						continue
-					instrumentDataFile.seek(-2, 1)
-					dataRecordHeader = nortek.structures.AD2CPHeader(
-							instrumentDataFile.read(self.sizeOfHeader))
-					dataRecordHeader[ 'version' ] = struct.unpack('<B', 
-							instrumentDataFile.read(1))
-					dataRecordHeader[ 'version' ] = dataRecordHeader[ 'version' ][ 0 ]
-					instrumentDataFile.seek(-1, 1)
-					numberOfBeams, numberOfCells = self.read_data(
-															 instrumentDataFile,
-															 dataRecordHeader[ 'id' ], 
-															 dataRecordHeader[ 'version' ],
-															 dataRecordHeader[ 'sizeInBytes' ],
-															 dataRecordHeader[ 'checksum' ],
-															 assignToArrays)
-
-	def read_data(self, instrumentDataFile, 
-								  id, 
-								  version, 
-								  sizeInBytes, 
-								  checksum, 
-								  assignToArrays = False):
-		if assignToArrays is False and id not in self:
-			binaryStructureGenerator = nortek.structures.generateAD2CP_DataRecord_binary(
-				version,
-				sizeInBytes)
-			self[ id ] = binaryStructureGenerator()
-		elif assignToArrays is True and not self[ id ].arraysAllocated:
-			self[ id ].allocateDataArrays(version, self)
-
-		if (instrumentDataFile.tell() + self[ id ]._sizeInBytes) < self.filesize:
-			self[ id ]._structureStart = instrumentDataFile.tell() - self.sizeOfHeader
-			self[ id ]._structureStop = self[ id ]._structureStart + self[ id ]._sizeInBytes + self.sizeOfHeader
-			self[ id ].checksum = checksum
-			instrumentDataFile.seek(self[ id ]._structureStop)
-			if not self[ id ].calculateChecksum(instrumentDataFile):
-				if not assignToArrays: # only report these on the first pass
-					self.reportChecksum(instrumentDataFile, id)
-			elif not assignToArrays:
-				if self[ id ].ensembleCounter == 0:
-					instrumentDataFile.seek(self[ id ]._structureStart + self.sizeOfHeader)
-					instrumentDataFile.readinto(self[ id ])
-					instrumentDataFile.seek(self[ id ]._structureStop)
-					self[ id ].numberOfBeams = self[ id ].cellsCSbeams.numberOfBeams
-					self[ id ].numberOfCells = self[ id ].cellsCSbeams.numberOfCells
-				self[ id ].incrementCounters()
-			elif assignToArrays:
-				# grab the configuration and other ancillary data
-				instrumentDataFile.seek(self[ id ]._structureStart + self.sizeOfHeader)
-				instrumentDataFile.readinto(self[ id ])
-				# now generate the data Structure
-				dataBlockGenerator = nortek.structures.generateAD2CP_DataBlock_binary(
-					self[ id ].configuration,
-					self[ id ].cellsCSbeams.numberOfBeams,
-					self[ id ].cellsCSbeams.numberOfCells) 
-				dataBlock = dataBlockGenerator()
-				instrumentDataFile.readinto(dataBlock)
-				instrumentDataFile.seek(self[ id ]._structureStop)
-				self[ id ].moveIntoDataArrays(version, dataBlock, self)
-		else:
-			logging.info('Truncated %s structure at file position %d.', self._structureName[ id ], instrumentDataFile.tell() - 2)
+				# the next block starts after the last record located here
+				carry = max([ stop ] + list(positions + headerSize + sizes))
+				blockStart += carry
+				data = data[ carry: ] + instrumentDataFile.read(self._bytesPerChunk)
+
+	def read_stream_header(self):
+		"""Read the first data record of the streamed type, which gives the
+		header data as in a full read and is kept as self[ id ] for
+		iter_decoded_records. Returns its id, None when the file holds no
+		data records."""
+		with open(self.filepath, 'rb') as instrumentDataFile:
+			first = self.read_end_data_record(instrumentDataFile, self.recordType)
+			if first is None:
+				return None
+			offset, id, sizeInBytes, recordStructure, record = first
+			instrumentDataFile.seek(offset)
+			buffer = numpy.frombuffer(instrumentDataFile.read(self._headerSizeInBytes + sizeInBytes), numpy.uint8)
+		self.read_first_data_record(id, buffer, self._headerSizeInBytes, sizeInBytes)
+		return id
+
+	def iter_decoded_records(self):
+		"""Yield the data records of the streamed type in file order, block
+		by block of iter_data_record_blocks, as (ensemble numbers, dict of
+		data type arrays shaped (cells, records, beams)). The time,
+		temperature and battery of the records come along as 1-D arrays and
+		the state sensors as 'state/heading' and so on, shaped as in a full
+		read. Each block is decoded in batches as by a full read. The
+		records of the other data record type are skipped with a warning,
+		as in a full read."""
+		id = self.read_stream_header()
+		if id is None:
+			return
+		ensembleCounter = 0
+		numberOfSkippedRecords = 0
+		for buffer, positions, ids, sizes in self.iter_data_record_blocks():
+			selected = ids == ord(id)
+			numberOfSkippedRecords += numpy.in1d(ids, self._dataRecordIDs).sum() - selected.sum()
+			dataStarts = positions[ selected ] + self._headerSizeInBytes
+			if not dataStarts.size:
+				continue
+			block = {'datasetDescription': self[ 'datasetDescription' ]}
+			self.decode_data_records(id, buffer, dataStarts, sizes[ selected ], block)
+			values = dict((dataType, block[ dataType ][ 'data' ]) for dataType in ('velocity', 'amplitude', 'correlation')
+						  if dataType in block)
+			for key in ('time', 'temperature', 'battery'):
+				values[ key ] = block[ key ]
+			for state, stateArray in block[ 'state' ].items():
+				values[ 'state/' + state ] = stateArray[ 'data' ]
+			yield numpy.arange(ensembleCounter, ensembleCounter + dataStarts.size), values
+			ensembleCounter += dataStarts.size
+		self.report_skipped_records(id, numberOfSkippedRecords)
 
-		return self[ id ].cellsCSbeams.numberOfBeams, self[ id ].cellsCSbeams.numberOfCells
+	def derive_stream_block(self, chunk):
+		if self.datenums:
+			chunk[ 'time' ] = nortek.structures.datenums(chunk[ 'time' ])
 
 	def cleanup(self):
 		self.pop("\x15", None)
@@ -366,54 +1864,382 @@ class HRProfiler(DataFile):
 	instrument_type = 'HR Profiler'
 	_structureName = {'\x2a': 'HR Profiler Data' }
 	
-	def read_data(self, assignToArrays = False):
-		if assignToArrays is False:
-			binaryStructureGenerator = nortek.structures.generateHRProfiler_DataRecord_binary(
-				self[ 'userConfiguration' ][ 'numberOfBeams' ],
-				self[ 'userConfiguration' ][ 'numberOfCells' ])
-			self[ '\x2a' ] = binaryStructureGenerator()
-			self[ '\x2a' ].setSizeInBytes()
+	def create_structures(self):
+		binaryStructureGenerator = nortek.structures.generateHRProfiler_DataRecord_binary(
+			self[ 'userConfiguration' ][ 'numberOfBeams' ],
+			self[ 'userConfiguration' ][ 'numberOfCells' ])
+		self[ '\x2a' ] = binaryStructureGenerator()
+		self[ '\x2a' ].setSizeInBytes()
+
+	def iter_decoded_records(self):
+		self.create_structures()
+		recordDtype = self[ '\x2a' ].recordDtype()
+		ensembleCounter = 0
+		for data, positions in self.iter_record_blocks():
+			records = nortek.structures.readRecords(
+					numpy.frombuffer(data, numpy.uint8),
+					positions[ '\x2a' ],
+					recordDtype.itemsize).view(recordDtype)[ :, 0 ]
+			ensembles = numpy.arange(ensembleCounter, ensembleCounter + records.size)
+			yield ensembles, self[ '\x2a' ].recordValues(records, self, self.dtype)
+			ensembleCounter += records.size
+
+	def load_data(self):
+		"""Locate the records with array operations, or take their offsets
+		from the record index, and decode them in bulk through the record
+		dtype built from the user configuration."""
+		self.create_structures()
+		recordStructure = self[ '\x2a' ]
+		recordDtype = recordStructure.recordDtype()
+		scan = None
+		if self.recordIndex is None:
+			scan = self.start_scan(self.filesize, self.endOfConfiguration, 
+				processes = self.processes)
+		with open(self.filepath, 'rb') as instrumentDataFile:
+			data = instrumentDataFile.read()
+		if self.recordIndex is None:
+			recordPositions = self.locate_records(data, self.endOfConfiguration,
+				processes = self.processes, scan = scan)
+			if self.recordIndexPath is not None:
+				self.save_record_index(recordPositions)
 		else:
-			self[ '\x2a' ].allocateDataArrays(self)
-			
-		with open(os.path.join(self.pathToSource, self.filename + self.sourceExtension), 'rb') as instrumentDataFile:
-			instrumentDataFile.seek(self.endOfConfiguration)
-			while True:
-				sync = instrumentDataFile.read(1)
-				if not sync:
-					break
-				elif sync == '\xa5':
-					id = instrumentDataFile.read(1)
-					if not id:
-						break
-					elif id in self._structureName:
-						if (instrumentDataFile.tell() + self[ id ]._sizeInBytes - 2) < self.filesize:
-							self[ id ]._structureStart = instrumentDataFile.tell() - 2
-							self[ id ]._structureStop = self[ id ]._structureStart + self[ id ]._sizeInBytes
-							# set FID to read checksum
-							instrumentDataFile.seek(self[ id ]._structureStop - 2)
-							self[ id ].checksum = struct.unpack('<H', instrumentDataFile.read(2))
-							self[ id ].checksum = self[ id ].checksum[ 0 ]
-							#pdb.set_trace()
-							if not self[ id ].calculateChecksum(instrumentDataFile):
-								pdb.set_trace()
-								if not assignToArrays: # only report these on the first pass
-									self.reportChecksum(instrumentDataFile, id)
-							elif not assignToArrays:
-								self[ id ].incrementCounters()
-							elif assignToArrays:
-								instrumentDataFile.seek(self[ id ]._structureStart + 2)
-								instrumentDataFile.readinto(self[ id ])
-								self[ id ].moveIntoDataArrays(self)
-								instrumentDataFile.seek(self[ id ]._structureStop)
-							#pdb.set_trace()
-						else:
-							logging.info('Truncated %s structure at file position %d.', self._structureName[ id ], instrumentDataFile.tell() - 2)
+			recordPositions = self.recordIndex[ 'positions' ]
+			self.checksumErrors = self.recordIndex[ 'checksumErrors' ]
+		positions = recordPositions[ '\x2a' ]
+		recordStructure.ensembleCounter = positions.size
+		recordStructure.allocateDataArrays(self, self.dtype)
+		buffer = numpy.frombuffer(data, numpy.uint8)
+		for chunkStart in range(0, positions.size, self._recordsPerChunk):
+			chunk = slice(chunkStart, chunkStart + self._recordsPerChunk)
+			records = nortek.structures.readRecords(
+					buffer, positions[ chunk ], recordDtype.itemsize).view(recordDtype)[ :, 0 ]
+			recordStructure.moveRecordsIntoDataArrays(
+					records, self, numpy.arange(positions.size)[ chunk ])
 
+	def count_records(self):
+		# the records have a fixed size and follow each other, their number
+		# comes from the offsets of the first and the last one. That counts
+		# the record slots between them: records in between that fail their
+		# checksum are counted but not loaded, so it is an estimate
+		self.create_structures()
+		with open(self.filepath, 'rb') as instrumentDataFile:
+			firstOffset = self.locate_end_record(instrumentDataFile, '\x2a')
+			lastOffset = self.locate_end_record(instrumentDataFile, '\x2a', fromEnd=True)
+		if firstOffset is None:
+			return 0, True
+		return ( lastOffset - firstOffset ) // self[ '\x2a' ]._sizeInBytes + 1, False
 
 	def cleanup(self):
 		pass
 
+class _CachePickler(pickle.Pickler):
+    """Pickles the decoded state of a file with each array saved as a .npy
+    file of the cache directory instead."""
+    def __init__(self, stateFile, directory):
+        pickle.Pickler.__init__(self, stateFile, 2)
+        self.directory = directory
+        self.numberOfArrays = 0
+
+    def persistent_id(self, value):
+        if isinstance(value, nortek.arrays.MappedDataArray):
+            value = numpy.asarray(value)
+        elif not isinstance(value, numpy.ndarray) or value.dtype.hasobject:
+            return None
+        arrayFile = '%d.npy' % self.numberOfArrays
+        numpy.save(os.path.join(self.directory, arrayFile), value)
+        self.numberOfArrays += 1
+        return arrayFile
+
+class _CacheUnpickler(pickle.Unpickler):
+    def __init__(self, stateFile, directory):
+        pickle.Unpickler.__init__(self, stateFile)
+        self.directory = directory
+
+    def persistent_load(self, arrayFile):
+        return numpy.load(os.path.join(self.directory, arrayFile), mmap_mode='c')
+
 class T (object):
 	pass
-	# empty class to hold the transformation matrices
\ No newline at end of file
+	# empty class to hold the transformation matrices
+
+# MATLAB classes of the numpy types that are exported
+_matlabClasses = {'float64': 'double', 'float32': 'single',
+                  'int8': 'int8', 'int16': 'int16', 'int32': 'int32', 'int64': 'int64',
+                  'uint8': 'uint8', 'uint16': 'uint16', 'uint32': 'uint32', 'uint64': 'uint64',
+                  'bool': 'logical'}
+
+def matlab_name(key):
+    """key as a MATLAB variable or field name."""
+    name = re.sub('[^A-Za-z0-9_]', '_', str(key))
+    if not re.match('[A-Za-z]', name):
+        name = 'x' + name
+    # namelengthmax
+    return name[ :63 ]
+
+def matlab_values(values):
+    """values as an array MATLAB can hold, times as microseconds since
+    1970."""
+    values = numpy.asarray(values)
+    if values.dtype.kind == 'M':
+        return values.astype('datetime64[us]').astype(numpy.int64)
+    return values
+
+def matlab_layout(values):
+    """MATLAB reads HDF5 datasets with their dimensions reversed, write
+    values transposed so they keep their shape, 1-D arrays as columns."""
+    values = numpy.asarray(values)
+    if values.ndim < 2:
+        return values.reshape(1, -1)
+    return values.transpose()
+
+def set_matlab_class(node, matlabClass):
+    node.attrs[ 'MATLAB_class' ] = numpy.string_(matlabClass)
+    if matlabClass == 'logical':
+        node.attrs[ 'MATLAB_int_decode' ] = numpy.int32(1)
+    elif matlabClass == 'char':
+        node.attrs[ 'MATLAB_int_decode' ] = numpy.int32(2)
+
+# instrument classes picked by load_files from the file extension
+_fileClasses = {'.vno': VectrinoFile,
+                '.ad2cp': AD2CP,
+                '.prf': HRProfiler}
+
+def file_class(filepath):
+    extension = os.path.splitext(filepath)[ 1 ].lower()
+    if extension not in _fileClasses:
+        raise ValueError("No instrument class for {} files ({})".format(extension, filepath))
+    return _fileClasses[ extension ]
+
+def data_arrays(instrument):
+    """The numeric arrays of a loaded file by key, taking the data of the
+    data array objects."""
+    arrays = {}
+    for key, value in instrument.items():
+        if isinstance(value, nortek.arrays.GenericDataArray):
+            value = value[ 'data' ]
+        if isinstance(value, numpy.ndarray) and value.dtype.kind in 'biufcM':
+            arrays[ key ] = value
+    return arrays
+
+def summarize_file(instrument):
+    summary = {'filepath': instrument.filepath,
+               'instrument_type': instrument.instrument_type,
+               'checksumErrors': sum(len(errors) for errors in instrument.checksumErrors.values())}
+    for key, values in data_arrays(instrument).items():
+        summary[ key ] = {'shape': values.shape}
+        if values.ndim == 3 and values.dtype.kind == 'f':
+            summary[ key ][ 'count' ] = numpy.isfinite(values).sum(axis=1)
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                summary[ key ][ 'mean' ] = numpy.nansum(values, axis=1) / summary[ key ][ 'count' ]
+                summary[ key ][ 'var' ] = numpy.nansum(
+                        (values - summary[ key ][ 'mean' ][ :, numpy.newaxis ]) ** 2,
+                        axis=1) / summary[ key ][ 'count' ]
+    if 'ensemble' in summary:
+        summary[ 'numberOfEnsembles' ] = summary[ 'ensemble' ][ 'shape' ][ 0 ]
+    return summary
+
+def probe_file(filepath):
+    """What DataFile.probe tells about a file, with the instrument class
+    picked from the extension."""
+    return file_class(filepath)(filepath, readData=False).probe()
+
+def _probe_file(filepath):
+    # runs in the worker processes of Catalog.update
+    try:
+        return probe_file(filepath)
+    except Exception as error:
+        logging.getLogger("Nortek").exception("Could not probe %s", filepath)
+        return {'filepath': filepath,
+                'filesize': os.path.getsize(filepath),
+                'mtime': os.path.getmtime(filepath),
+                'error': repr(error)}
+
+def _find_records_in_segment(task):
+    # runs in the worker processes of a parallel locate_records
+    filepath, size, sizesInBytes, start, stop, bytesPerChunk, recordsPerChunk = task
+    buffer = numpy.memmap(filepath, numpy.uint8, mode='r')[ :size ]
+    return nortek.structures.findRecords(buffer, sizesInBytes, start, stop,
+                                         bytesPerChunk, recordsPerChunk)
+
+def _load_file(task):
+    # runs in the worker processes, so it only returns plain dicts of arrays
+    # and strings
+    fileNumber, filepath, summarize, directory, options = task
+    try:
+        instrument = file_class(filepath)(filepath, **options)
+        if summarize:
+            return summarize_file(instrument)
+        loaded = {'filepath': filepath,
+                  'instrument_type': instrument.instrument_type,
+                  'arrays': {}}
+        for key, values in data_arrays(instrument).items():
+            arrayPath = os.path.join(directory, '{}-{}.npy'.format(fileNumber, key))
+            numpy.save(arrayPath, values)
+            loaded[ 'arrays' ][ key ] = arrayPath
+        return loaded
+    except Exception as error:
+        logging.getLogger("Nortek").exception("Could not load %s", filepath)
+        return {'filepath': filepath, 'error': repr(error)}
+
+def load_files(paths, summarize=True, processes=None, directory=None, **options):
+    """Load a list of files, or the files matching a glob pattern, with a
+    pool of processes, one file per task. The instrument class is picked from
+    the extension and options are passed on to it.
+
+    Returns a list in the order of the files. With summarize each entry is a
+    summary holding the shape of every data array and, for the (cells,
+    ensembles, beams) arrays, the count, mean and variance of the finite
+    samples per cell and beam. Otherwise each entry holds the data arrays
+    under 'arrays': the workers write them to .npy files in a temporary
+    directory, in /dev/shm where there is one, and they are mapped read only
+    from there instead of being pickled back. Files that fail to load come
+    back as {'filepath', 'error'}.
+
+    processes defaults to the number of cores, with 1 the files are loaded
+    in this process."""
+    if isinstance(paths, (type(''), type(u''))):
+        paths = sorted(glob.glob(paths))
+    paths = list(paths)
+    for filepath in paths:
+        file_class(filepath)
+    if directory is None and os.path.isdir('/dev/shm'):
+        directory = '/dev/shm'
+    arrayDirectory = None if summarize else tempfile.mkdtemp(prefix='nortek-', dir=directory)
+    mapped = False
+    try:
+        tasks = [ (fileNumber, filepath, summarize, arrayDirectory, options)
+                  for fileNumber, filepath in enumerate(paths) ]
+        if processes == 1 or len(paths) < 2:
+            results = [ _load_file(task) for task in tasks ]
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_load_file, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        if arrayDirectory is None:
+            return results
+        for loaded in results:
+            for key, arrayPath in loaded.get('arrays', {}).items():
+                loaded[ 'arrays' ][ key ] = numpy.load(arrayPath, mmap_mode='r')
+        mapped = True
+    finally:
+        # on POSIX systems the mappings outlive the directory entries, so
+        # only the arrays mapped so far are kept, also when loading fails
+        if arrayDirectory is not None and (os.name == 'posix' or not mapped):
+            shutil.rmtree(arrayDirectory, ignore_errors=True)
+    if os.name != 'posix':
+        logging.getLogger("Nortek").info("Data arrays of %d files are mapped from %s", len(paths), arrayDirectory)
+    return results
+
+class Catalog(object):
+    """An on-disk catalog of the files of an archive, an SQLite database of
+    what probe_file tells about each file, to pick files by instrument and
+    time without opening them. Times are stored as microseconds since
+    1970."""
+    _columns = (('filepath', 'TEXT PRIMARY KEY'),
+                ('filesize', 'INTEGER'),
+                ('mtime', 'REAL'),
+                ('instrumentType', 'TEXT'),
+                ('serialNumber', 'TEXT'),
+                ('sampleRate', 'REAL'),
+                ('coordinateSystem', 'TEXT'),
+                ('numberOfRecords', 'INTEGER'),
+                ('numberOfRecordsExact', 'INTEGER'),
+                ('startTime', 'INTEGER'),
+                ('endTime', 'INTEGER'),
+                ('error', 'TEXT'))
+
+    def __init__(self, catalogPath):
+        self.catalogPath = catalogPath
+        self.connection = sqlite3.connect(catalogPath)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files ({})'.format(
+                ', '.join(name + ' ' + columnType for name, columnType in self._columns)))
+        # catalogs written before a column was added get it, empty
+        existing = set(column[ 1 ] for column in self.connection.execute('PRAGMA table_info(files)'))
+        for name, columnType in self._columns:
+            if name not in existing:
+                self.connection.execute('ALTER TABLE files ADD COLUMN {} {}'.format(name, columnType))
+        self.connection.execute('CREATE INDEX IF NOT EXISTS files_by_time ON files (instrumentType, startTime)')
+        self.connection.commit()
+
+    def update(self, paths, processes=None):
+        """Probe the files of a list, or matching a glob pattern, that are not
+        in the catalog or whose size or modification time changed since, with
+        a pool of processes as in load_files. Returns the number of files
+        probed."""
+        if isinstance(paths, (type(''), type(u''))):
+            paths = sorted(glob.glob(paths))
+        catalogued = dict((filepath, (filesize, mtime)) for filepath, filesize, mtime in
+                          self.connection.execute('SELECT filepath, filesize, mtime FROM files'))
+        stale = []
+        for filepath in paths:
+            filepath = os.path.abspath(filepath)
+            if catalogued.get(filepath) != (os.path.getsize(filepath), os.path.getmtime(filepath)):
+                file_class(filepath)
+                stale.append(filepath)
+        if processes == 1 or len(stale) < 2:
+            entries = [ _probe_file(filepath) for filepath in stale ]
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                entries = pool.map(_probe_file, stale, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        names = [ name for name, columnType in self._columns ]
+        self.connection.executemany(
+                'INSERT OR REPLACE INTO files ({}) VALUES ({})'.format(', '.join(names), ', '.join('?' * len(names))),
+                [ [ self.to_column(name, entry.get(name)) for name in names ] for entry in entries ])
+        self.connection.commit()
+        return len(entries)
+
+    def to_column(self, name, value):
+        if value is None:
+            return None
+        elif name in ('startTime', 'endTime'):
+            return int(numpy.datetime64(value, 'us').astype(numpy.int64))
+        elif isinstance(value, bytes):
+            return value.rstrip(b'\x00').decode('latin-1')
+        elif isinstance(value, numpy.generic):
+            return value.item()
+        return value
+
+    def select(self, instrumentType=None, serialNumber=None, start=None, stop=None):
+        """The catalogued files, as probe_file entries ordered by start time,
+        of the instrument type and serial number given whose records overlap
+        the time range from start to stop (datetime64 values or ISO strings,
+        either can be None). Files that could not be probed are left out."""
+        conditions, parameters = [ 'error IS NULL' ], []
+        for name, value in (('instrumentType', instrumentType), ('serialNumber', serialNumber)):
+            if value is not None:
+                conditions.append(name + ' = ?')
+                parameters.append(value)
+        if start is not None:
+            conditions.append('endTime > ?')
+            parameters.append(self.to_column('endTime', start))
+        if stop is not None:
+            conditions.append('startTime < ?')
+            parameters.append(self.to_column('startTime', stop))
+        names = [ name for name, columnType in self._columns ]
+        rows = self.connection.execute('SELECT {} FROM files WHERE {} ORDER BY startTime, filepath'.format(
+                ', '.join(names), ' AND '.join(conditions)), parameters)
+        entries = []
+        for row in rows:
+            entry = dict(zip(names, row))
+            del entry[ 'error' ]
+            if entry[ 'numberOfRecordsExact' ] is not None:
+                entry[ 'numberOfRecordsExact' ] = bool(entry[ 'numberOfRecordsExact' ])
+            for name in ('startTime', 'endTime'):
+                if entry[ name ] is not None:
+                    entry[ name ] = numpy.datetime64(entry[ name ], 'us')
+            entries.append(entry)
+        return entries
+
+    def failures(self):
+        """The files that could not be probed and their errors."""
+        return dict(self.connection.execute('SELECT filepath, error FROM files WHERE error IS NOT NULL'))
+
+    def close(self):
+        self.connection.close()
@@ -8,11 +8,10 @@ from ctypes import *
 import UserDict
 import struct
 import re
+import collections
 import numpy
 import pdb
 from nortek import arrays as NortekDataArrays
-import datetime
-import pylab
 import logging
 
 moduleLogger = logging.getLogger( "Nortek." + __name__ )
@@ -26,6 +25,201 @@ class BCDTimeWord( Structure ):
 				 ( "month", c_ubyte ),
 				 ( "day", c_ubyte ) ]
 
+def readRecords( buffer, positions, sizeInBytes ):
+	# copy the records starting at the byte offsets positions of buffer (a
+	# uint8 array) into a 2-D uint8 array, one row per record, which can be
+	# viewed through a record dtype
+	positions = numpy.asarray( positions, dtype = numpy.intp )
+	if positions.size == 0:
+		return numpy.zeros( ( 0, sizeInBytes ), numpy.uint8 )
+	rows = numpy.lib.stride_tricks.as_strided( buffer,
+		shape = ( buffer.size - sizeInBytes + 1, sizeInBytes ),
+		strides = ( buffer.strides[ 0 ], buffer.strides[ 0 ] ) )
+	return rows[ positions ]
+
+def validateChecksums( buffer, positions, sizeInBytes, reportedChecksums = None, recordsPerChunk = 2 ** 20 ):
+	# Nortek checksum of a batch of records sharing one layout: 0xb58c plus the
+	# sum of the record's shorts, modulo 65536. Each block of records is viewed
+	# as a 2-D array of shorts and summed along the rows. By default the
+	# checksum is the last short of each record and the sum covers the shorts
+	# before it. AD2CP records carry it in their header instead, pass those
+	# values as reportedChecksums and the sum covers all sizeInBytes bytes.
+	# Returns a boolean mask over positions and the positions that failed.
+	positions = numpy.asarray( positions, dtype = numpy.intp )
+	valid = numpy.zeros( positions.shape, bool )
+	numberOfWords = sizeInBytes // 2
+	for chunkStart in range( 0, positions.size, recordsPerChunk ):
+		chunk = slice( chunkStart, chunkStart + recordsPerChunk )
+		words = readRecords( buffer, positions[ chunk ], 2 * numberOfWords ).view( '<i2' )
+		if reportedChecksums is None:
+			reportedChecksum = words[ :, -1 ].astype( numpy.uint16 )
+			words = words[ :, :-1 ]
+		else:
+			reportedChecksum = numpy.asarray( reportedChecksums )[ chunk ]
+		calculatedChecksum = ( 0xb58c + words.sum( axis = 1, dtype = numpy.int64 ) ) % 65536
+		valid[ chunk ] = calculatedChecksum == reportedChecksum
+	return valid, positions[ ~valid ]
+
+def findRecords( buffer, sizesInBytes, start = 0, stop = None, bytesPerChunk = 2 ** 26, recordsPerChunk = 2 ** 20 ):
+	# candidate records of buffer (a uint8 array) starting in [start, stop):
+	# every sync byte followed by one of the ids of sizesInBytes, a dict of
+	# record sizes keyed on id, whose record fits in buffer. Returns a dict
+	# keyed on id of the positions whose checksum passed and of those that
+	# failed. Candidates are checked on their own, settling the ones that
+	# overlap is left to resolveOverlaps.
+	if stop is None or stop > buffer.size - 1:
+		stop = buffer.size - 1
+	knownIDs = numpy.array( [ ord( id ) for id in sizesInBytes ], numpy.uint8 )
+	syncPositions = []
+	for chunkStart in range( start, stop, bytesPerChunk ):
+		chunk = buffer[ chunkStart:min( chunkStart + bytesPerChunk, stop ) + 1 ]
+		found = numpy.flatnonzero( chunk[ :-1 ] == 0xa5 )
+		syncPositions.append( found[ numpy.in1d( chunk[ found + 1 ], knownIDs ) ] + chunkStart )
+	syncPositions = numpy.concatenate( syncPositions or [ numpy.zeros( ( 0, ), numpy.int64 ) ] ).astype( numpy.int64 )
+	syncIDs = buffer[ syncPositions + 1 ]
+	candidates = {}
+	for id, sizeInBytes in sizesInBytes.items():
+		positions = syncPositions[ ( syncIDs == ord( id ) ) &
+			( syncPositions + sizeInBytes < buffer.size ) ]
+		valid, failed = validateChecksums( buffer, positions, sizeInBytes,
+			recordsPerChunk = recordsPerChunk )
+		candidates[ id ] = ( positions[ valid ], failed )
+	return candidates
+
+def unwrapCounter( count, previousCounter = 0, modulus = 256 ):
+	# the running counters of records that only carry them modulo modulus,
+	# continuing from previousCounter. Each record is taken to be the first
+	# one ahead of the previous record with its count, so any run of fewer
+	# than modulus lost records is counted, also across a wrap of the count.
+	# A record repeating the count of the record before it is a step of 0:
+	# it is taken to be the same sample again and gets the same counter,
+	# never a wrap over modulus lost records.
+	count = numpy.asarray( count, dtype = numpy.int64 )
+	steps = numpy.empty_like( count )
+	steps[ :1 ] = count[ :1 ] - previousCounter
+	steps[ 1: ] = numpy.diff( count )
+	return previousCounter + numpy.cumsum( steps % modulus )
+
+def counterGaps( counters ):
+	# the first missing counter and the number of counters missing for every
+	# jump of more than one in a sorted array of counters
+	counters = numpy.asarray( counters, dtype = numpy.int64 )
+	steps = numpy.diff( counters )
+	jumps = numpy.flatnonzero( steps > 1 )
+	return counters[ jumps ] + 1, steps[ jumps ] - 1
+
+def resolveOverlaps( positions, ends ):
+	# records that passed their checksum, sorted by their start positions, can
+	# still overlap: a record starting before the end of an earlier one only
+	# exists if that earlier one was not accepted, settle those few in file
+	# order. Returns a boolean mask of the records a byte-by-byte scan keeps.
+	keep = numpy.ones( positions.shape, bool )
+	if positions.size:
+		overlapping = numpy.flatnonzero( 
+			positions[ 1: ] < numpy.maximum.accumulate( ends )[ :-1 ] ) + 1
+		if overlapping.size:
+			clearEnds = ends.copy()
+			clearEnds[ overlapping ] = 0
+			clearEnds = numpy.maximum.accumulate( clearEnds )
+			keptEnd = 0
+			for index in overlapping:
+				if positions[ index ] < max( clearEnds[ index - 1 ], keptEnd ):
+					keep[ index ] = False
+				else:
+					keptEnd = max( keptEnd, ends[ index ] )
+	return keep
+
+def ad2cpTimestamps( records ):
+	# datetime64[us] of AD2CP records from their year (since 1900), month
+	# (from 0), day, hour, minute, seconds and microseconds columns. The
+	# microseconds field counts hundreds of microseconds.
+	years = numpy.asarray( records[ 'year' ], numpy.int64 ) + 1900 - 1970
+	times = years.astype( 'datetime64[Y]' ).astype( 'datetime64[M]' ) + \
+		numpy.asarray( records[ 'month' ], numpy.int64 ).astype( 'timedelta64[M]' )
+	times = times.astype( 'datetime64[us]' )
+	for field, unit in ( ( 'day', 'D' ), ( 'hour', 'h' ), ( 'minute', 'm' ), ( 'seconds', 's' ) ):
+		values = numpy.asarray( records[ field ], numpy.int64 )
+		if field == 'day':
+			values = values - 1
+		times += values.astype( 'timedelta64[%s]' % unit )
+	times += ( 100 * numpy.asarray( records[ 'microseconds' ], numpy.int64 ) ).astype( 'timedelta64[us]' )
+	return times
+
+def datenums( times ):
+	# matplotlib date numbers (days since 0001-01-01, which is 1) of datetime64 values
+	return ( numpy.asarray( times, 'datetime64[us]' ) - numpy.datetime64( '0001-01-01T00:00:00', 'us' ) ) / \
+		numpy.timedelta64( 1, 'D' ) + 1
+
+def clockTimestamp( clock ):
+	# datetime64[us] of the 6 byte BCD clock of the configuration and data
+	# records (minute, second, day, hour, year from 2000, month), None if it
+	# does not hold a valid date
+	minute, second, day, hour, year, month = [ ( byte >> 4 ) * 10 + ( byte & 0x0f ) 
+											   for byte in bytearray( clock ) ]
+	try:
+		return numpy.datetime64( '%04d-%02d-%02dT%02d:%02d:%02d' % 
+								 ( 2000 + year, month, day, hour, minute, second ), 'us' )
+	except ValueError:
+		return None
+
+def structureDtype( structure ):
+	# numpy dtype laid out like a ctypes Structure. Nested structures made of
+	# bit fields, which numpy can not describe, become unsigned integers of
+	# the same size; unpackBitfields splits them.
+	names, formats, offsets = [], [], []
+	for field in structure._fields_:
+		name, fieldType = field[ 0:2 ]
+		if isinstance( fieldType, type ) and issubclass( fieldType, Structure ) and \
+			any( len( subfield ) == 3 for subfield in fieldType._fields_ ):
+			fieldDtype = numpy.dtype( '<u%d' % sizeof( fieldType ) )
+		else:
+			fieldDtype = numpy.dtype( fieldType )
+		names.append( name )
+		formats.append( fieldDtype )
+		offsets.append( getattr( structure, name ).offset )
+	return numpy.dtype( { 'names': names,
+						  'formats': formats,
+						  'offsets': offsets,
+						  'itemsize': sizeof( structure ) } )
+
+def unpackBitfields( bitfieldStructure, values ):
+	# the fields of a bit field Structure from an array of the integers
+	# holding it. ctypes reports a bit field's size as bits << 16 | offset.
+	values = numpy.asarray( values )
+	unpacked = {}
+	for field in bitfieldStructure._fields_:
+		descriptor = getattr( bitfieldStructure, field[ 0 ] )
+		bitOffset, numberOfBits = descriptor.size & 0xffff, descriptor.size >> 16
+		unpacked[ field[ 0 ] ] = ( values >> bitOffset ) & ( ( 1 << numberOfBits ) - 1 )
+	return unpacked
+
+class MappedRecords( object ):
+	# records of one layout at known byte offsets of a memory-mapped file (a
+	# uint8 numpy.memmap) or of a uint8 array holding copies of the records
+	# back to back. Records that follow each other without a gap are a
+	# strided view of the map, otherwise each one is gathered from its offset
+	# when it is asked for. Nothing is copied until field() is called.
+	def __init__( self, buffer, positions, dtype ):
+		self.dtype = dtype
+		positions = numpy.asarray( positions, dtype = numpy.int64 )
+		self.numberOfRecords = positions.size
+		if positions.size and numpy.all( numpy.diff( positions ) == dtype.itemsize ):
+			self.view = buffer[ positions[ 0 ]:positions[ 0 ] + positions.size * dtype.itemsize ].view( dtype )
+		else:
+			self.view = None
+			self.buffer = buffer
+			self.positions = positions
+
+	def __len__( self ):
+		return self.numberOfRecords
+
+	def field( self, name, rows ):
+		if self.view is not None:
+			return self.view[ name ][ rows ]
+		return readRecords( self.buffer, 
+							self.positions[ rows ],
+							self.dtype.itemsize ).view( self.dtype )[ :, 0 ][ name ]
+
 class Header( UserDict.UserDict ):
 	def __init__( self, binaryDataString ):
 		UserDict.UserDict.__init__( self )
@@ -36,19 +230,12 @@ class Header( UserDict.UserDict ):
 			self.interpretBinaryData()
 			
 	def calculateChecksum( self ):
-		if self.length >= 4:
-			reportedChecksum = struct.unpack( '<H', self.binaryData[ -2: ] )
-			checksumFormatString = '<' + 'h' * ( self.length / 2 )
-			if struct.calcsize( checksumFormatString ) == self.length:
-				calculatedChecksum = ( int( 'b58c', base = 16 ) 
-											+ sum( struct.unpack( checksumFormatString,
-										self.binaryData[ 0:-2 ] ) ) ) % 65536
-			else:
-				self.checksum = False
-			if calculatedChecksum != reportedChecksum[ 0 ]:
-				self.checksum = False
-			else:
-				self.checksum = True
+		if self.length >= 4 and self.length % 2 == 0:
+			valid, failures = validateChecksums( 
+				numpy.frombuffer( self.binaryData, numpy.uint8 ),
+				[ 0 ],
+				self.length + 2 )
+			self.checksum = bool( valid[ 0 ] )
 		else:
 			self.checksum = False
 
@@ -231,24 +418,35 @@ class Header( UserDict.UserDict ):
 class NortekBinaryDataStructure( Structure ):
 	_structureStart = 0
 	_structureStop = 0
+
+	@classmethod
+	def recordDtype( cls ):
+		# numpy dtype laid out like the record in the file: the sync byte and
+		# id, which are read before the structure itself, then the ctypes fields
+		structureDtype = numpy.dtype( cls )
+		names = [ 'sync', 'id' ]
+		formats = [ numpy.uint8, numpy.uint8 ]
+		offsets = [ 0, 1 ]
+		for name in structureDtype.names:
+			fieldDtype, fieldOffset = structureDtype.fields[ name ][ 0:2 ]
+			names.append( name )
+			formats.append( fieldDtype )
+			offsets.append( fieldOffset + 2 )
+		return numpy.dtype( { 'names': names,
+							  'formats': formats,
+							  'offsets': offsets,
+							  'itemsize': structureDtype.itemsize + 2 } )
 	
 	def calculateChecksum( self, openDataFile ):
+		# single record version of validateChecksums, the record ends at the
+		# current file position
 		originalPosition = openDataFile.tell()
 		openDataFile.seek( originalPosition - self._sizeInBytes )
-		checksumDataType = c_short * ( self._sizeInBytes / 2 - 1 )
-		checksumData = checksumDataType()
-		openDataFile.readinto( checksumData )
+		recordBytes = numpy.frombuffer( openDataFile.read( self._sizeInBytes ), numpy.uint8 )
 		openDataFile.seek( originalPosition )
-		calculatedChecksum = int( 'b58c', base = 16 )
-		for aShort in checksumData:
-			calculatedChecksum += aShort
-		self.calculatedChecksum = calculatedChecksum % 65536
-		if self.checksum == self.calculatedChecksum:
-			self.checksumResult = True
-			return True
-		else:
-			self.checksumResult = False
-			return False
+		valid, failures = validateChecksums( recordBytes, [ 0 ], self._sizeInBytes )
+		self.checksumResult = bool( valid[ 0 ] )
+		return self.checksumResult
 
 	def incrementCounters( self ):
 		pass		
@@ -261,6 +459,9 @@ class NortekBinaryDataStructure( Structure ):
 		
 	def moveIntoDataArrays( self, anInstrument ):
 		pass
+
+	def finalizeDataArrays( self, anInstrument ):
+		pass
 	
 class VectrinoVelocityData_binary( NortekBinaryDataStructure ):
 	_fields_ = [ ( "status", c_char ),
@@ -272,47 +473,126 @@ class VectrinoVelocityData_binary( NortekBinaryDataStructure ):
 	_sizeInBytes = 22
 	ensembleCounter = 0
 	ensembleCycleCounter = 0
+	# ensemble number of the first row, set when only part of a file is read
+	firstEnsemble = 0
 	
 	def incrementCounters( self ):
-		if self.ensembleCounter > 1 and self.count == 0:
-			self.ensembleCycleCounter += 1
-		self.ensembleCounter = self.ensembleCycleCounter * 255 + self.count + self.ensembleCycleCounter
-# 		moduleLogger.info( 'Counter is {} and ensemble is {}'.format( 
-# 			self.count,
-# 			self.ensembleCounter ) )
-		#self.ensembleCounter += 1
-		#while self.ensembleCounter != self.ensembleCycleCounter * 255 + self.count:
-		#	self.ensembleCounter += 1
+		self.ensembleCounter += ( self.count - self.ensembleCounter ) % 256
+		self.ensembleCycleCounter = self.ensembleCounter // 256
 	
 	def resetCounters( self ):
 		self.ensembleCounter = 0
 		self.ensembleCycleCounter = 0
+
+	def ensembleIndices( self, count ):
+		# vectorized incrementCounters over a block of records: returns the
+		# ensemble each record is stored at, one less than its counter, and
+		# leaves the counters as if incrementCounters had been called once
+		# per record. Lost records leave their ensembles empty. A record
+		# repeating the count of the record before it goes to the same
+		# ensemble, where the later record overwrites the earlier one; those
+		# repeats are counted and logged.
+		count = numpy.asarray( count, dtype = numpy.int64 )
+		if count.size == 0:
+			return numpy.zeros( ( 0, ), numpy.int64 )
+		counter = unwrapCounter( count, self.ensembleCounter )
+		repeats = numpy.count_nonzero( counter[ 1: ] == counter[ :-1 ] )
+		if self.ensembleCounter and counter[ 0 ] == self.ensembleCounter:
+			repeats += 1
+		if repeats:
+			moduleLogger.warning( '%d velocity records repeat the count of the record before them, '
+				'only the last of each run is kept', repeats )
+		self.ensembleCounter = int( counter[ -1 ] )
+		self.ensembleCycleCounter = self.ensembleCounter // 256
+		return numpy.maximum( counter - 1, 0 )
 		
-	def allocateDataArrays( self, vectrinoInstrument ):
-		samepleRate = vectrinoInstrument[ 'userConfiguration' ][ 'sampleRate' ]
-		vectrinoInstrument[ 'velocity' ] = NortekDataArrays.VelocityDataArray( 
-			samepleRate,
-			shape = ( 1, self.ensembleCounter, 4 ) )
-		vectrinoInstrument[ 'amplitude' ] = NortekDataArrays.GenericDataArray( 
-			samepleRate,
-			shape = ( 1, self.ensembleCounter, 4 ) )
-		vectrinoInstrument[ 'snr' ] = NortekDataArrays.GenericDataArray( 
-			samepleRate,
-			shape = ( 1, self.ensembleCounter, 4 ) )
-		vectrinoInstrument[ 'correlation' ] = NortekDataArrays.GenericDataArray( 
-			samepleRate,
-			shape = ( 1, self.ensembleCounter, 4 ) )
-		vectrinoInstrument[ 'ensemble' ] = numpy.arange( 0, self.ensembleCounter, 1 )
+	def allocateDataArrays( self, vectrinoInstrument, dataTypes = ( 'velocity', 'amplitude', 'correlation' ), dtype = numpy.float64 ):
+		# the number of ensembles is only known once the whole file has been
+		# read, so fill growable buffers and trim them in finalizeDataArrays.
+		# dataTypes selects the quantities that are decoded.
 		self.resetCounters()
+		self._buffers = {}
+		for dataType in dataTypes:
+			self._buffers[ dataType ] = NortekDataArrays.GrowableArray( shape = ( 1, 0, 4 ), dtype = dtype )
+		# the data arrays handed out while the buffers are kept open
+		self._dataArrays = {}
+		self._statistics = NortekDataArrays.StreamingStatistics()
 		
 	def moveIntoDataArrays( self, vectrinoInstrument ):
-		try:
-			vectrinoInstrument[ 'velocity' ][ 'data' ][ 0, self.ensembleCounter, : ] = self.velocity[ 0:4 ]
-			vectrinoInstrument[ 'amplitude' ][ 'data' ][ 0, self.ensembleCounter, : ] = self.amplitude[ 0:4 ]
-			vectrinoInstrument[ 'correlation' ][ 'data' ][ 0, self.ensembleCounter, : ] = self.correlation[ 0:4 ]
-			self.incrementCounters()
-		except IndexError as error:
-			pdb.set_trace()
+		self.incrementCounters()
+		for dataType in self._buffers:
+			self._buffers[ dataType ].put( max( self.ensembleCounter - 1, 0 ), getattr( self, dataType )[ 0:4 ] )
+
+	def moveRecordsIntoDataArrays( self, records, vectrinoInstrument, ensembles = None ):
+		# bulk counterpart of moveIntoDataArrays for a block of records viewed
+		# through recordDtype(). ensembles can come from a record index or an
+		# earlier ensembleIndices call, the counters then have to be set to
+		# their final values beforehand. Returns the ensemble of each record.
+		if ensembles is None:
+			ensembles = self.ensembleIndices( records[ 'count' ] )
+		for dataType in self._buffers:
+			self._buffers[ dataType ].reserve( self.ensembleCounter )
+			self._buffers[ dataType ].put( ensembles, records[ dataType ] )
+		return ensembles
+
+	def mapDataArrays( self, records, vectrinoInstrument, ensembles = None, dtype = numpy.float64 ):
+		# memory-mapped alternative to allocate/move/finalize, records is a
+		# MappedRecords of velocity records. The arrays stay in the file and
+		# are decoded when they are indexed. ensembles works as in
+		# moveRecordsIntoDataArrays.
+		if ensembles is None:
+			self.resetCounters()
+			ensembles = self.ensembleIndices( records.field( 'count', slice( None ) ) )
+		sampleRate = vectrinoInstrument[ 'userConfiguration' ][ 'sampleRate' ]
+		velocity = NortekDataArrays.MappedDataArray( records, 'velocity', ensembles, self.ensembleCounter, dtype )
+		vectrinoInstrument[ 'velocity' ] = NortekDataArrays.VelocityDataArray( 
+			sampleRate,
+			data = velocity )
+		vectrinoInstrument[ 'amplitude' ] = NortekDataArrays.GenericDataArray( 
+			sampleRate,
+			data = velocity.derived( 'amplitude' ) )
+		vectrinoInstrument[ 'correlation' ] = NortekDataArrays.GenericDataArray( 
+			sampleRate,
+			data = velocity.derived( 'correlation' ) )
+		vectrinoInstrument[ 'ensemble' ] = numpy.arange( self.firstEnsemble, self.firstEnsemble + self.ensembleCounter, 1 )
+		return ensembles
+
+	def finalizeDataArrays( self, vectrinoInstrument, keepBuffers = False ):
+		# keepBuffers leaves the buffers open for more records, the data
+		# arrays are then views of them. The same data array objects are
+		# handed out on every such call with their data swapped, and the
+		# velocity statistics are updated with the ensembles added since the
+		# last call only, through StreamingStatistics, so its median is
+		# approximate once the sketch is full.
+		sampleRate = vectrinoInstrument[ 'userConfiguration' ][ 'sampleRate' ]
+		for dataType in self._buffers:
+			if not keepBuffers:
+				data = self._buffers[ dataType ].trim( self.ensembleCounter )
+				if dataType == 'velocity':
+					vectrinoInstrument[ dataType ] = NortekDataArrays.VelocityDataArray( sampleRate, data = data )
+				else:
+					vectrinoInstrument[ dataType ] = NortekDataArrays.GenericDataArray( sampleRate, data = data )
+				continue
+			data = self._buffers[ dataType ].view( self.ensembleCounter )
+			if dataType not in self._dataArrays:
+				if dataType == 'velocity':
+					self._dataArrays[ dataType ] = NortekDataArrays.VelocityDataArray( sampleRate, data = data[ :, :0 ] )
+				else:
+					self._dataArrays[ dataType ] = NortekDataArrays.GenericDataArray( sampleRate, data = data[ :, :0 ] )
+			dataArray = self._dataArrays[ dataType ]
+			if dataType == 'velocity':
+				self._statistics.update( data[ :, dataArray.numberOfSamples: ] )
+				dataArray.mean = self._statistics.mean
+				dataArray.median = self._statistics.median()
+				dataArray.var = self._statistics.variance()
+			dataArray[ 'data' ] = data
+			dataArray.numberOfSamples = data.shape[ 1 ]
+			vectrinoInstrument[ dataType ] = dataArray
+		vectrinoInstrument[ 'ensemble' ] = numpy.arange( self.firstEnsemble, self.firstEnsemble + self.ensembleCounter, 1 )
+		if not keepBuffers:
+			del self._buffers
+			del self._dataArrays
+			del self._statistics
 			
 class VectrinoFileInfo_binary( NortekBinaryDataStructure ):
 	_fields_ = [ ( "sizeInWords", c_short ),
@@ -381,15 +661,30 @@ class VectrinoProbeCheck_binary( NortekBinaryDataStructure ):
 		
 	def allocateDataArrays( self, vectrinoInstrument ):
 		vectrinoInstrument[ 'probeCheck' ] = {}
-		vectrinoInstrument[ 'probeCheck' ][ 'amplitude' ] = numpy.zeros( ( 4, self.samplesPerBeam, self.probeCheckCounter ) )
+		# samplesPerBeam is only known once the first probe check has been read
+		self._buffer = None
 		self.resetCounters()
 		
 	def moveIntoDataArrays( self, vectrinoInstrument ):
-		for beamNumber in range( 0, 4, 1 ):
-			vectrinoInstrument[ 'probeCheck' ][ 'amplitude' ][ beamNumber, :, self.probeCheckCounter ] = \
-				self.amplitude[ beamNumber ][ : ]
+		if self._buffer is None:
+			self._buffer = NortekDataArrays.GrowableArray( 
+				shape = ( 4, self.samplesPerBeam, 0 ),
+				axis = 2,
+				fillValue = 0,
+				initialLength = 4 )
+		self._buffer.put( self.probeCheckCounter, numpy.array( self.amplitude ) )
 		self.generateDistances( vectrinoInstrument, vectrinoInstrument[ '\x50' ].speedOfSound )
 		self.incrementCounters()
+
+	def finalizeDataArrays( self, vectrinoInstrument, keepBuffers = False ):
+		if self._buffer is None:
+			vectrinoInstrument[ 'probeCheck' ][ 'amplitude' ] = numpy.zeros( ( 4, self.samplesPerBeam, 0 ) )
+		elif keepBuffers:
+			vectrinoInstrument[ 'probeCheck' ][ 'amplitude' ] = self._buffer.view( self.probeCheckCounter )
+		else:
+			vectrinoInstrument[ 'probeCheck' ][ 'amplitude' ] = self._buffer.trim( self.probeCheckCounter )
+		if not keepBuffers:
+			del self._buffer
 		
 	def generateDistances( self, vectrinoInstrument, speedOfSound = 1500.0 ):
 		dVertDist = 5.7 # mm
@@ -424,17 +719,28 @@ class VectrinoDistanceMeasurement_binary( NortekBinaryDataStructure ):
 		
 	def allocateDataArrays( self, vectrinoInstrument ):
 		vectrinoInstrument[ 'distance' ] = {}
-		vectrinoInstrument[ 'distance' ][ 'fromProbe' ] = numpy.zeros( ( self.distanceCounter, ) )
-		vectrinoInstrument[ 'distance' ][ 'quality' ] = numpy.zeros( ( self.distanceCounter, ) )
+		self._buffers = { 'fromProbe': NortekDataArrays.GrowableArray( shape = ( 0, ), axis = 0, fillValue = 0, initialLength = 16 ),
+						  'quality': NortekDataArrays.GrowableArray( shape = ( 0, ), axis = 0, fillValue = 0, initialLength = 16 ) }
 		self.resetCounters()
 		
 	def moveIntoDataArrays( self, vectrinoInstrument ):
-		vectrinoInstrument[ 'distance' ][ 'fromProbe' ][ self.distanceCounter ] = \
-				self.distance / 10.0
-		vectrinoInstrument[ 'distance' ][ 'quality' ][ self.distanceCounter ] = \
-				self.quality
+		self._buffers[ 'fromProbe' ].put( self.distanceCounter, self.distance / 10.0 )
+		self._buffers[ 'quality' ].put( self.distanceCounter, self.quality )
 		self.incrementCounters()
 
+	def finalizeDataArrays( self, vectrinoInstrument, keepBuffers = False ):
+		if keepBuffers:
+			finalize = lambda buffer: buffer.view( self.distanceCounter )
+		else:
+			finalize = lambda buffer: buffer.trim( self.distanceCounter )
+		vectrinoInstrument[ 'distance' ][ 'fromProbe' ] = finalize( self._buffers[ 'fromProbe' ] )
+		# the velocity header also reports a distance quality, only replace it
+		# when distance measurement records were found
+		if self.distanceCounter or 'quality' not in vectrinoInstrument[ 'distance' ]:
+			vectrinoInstrument[ 'distance' ][ 'quality' ] = finalize( self._buffers[ 'quality' ] )
+		if not keepBuffers:
+			del self._buffers
+
 class AD2CPHeader( Header ):
 	def interpretBinaryData( self, instrumentType = None ):
 		self[ 'id' ], \
@@ -449,7 +755,21 @@ class AD2CPHeader( Header ):
 			
 		return instrumentType
 
+# the generated AD2CP classes, keyed on their layout
+_AD2CP_DataRecordClasses = {}
+_AD2CP_DataBlockClasses = {}
+
+# the configuration bits that decide the layout of an AD2CP data block
+AD2CPConfiguration = collections.namedtuple( 'AD2CPConfiguration', 
+	[ 'includesVelocity', 'includesAmplitude', 'includesCorrelation' ] )
+
 def generateAD2CP_DataRecord_binary( version, sizeInBytes ):
+	if ( version, sizeInBytes ) not in _AD2CP_DataRecordClasses:
+		_AD2CP_DataRecordClasses[ ( version, sizeInBytes ) ] = \
+			_generateAD2CP_DataRecord_binary( version, sizeInBytes )
+	return _AD2CP_DataRecordClasses[ ( version, sizeInBytes ) ]
+
+def _generateAD2CP_DataRecord_binary( version, sizeInBytes ):
 	class ConfigurationBitMask( Structure ):
 		_fields_ = [ ( "validP", c_ubyte, 1 ), 
 					 ( "validT", c_ubyte, 1 ),
@@ -620,22 +940,14 @@ def generateAD2CP_DataRecord_binary( version, sizeInBytes ):
 		_sizeInBytes = sizeInBytes
 		
 		def calculateChecksum( self, openDataFile ):
+			# the data checksum is carried in the record header
 			originalPosition = openDataFile.tell()
 			openDataFile.seek( originalPosition - self._sizeInBytes )
-			checksumDataType = c_short * ( self._sizeInBytes / 2 )
-			checksumData = checksumDataType()
-			openDataFile.readinto( checksumData )
+			recordBytes = numpy.frombuffer( openDataFile.read( self._sizeInBytes ), numpy.uint8 )
 			openDataFile.seek( originalPosition )
-			calculatedChecksum = int( 'b58c', base = 16 )
-			for aShort in checksumData:
-				calculatedChecksum += aShort
-			self.calculatedChecksum = calculatedChecksum % 65536
-			if self.checksum == self.calculatedChecksum:
-				self.checksumResult = True
-				return True
-			else:
-				self.checksumResult = False
-				return False
+			valid, failures = validateChecksums( recordBytes, [ 0 ], self._sizeInBytes, [ self.checksum ] )
+			self.checksumResult = bool( valid[ 0 ] )
+			return self.checksumResult
 		
 		def incrementCounters( self ):
 			self.ensembleCounter += 1
@@ -649,18 +961,19 @@ def generateAD2CP_DataRecord_binary( version, sizeInBytes ):
 					self.numberOfCells, 
 					self.ensembleCounter,
 					self.numberOfBeams ) )
+			# NaN for the records whose layout lacks the data type
 			if self.configuration.includesAmplitude:
-				ad2cpInstrument[ 'amplitude' ] = NortekDataArrays.GenericDataArray( shape = ( 
+				ad2cpInstrument[ 'amplitude' ] = NortekDataArrays.GenericDataArray( data = numpy.full( ( 
 					self.numberOfCells, 
 					self.ensembleCounter,
-					self.numberOfBeams ) )
+					self.numberOfBeams ), numpy.nan ) )
 			if self.configuration.includesCorrelation:
-				ad2cpInstrument[ 'correlation' ] = NortekDataArrays.GenericDataArray( shape =( 
+				ad2cpInstrument[ 'correlation' ] = NortekDataArrays.GenericDataArray( data = numpy.full( ( 
 					self.numberOfCells, 
 					self.ensembleCounter,
-					self.numberOfBeams ) )
+					self.numberOfBeams ), numpy.nan ) )
 			ad2cpInstrument[ 'ensemble' ] = numpy.zeros( ( self.ensembleCounter,  ) )
-			ad2cpInstrument[ 'time' ] = numpy.zeros( ( self.ensembleCounter,  ) )
+			ad2cpInstrument[ 'time' ] = numpy.zeros( ( self.ensembleCounter,  ), 'datetime64[us]' )
 			ad2cpInstrument[ 'temperature' ] = numpy.zeros( ( self.ensembleCounter,  ) )
 			ad2cpInstrument[ 'battery' ] = numpy.zeros( ( self.ensembleCounter,  ) )
 			ad2cpInstrument[ 'state' ] = { 'heading': NortekDataArrays.GenericDataArray( shape = ( 1, self.ensembleCounter ) ),
@@ -691,15 +1004,9 @@ def generateAD2CP_DataRecord_binary( version, sizeInBytes ):
 					ad2cpInstrument[ 'correlation' ][ 'data' ][ :, self.ensembleCounter, datasetNumber ] \
 						= dataBlock.correlation[ datasetNumber ][ : ]
 			ad2cpInstrument[ 'ensemble' ][ self.ensembleCounter, ] = self.ensembleCounter
-			ensembleDateStr = datetime.datetime( self.year + 1900, 
-												 self.month + 1, 
-												 self.day, 
-												 self.hour, 
-												 self.minute, 
-												 self.seconds, 
-												 self.microseconds )
-			ad2cpInstrument[ 'time' ][ self.ensembleCounter, ] = pylab.datestr2num( 
-				'{:%Y-%m-%d %H:%M:%S}'.format( ensembleDateStr ) )
+			ad2cpInstrument[ 'time' ][ self.ensembleCounter, ] = ad2cpTimestamps( 
+				dict( ( field, getattr( self, field ) ) 
+					  for field in ( 'year', 'month', 'day', 'hour', 'minute', 'seconds', 'microseconds' ) ) )
 			ad2cpInstrument[ 'temperature' ][ self.ensembleCounter, ] = self.temperature
 			ad2cpInstrument[ 'battery' ][ self.ensembleCounter, ] = self.battery
 			ad2cpInstrument[ 'state' ][ 'heading' ][ 'data' ][ 0, self.ensembleCounter ] = self.heading
@@ -715,6 +1022,34 @@ def generateAD2CP_DataRecord_binary( version, sizeInBytes ):
 					self.accelorometerRawData_y,
 					self.accelorometerRawData_z ]
 			self.incrementCounters()
+
+		def moveRecordsIntoDataArrays( self, version, records, dataBlocks, ensembles, ad2cpInstrument ):
+			# bulk counterpart of moveIntoDataArrays. records are the record
+			# structures viewed through structureDtype(), dataBlocks their data
+			# blocks (all of one layout) and ensembles the ensemble of each
+			if ensembles.size == 0:
+				return
+			scaling = 1000 * 10.0**records[ 'velocityScaling' ]
+			for datasetNumber in ad2cpInstrument[ 'datasetDescription' ]:
+				for dataType in dataBlocks.dtype.names or ():
+					if dataType not in ad2cpInstrument:
+						continue
+					values = dataBlocks[ dataType ][ :, datasetNumber, : ].T
+					if dataType == 'velocity':
+						values = values * scaling
+					ad2cpInstrument[ dataType ][ 'data' ][ :, ensembles, datasetNumber ] = values
+			ad2cpInstrument[ 'ensemble' ][ ensembles ] = ensembles
+			ad2cpInstrument[ 'time' ][ ensembles ] = ad2cpTimestamps( records )
+			ad2cpInstrument[ 'temperature' ][ ensembles ] = records[ 'temperature' ]
+			ad2cpInstrument[ 'battery' ][ ensembles ] = records[ 'battery' ]
+			for state in ( 'heading', 'pitch', 'roll' ):
+				ad2cpInstrument[ 'state' ][ state ][ 'data' ][ 0, ensembles ] = records[ state ]
+			if version is 2 or version is 3:
+				for state, sensor in ( ( 'magnetometer', 'magentometerRawData' ),
+									   ( 'accelorometer', 'accelorometerRawData' ) ):
+					for axisNumber, axis in enumerate( ( 'x', 'y', 'z' ) ):
+						ad2cpInstrument[ 'state' ][ state ][ 'data' ][ axisNumber, ensembles ] = \
+							records[ sensor + '_' + axis ]
 	
 		def moveHeader( self, ad2cpInstrument ):
 			ad2cpInstrument[ 'userConfiguration' ] = {	"numberOfCells": self.cellsCSbeams.numberOfCells,
@@ -737,6 +1072,16 @@ def generateAD2CP_DataRecord_binary( version, sizeInBytes ):
 	return AD2CP_DataRecord_binary
 
 def generateAD2CP_DataBlock_binary( configuration, numberOfBeams, numberOfCells ):
+	layout = ( AD2CPConfiguration( bool( configuration.includesVelocity ),
+								   bool( configuration.includesAmplitude ),
+								   bool( configuration.includesCorrelation ) ),
+			   numberOfBeams,
+			   numberOfCells )
+	if layout not in _AD2CP_DataBlockClasses:
+		_AD2CP_DataBlockClasses[ layout ] = _generateAD2CP_DataBlock_binary( *layout )
+	return _AD2CP_DataBlockClasses[ layout ]
+
+def _generateAD2CP_DataBlock_binary( configuration, numberOfBeams, numberOfCells ):
 	adhoc_fields_ = []
 	sizeInBytes = 0
 	if configuration.includesVelocity:
@@ -798,7 +1143,7 @@ def generateHRProfiler_DataRecord_binary( numberOfBeams = 3, numberOfCells = 1 )
 		def resetCounters( self ):
 			self.ensembleCounter = 0
 		
-		def allocateDataArrays( self, hrProfilerInstrument ):
+		def allocateDataArrays( self, hrProfilerInstrument, dtype = numpy.float64 ):
 			if 'sampleRate' in hrProfilerInstrument[ 'userConfiguration' ]:
 				sampleRate = hrProfilerInstrument[ 'userConfiguration' ][ 'sampleRate' ]
 			else:
@@ -808,19 +1153,22 @@ def generateHRProfiler_DataRecord_binary( numberOfBeams = 3, numberOfCells = 1 )
 				shape = ( 
 					hrProfilerInstrument[ 'userConfiguration' ][ 'numberOfCells' ], 
 					self.ensembleCounter,
-					hrProfilerInstrument[ 'userConfiguration' ][ 'numberOfBeams' ] ) )
+					hrProfilerInstrument[ 'userConfiguration' ][ 'numberOfBeams' ] ),
+				dtype = dtype )
 			hrProfilerInstrument[ 'amplitude' ] = NortekDataArrays.GenericDataArray( 
 				sampleRate,
 				shape = ( 
 					hrProfilerInstrument[ 'userConfiguration' ][ 'numberOfCells' ], 
 					self.ensembleCounter,
-					hrProfilerInstrument[ 'userConfiguration' ][ 'numberOfBeams' ] ) )
+					hrProfilerInstrument[ 'userConfiguration' ][ 'numberOfBeams' ] ),
+				dtype = dtype )
 			hrProfilerInstrument[ 'correlation' ] = NortekDataArrays.GenericDataArray( 
 				sampleRate,
 				shape = ( 
 					hrProfilerInstrument[ 'userConfiguration' ][ 'numberOfCells' ], 
 					self.ensembleCounter,
-					hrProfilerInstrument[ 'userConfiguration' ][ 'numberOfBeams' ] ) )
+					hrProfilerInstrument[ 'userConfiguration' ][ 'numberOfBeams' ] ),
+				dtype = dtype )
 			hrProfilerInstrument[ 'ensemble' ] = numpy.zeros( ( self.ensembleCounter,  ) )
 			self.resetCounters()
 		
@@ -836,5 +1184,23 @@ def generateHRProfiler_DataRecord_binary( numberOfBeams = 3, numberOfCells = 1 )
 					= self.correlation[ beamNumber ][ : ]
 				hrProfilerInstrument[ 'ensemble' ][ self.ensembleCounter, ] = self.ensembleCounter
 			self.incrementCounters()
+
+		def recordValues( self, records, hrProfilerInstrument, dtype = numpy.float64 ):
+			# velocity, amplitude and correlation of records viewed through
+			# recordDtype(), shaped ( cells, records, beams ) like the data arrays
+			values = {}
+			for dataType in ( 'velocity', 'amplitude', 'correlation' ):
+				# ( records, beams, cells ) in the file
+				values[ dataType ] = records[ dataType ].transpose( 2, 0, 1 ).astype( dtype )
+			values[ 'velocity' ] *= hrProfilerInstrument[ 'userConfiguration' ][ 'velocityScaling' ]
+			return values
+
+		def moveRecordsIntoDataArrays( self, records, hrProfilerInstrument, ensembles ):
+			# bulk counterpart of moveIntoDataArrays, ensembles gives the
+			# ensemble of each record
+			for dataType, values in self.recordValues( records, hrProfilerInstrument,
+				hrProfilerInstrument[ 'velocity' ][ 'data' ].dtype ).items():
+				hrProfilerInstrument[ dataType ][ 'data' ][ :, ensembles, : ] = values
+			hrProfilerInstrument[ 'ensemble' ][ ensembles ] = ensembles
 	
 	return HRProfiler_DataRecord_binary
\ No newline at end of file
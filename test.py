@@ -6,9 +6,12 @@ Created on Wed Dec 17 18:24:36 2014
 """
 
 from __future__ import print_function, division
-from nortek.files import VectrinoFile
+from nortek.files import VectrinoFile, load_files, probe_file, Catalog
+from nortek.structures import unwrapCounter, counterGaps
 from nortek.controls import PdControl
 import matplotlib.pyplot as plt
+import numpy as np
+import pytest
 
 def test_vectrino_file():
     vec = VectrinoFile("examples/test.vno")
@@ -18,7 +21,503 @@ def test_vectrino_file():
     print(vec["hardwareConfiguration"])
     plt.plot(u)
     plt.show()
+
+def test_vectrino_ensemble_range():
+    vec = VectrinoFile("examples/test.vno")
+    part = VectrinoFile("examples/test.vno", ensembles=slice(100, 400))
+    assert (part["ensemble"] == vec["ensemble"][100:400]).all()
+    assert (part["velocity"]["data"] == vec["velocity"]["data"][:, 100:400]).all()
+    for ensembles in [slice(-100, None), slice(0, -1)]:
+        try:
+            VectrinoFile("examples/test.vno", ensembles=ensembles)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("negative ensembles were read")
+
+def test_vectrino_chunks():
+    vec = VectrinoFile("examples/test.vno")
+    stream = VectrinoFile("examples/test.vno", readData=False)
+    chunks = list(stream.iter_chunks(1000))
+    assert all(chunk["velocity"].shape[1] == 1000 for chunk in chunks[:-1])
+    u = np.concatenate([ chunk["velocity"] for chunk in chunks ], axis=1)
+    assert (u == vec["velocity"]["data"]).all()
+
+def test_vectrino_compact_dtype():
+    vec = VectrinoFile("examples/test.vno")
+    for options in [{"compact": True}, {"dtype": np.float32}]:
+        loaded = VectrinoFile("examples/test.vno", **options)
+        assert (loaded["ensemble"] == vec["ensemble"]).all()
+        for dataType in ["velocity", "amplitude", "correlation", "snr"]:
+            data = np.asarray(loaded[dataType]["data"][...])
+            assert data.shape == vec[dataType]["data"].shape
+            assert np.allclose(data, vec[dataType]["data"], rtol=1e-6, equal_nan=True)
+    assert VectrinoFile("examples/test.vno", dtype=np.float32)["velocity"]["data"].dtype == np.float32
+
+def test_vectrino_memory_mapped():
+    vec = VectrinoFile("examples/test.vno")
+    mapped = VectrinoFile("examples/test.vno", memoryMapped=True)
+    assert (mapped["ensemble"] == vec["ensemble"]).all()
+    for dataType in ["velocity", "amplitude", "correlation", "snr"]:
+        data = np.asarray(mapped[dataType]["data"][...])
+        assert data.shape == vec[dataType]["data"].shape
+        assert np.allclose(data, vec[dataType]["data"], equal_nan=True)
+    assert np.array_equal(mapped["velocity"]["data"][:, 100:200:3, 2],
+                          vec["velocity"]["data"][:, 100:200:3, 2])
+
+def test_load_files():
+    vec = VectrinoFile("examples/test.vno")
+    summaries = load_files("examples/*.vno", processes=2)
+    assert summaries[0]["numberOfEnsembles"] == vec["ensemble"].size
+    assert summaries[0]["checksumErrors"] == 0
+    assert summaries[0]["instrument_type"] == "Vectrino"
+    loaded = load_files(["examples/test.vno"] * 2, summarize=False)
+    assert all((l["arrays"]["ensemble"] == vec["ensemble"]).all() for l in loaded)
+
+def test_load_files_cleanup(tmpdir, monkeypatch):
+    import nortek.files
+    loaded = load_files(["examples/test.vno"], summarize=False, directory=str(tmpdir))
+    assert loaded[0]["arrays"]["velocity"].shape[0] == 1
+    assert tmpdir.listdir() == []
+    def fail(*args, **kwargs):
+        raise MemoryError()
+    monkeypatch.setattr(nortek.files.numpy, "load", fail)
+    with pytest.raises(MemoryError):
+        load_files(["examples/test.vno"], summarize=False, directory=str(tmpdir))
+    assert tmpdir.listdir() == []
+
+def test_parallel_scan():
+    vec = VectrinoFile("examples/test.vno")
+    bytesPerSegment = VectrinoFile._bytesPerSegment
+    VectrinoFile._bytesPerSegment = 4096
+    try:
+        parallel = VectrinoFile("examples/test.vno", processes=2)
+    finally:
+        VectrinoFile._bytesPerSegment = bytesPerSegment
+    assert (parallel["ensemble"] == vec["ensemble"]).all()
+    assert np.array_equal(np.nan_to_num(parallel["velocity"]["data"]),
+                          np.nan_to_num(vec["velocity"]["data"]))
+    assert np.array_equal(parallel["probeCheck"]["amplitude"], vec["probeCheck"]["amplitude"])
+
+def test_vectrino_follow(tmpdir):
+    vec = VectrinoFile("examples/test.vno")
+    with open("examples/test.vno", "rb") as source:
+        raw = source.read()
+    followPath = str(tmpdir.join("follow.vno"))
+    with open(followPath, "wb") as growing:
+        growing.write(raw[:len(raw) // 2])
+    follower = VectrinoFile(followPath, follow=True)
+    velocity = follower["velocity"]
+    with open(followPath, "ab") as growing:
+        growing.write(raw[len(raw) // 2:])
+    follower.refresh()
+    assert (follower["ensemble"] == vec["ensemble"]).all()
+    assert follower["velocity"] is velocity
+    assert np.array_equal(np.nan_to_num(velocity["data"]),
+                          np.nan_to_num(vec["velocity"]["data"]))
+    assert np.allclose(velocity.mean, vec["velocity"].mean)
+    assert np.allclose(velocity.var, vec["velocity"].var)
+
+def test_unwrap_counter(caplog):
+    from nortek.structures import VectrinoVelocityData_binary
+    # a repeated count is the same sample again, not a wrap
+    counters = unwrapCounter([250, 252, 3, 4, 4, 10])
+    assert list(counters) == [250, 252, 259, 260, 260, 266]
+    starts, lengths = counterGaps(counters)
+    assert list(starts) == [251, 253, 261] and list(lengths) == [1, 6, 5]
+    velocity = VectrinoVelocityData_binary()
+    assert list(velocity.ensembleIndices([250, 252, 3, 4, 4, 10])) == [249, 251, 258, 259, 259, 265]
+    assert "1 velocity records repeat" in caplog.text
+    caplog.clear()
+    assert list(velocity.ensembleIndices([10, 11])) == [265, 266]
+    assert "1 velocity records repeat" in caplog.text
+
+def test_vectrino_hdf5(tmpdir):
+    import h5py
+    vec = VectrinoFile("examples/test.vno")
+    stream = VectrinoFile("examples/test.vno", readData=False)
+    hdf5File = stream.exportToHDF5(str(tmpdir.join("test.h5")), ensemblesPerChunk=1000)
+    with h5py.File(hdf5File, "r") as exported:
+        assert exported["velocity/data"].chunks == (1, 1000, 4)
+        assert np.array_equal(np.nan_to_num(exported["velocity/data"][...]),
+                              np.nan_to_num(vec["velocity"]["data"]))
+        assert exported["userConfiguration"].attrs["sampleRate"] == 200
+        assert np.array_equal(np.nan_to_num(exported["snr/data"][...]),
+                              np.nan_to_num(vec["snr"]["data"]))
+        assert exported["velocityHeader/noise/amplitude"].attrs["1"] == \
+            vec["velocityHeader"]["noise"]["amplitude"][1]
+        assert np.array_equal(exported["probeCheck/amplitude"][...], vec["probeCheck"]["amplitude"])
+        assert np.array_equal(exported["gaps/ensemble"][...], vec["gaps"]["ensemble"])
+
+def test_vectrino_matlab(tmpdir):
+    from scipy.io import loadmat
+    vec = VectrinoFile("examples/test.vno")
+    matlabFile = vec.exportToMatlabV5(str(tmpdir.join("test.mat")))
+    exported = loadmat(matlabFile, struct_as_record=False, squeeze_me=True)
+    assert exported["velocity"].data.shape == vec["velocity"]["data"].shape[1:]
+    assert exported["userConfiguration"].sampleRate == 200
+
+def test_vectrino_matlab_v7p3(tmpdir):
+    import h5py
+    vec = VectrinoFile("examples/test.vno")
+    matlabFile = vec.exportToMatlabV7p3(str(tmpdir.join("test.mat")), ensemblesPerChunk=1000)
+    with open(matlabFile, "rb") as exported:
+        header = exported.read(128)
+    assert header.startswith(b"MATLAB 7.3 MAT-file")
+    assert header[124:] == b"\x00\x02IM"
+    with h5py.File(matlabFile, "r") as exported:
+        velocity = exported["velocity/data"]
+        assert velocity.shape == vec["velocity"]["data"].shape[::-1]
+        assert np.array_equal(np.nan_to_num(velocity[...]),
+                              np.nan_to_num(vec["velocity"]["data"].T))
+        matlabClasses = [ (exported["velocity"], "struct"), (velocity, "double"),
+                          (exported["ensemble"], "int64"), (exported["userConfiguration"], "struct") ]
+        for item, matlabClass in matlabClasses:
+            assert item.attrs["MATLAB_class"] in (matlabClass, matlabClass.encode("ascii"))
     
+def test_vectrino_cache(tmpdir):
+    vec = VectrinoFile("examples/test.vno")
+    VectrinoFile("examples/test.vno", cache=str(tmpdir))
+    cached = VectrinoFile("examples/test.vno", cache=str(tmpdir))
+    assert isinstance(cached["velocity"]["data"], np.memmap)
+    assert np.array_equal(np.nan_to_num(cached["velocity"]["data"]),
+                          np.nan_to_num(vec["velocity"]["data"]))
+    assert cached["userConfiguration"]["sampleRate"] == 200
+    
+def test_probe_file(tmpdir):
+    metadata = probe_file("examples/test.vno")
+    assert metadata["instrumentType"] == "Vectrino"
+    assert metadata["numberOfRecords"] == len(VectrinoFile("examples/test.vno")["ensemble"])
+    catalog = Catalog(str(tmpdir.join("catalog.db")))
+    assert catalog.update("examples/*.vno") == 1
+    assert catalog.update("examples/*.vno") == 0
+    assert len(catalog.select("Vectrino", start=metadata["startTime"])) == 1
+    assert len(catalog.select(stop=metadata["startTime"])) == 0
+    catalog.close()
+
+def test_probe_interleaved_records(tmpdir):
+    vec = VectrinoFile("examples/test.vno")
+    with open("examples/test.vno", "rb") as source:
+        raw = source.read()
+    vec.create_structures()
+    positions = vec.locate_records(raw, vec.endOfConfiguration)
+    probeCheck = positions["\x07"][0]
+    middle = positions["\x51"][positions["\x51"].size // 2]
+    splicedPath = str(tmpdir.join("spliced.vno"))
+    with open(splicedPath, "wb") as spliced:
+        spliced.write(raw[:middle] + raw[probeCheck:probeCheck + 2064] + raw[middle:])
+    metadata = probe_file(splicedPath)
+    assert len(VectrinoFile(splicedPath)["ensemble"]) == len(vec["ensemble"])
+    assert metadata["numberOfRecords"] == len(vec["ensemble"])
+    assert not metadata["numberOfRecordsExact"]
+    assert probe_file("examples/test.vno")["numberOfRecordsExact"]
+    
+def ad2cp_record(id, ensemble, includes=(1, 1, 1), numberOfBeams=4, numberOfCells=2, velocityScaling=-3):
+    import ctypes, struct
+    from nortek.structures import generateAD2CP_DataRecord_binary
+    random = np.random.RandomState(ensemble)
+    recordSize = ctypes.sizeof(generateAD2CP_DataRecord_binary(3, 0))
+    blocks = [ random.randint(-3000, 3000, (numberOfBeams, numberOfCells)).astype("<i2"),
+               random.randint(0, 256, (numberOfBeams, numberOfCells)).astype(np.uint8),
+               random.randint(0, 101, (numberOfBeams, numberOfCells)).astype(np.uint8) ]
+    block = b"".join(values.tostring() for values, included in zip(blocks, includes) if included)
+    record = generateAD2CP_DataRecord_binary(3, recordSize + len(block))()
+    record.version = 3
+    (record.configuration.includesVelocity, record.configuration.includesAmplitude,
+     record.configuration.includesCorrelation) = includes
+    record.cellsCSbeams.numberOfBeams = numberOfBeams
+    record.cellsCSbeams.numberOfCells = numberOfCells
+    for dataset in range(numberOfBeams):
+        setattr(record.datasetDescription, "physicalBeamDataSet%d" % (dataset + 1), dataset + 1)
+    record.year, record.month, record.day = 116, ensemble % 12, 1 + ensemble % 28
+    record.hour, record.minute, record.seconds = ensemble % 24, ensemble % 60, (7 * ensemble) % 60
+    record.microseconds = (1234 * ensemble) % 10000
+    record.velocityScaling = velocityScaling
+    record.temperature, record.battery = 1500 + ensemble, 120 + ensemble
+    record.heading, record.pitch, record.roll = 3600 - ensemble, -ensemble, ensemble
+    record.magentometerRawData_x, record.accelorometerRawData_z = -ensemble, 2 * ensemble
+    data = ctypes.string_at(ctypes.addressof(record), recordSize) + block
+    header = b"\xa5\x0a" + id + b"\x10" + struct.pack("<HH", len(data), nortek_checksum(data))
+    return header + struct.pack("<H", nortek_checksum(header)) + data
+
+def nortek_checksum(data):
+    return (0xb58c + int(np.frombuffer(data[:len(data) // 2 * 2], "<i2").sum(dtype=np.int64))) % 65536
+
+def write_ad2cp(path, records):
+    """Write the records back to back, returns their file offsets."""
+    offsets = np.cumsum([ 0 ] + [ len(record) for record in records ])[ :-1 ]
+    with open(path, "wb") as ad2cpFile:
+        ad2cpFile.write(b"".join(records))
+    return offsets
+
+@pytest.fixture
+def ad2cp_file(tmpdir):
+    """Two layouts of current profile data records, burst records of
+    another size in between and a record whose data checksum fails.
+    Returns the path and the file offsets of the records."""
+    records = [ ad2cp_record(b"\x16", n, includes=(1, 1, 1) if n % 3 else (1, 0, 0)) for n in range(50) ]
+    records[10:10] = [ ad2cp_record(b"\x15", 100 + n, numberOfCells=3) for n in range(5) ]
+    corrupt = bytearray(records[20])
+    corrupt[-1] ^= 0xff
+    records[20] = bytes(corrupt)
+    path = str(tmpdir.join("synthetic.ad2cp"))
+    return path, write_ad2cp(path, records)
+
+def test_ad2cp_file(ad2cp_file, caplog):
+    import ctypes, struct
+    from nortek.files import AD2CP
+    from nortek.structures import generateAD2CP_DataRecord_binary, generateAD2CP_DataBlock_binary
+    path, offsets = ad2cp_file
+    with open(path, "rb") as source:
+        raw = source.read()
+    ad2cp = AD2CP(path)
+    assert "Skipped 5 Burst Data Records" in caplog.text
+    decoded = [ offset for number, offset in enumerate(offsets)
+                if raw[offset + 2:offset + 3] == b"\x16" and number != 20 ]
+    assert ad2cp["velocity"]["data"].shape == (2, len(decoded), 4)
+    for ensemble, offset in enumerate(decoded):
+        sizeInBytes = struct.unpack_from("<H", raw, offset + 4)[0]
+        recordStructure = generateAD2CP_DataRecord_binary(3, sizeInBytes)
+        record = recordStructure.from_buffer_copy(raw, offset + 10)
+        blockStructure = generateAD2CP_DataBlock_binary(record.configuration, 4, 2)
+        block = blockStructure.from_buffer_copy(raw, offset + 10 + ctypes.sizeof(record))
+        assert generateAD2CP_DataRecord_binary(3, sizeInBytes) is recordStructure
+        assert generateAD2CP_DataBlock_binary(record.configuration, 4, 2) is blockStructure
+        assert np.array_equal(ad2cp["velocity"]["data"][:, ensemble],
+                              np.array(block.velocity, float).T * 1000 * 10.0 ** record.velocityScaling)
+        for dataType in ["amplitude", "correlation"]:
+            expected = np.array(getattr(block, dataType)).T if hasattr(block, dataType) else np.nan
+            assert np.allclose(ad2cp[dataType]["data"][:, ensemble], expected, equal_nan=True)
+        assert ad2cp["temperature"][ensemble] == record.temperature
+        assert ad2cp["battery"][ensemble] == record.battery
+        assert ad2cp["state"]["heading"]["data"][0, ensemble] == record.heading
+        assert ad2cp["state"]["magnetometer"]["data"][0, ensemble] == record.magentometerRawData_x
+        assert ad2cp["state"]["accelorometer"]["data"][2, ensemble] == record.accelorometerRawData_z
+    assert AD2CP(path, recordType="\x15")["velocity"]["data"].shape == (3, 5, 4)
+
+def test_ad2cp_stream(ad2cp_file, caplog):
+    from nortek.files import AD2CP
+    path, offsets = ad2cp_file
+    ad2cp = AD2CP(path)
+    stream = AD2CP(path, readData=False)
+    # blocks shorter than a record, so they are grown to take one
+    stream._bytesPerChunk = 64
+    caplog.clear()
+    chunks = list(stream.iter_chunks(8))
+    assert "Skipped 5 Burst Data Records" in caplog.text
+    assert np.array_equal(np.concatenate([ chunk["ensemble"] for chunk in chunks ]), np.arange(49))
+    for dataType in ["velocity", "amplitude", "correlation"]:
+        assert np.allclose(np.concatenate([ chunk[dataType] for chunk in chunks ], axis=1),
+                           ad2cp[dataType]["data"], equal_nan=True)
+    
+def test_ad2cp_timestamps(tmpdir):
+    import datetime
+    from matplotlib.dates import date2num
+    from nortek.files import AD2CP
+    from nortek.structures import ad2cpTimestamps, datenums
+    # year from 1900, month from 0 and the microseconds in hundreds
+    fields = {"year": [116, 99], "month": [0, 11], "day": [1, 31], "hour": [0, 23],
+              "minute": [0, 59], "seconds": [0, 59], "microseconds": [1, 9999]}
+    times = ad2cpTimestamps(dict((field, np.array(values)) for field, values in fields.items()))
+    expected = [ datetime.datetime(2016, 1, 1, 0, 0, 0, 100), datetime.datetime(1999, 12, 31, 23, 59, 59, 999900) ]
+    assert list(times) == [ np.datetime64(time) for time in expected ]
+    assert np.allclose(datenums(times), date2num(expected), rtol=0, atol=1e-9)
+    path = str(tmpdir.join("synthetic.ad2cp"))
+    write_ad2cp(path, [ ad2cp_record(b"\x16", n) for n in range(5) ])
+    times = AD2CP(path)["time"]
+    assert times.dtype == np.dtype("datetime64[us]")
+    assert np.allclose(AD2CP(path, datenums=True)["time"], date2num(times.astype(datetime.datetime)),
+                       rtol=0, atol=1e-9)
+
+def test_ad2cp_stream_export(ad2cp_file, tmpdir):
+    import h5py
+    from scipy.io import loadmat
+    from nortek.files import AD2CP
+    path, offsets = ad2cp_file
+    full, stream = AD2CP(path), AD2CP(path, readData=False)
+    for export in ["exportToHDF5", "exportToMatlabV7p3"]:
+        datasets = []
+        for name, ad2cp in [("full", full), ("stream", stream)]:
+            exportPath = getattr(ad2cp, export)(str(tmpdir.join(name + ".h5")), ensemblesPerChunk=16)
+            with h5py.File(exportPath, "r") as exported:
+                names = []
+                exported.visititems(lambda key, item: names.append(key) if isinstance(item, h5py.Dataset) else None)
+                datasets.append(dict((key, exported[key][...]) for key in names))
+        assert sorted(datasets[0]) == sorted(datasets[1])
+        for key in ["time", "temperature", "battery", "state/heading/data", "state/magnetometer/data",
+                    "state/accelorometer/data", "velocity/data"]:
+            assert np.allclose(datasets[0][key], datasets[1][key], equal_nan=True)
+    variables = []
+    for name, ad2cp in [("full", full), ("stream", stream)]:
+        exported = loadmat(ad2cp.exportToMatlabV5(str(tmpdir.join(name + ".mat"))),
+                           struct_as_record=False, squeeze_me=True)
+        variables.append(exported)
+        assert sorted(exported["state"]._fieldnames) == \
+            ["accelorometer", "heading", "magnetometer", "pitch", "roll"]
+    assert sorted(variables[0]) == sorted(variables[1])
+    assert np.array_equal(variables[0]["time"], variables[1]["time"])
+    assert np.array_equal(variables[0]["state"].heading.data, variables[1]["state"].heading.data)
+    streamed = AD2CP(path, readData=False, datenums=True)
+    with h5py.File(streamed.exportToHDF5(str(tmpdir.join("datenums.h5"))), "r") as exported:
+        assert np.allclose(exported["time"][...], AD2CP(path, datenums=True)["time"])
+
+@pytest.fixture
+def hr_profiler_file(tmpdir):
+    """An HR Profiler file of 400 records with test.vno's configuration, an
+    AQD serial number, firmware 3.20 and a velocity scaling of 0.1 mm/s,
+    cut off in the middle of a last record. Returns its path and the file
+    offsets of the whole records."""
+    import ctypes, struct
+    from nortek.structures import generateHRProfiler_DataRecord_binary
+    with open("examples/test.vno", "rb") as source:
+        configuration = bytearray(source.read(784))
+    configuration[4:18] = b"AQD 1046".ljust(14)
+    configuration[42:46] = b"3.20"
+    modeWord = 272 + 58
+    configuration[modeWord] |= 1 << 4
+    for start, size in [(0, 48), (48, 224), (272, 512)]:
+        configuration[start + size - 2:start + size] = struct.pack(
+                "<H", nortek_checksum(bytes(configuration[start:start + size - 2])))
+    recordStructure = generateHRProfiler_DataRecord_binary(4, 1)
+    random = np.random.RandomState(0)
+    records = []
+    for ensemble in range(400):
+        record = recordStructure()
+        record.sizeInWords = (ctypes.sizeof(record) + 4) // 2
+        record.numberOfBeams, record.numberOfCells = 4, 1
+        for beam in range(4):
+            record.velocity[beam][0] = random.randint(-3000, 3000)
+            record.amplitude[beam][0] = random.randint(0, 256)
+            record.correlation[beam][0] = random.randint(0, 101)
+        data = b"\xa5\x2a" + ctypes.string_at(ctypes.addressof(record), ctypes.sizeof(record))
+        records.append(data + struct.pack("<H", nortek_checksum(data)))
+    path = str(tmpdir.join("synthetic.prf"))
+    offsets = write_ad2cp(path, [bytes(configuration)] + records + [records[0][:40]])[1:-1]
+    return path, offsets
+
+def test_hr_profiler_file(hr_profiler_file, tmpdir):
+    import ctypes
+    from nortek.files import HRProfiler
+    from nortek.structures import generateHRProfiler_DataRecord_binary
+    path, offsets = hr_profiler_file
+    profiler = HRProfiler(path)
+    assert profiler["type"] == "HR Profiler"
+    assert profiler["userConfiguration"]["velocityScaling"] == 0.1
+    with open(path, "rb") as source:
+        raw = source.read()
+    recordStructure = generateHRProfiler_DataRecord_binary(4, 1)
+    assert profiler["velocity"]["data"].shape == (1, len(offsets), 4)
+    for ensemble, offset in enumerate(offsets):
+        record = recordStructure.from_buffer_copy(raw, offset + 2)
+        assert np.allclose(profiler["velocity"]["data"][:, ensemble],
+                           np.array(record.velocity, float).T * 0.1)
+        assert np.array_equal(profiler["amplitude"]["data"][:, ensemble], np.array(record.amplitude).T)
+        assert np.array_equal(profiler["correlation"]["data"][:, ensemble], np.array(record.correlation).T)
+    indexed = HRProfiler(path, recordIndex=str(tmpdir))
+    assert indexed.recordIndex is None and tmpdir.listdir(lambda entry: entry.ext == ".npz")
+    indexed = HRProfiler(path, recordIndex=str(tmpdir), dtype=np.float32)
+    assert indexed.recordIndex is not None
+    assert indexed["velocity"]["data"].dtype == np.float32
+    assert np.allclose(indexed["velocity"]["data"], profiler["velocity"]["data"])
+
+def test_probe_record_slots(hr_profiler_file, ad2cp_file, tmpdir):
+    from nortek.files import HRProfiler
+    path, offsets = hr_profiler_file
+    with open(path, "rb") as source:
+        raw = bytearray(source.read())
+    # a record in the middle that fails its checksum still takes its slot
+    raw[offsets[200] + 10] ^= 0xff
+    damaged = tmpdir.join("damaged.prf")
+    damaged.write_binary(bytes(raw))
+    metadata = probe_file(str(damaged))
+    assert metadata["instrumentType"] == "HR Profiler"
+    assert metadata["numberOfRecords"] == len(offsets)
+    assert not metadata["numberOfRecordsExact"]
+    assert HRProfiler(str(damaged))["velocity"]["data"].shape[1] == len(offsets) - 1
+    metadata = probe_file(ad2cp_file[0])
+    assert metadata["instrumentType"] == "AD2CP"
+    assert not metadata["numberOfRecordsExact"]
+
+def test_adaptive_outlier_removal():
+    from nortek.arrays import GenericDataArray
+    data = np.random.RandomState(0).normal(size=(3, 1000, 4))
+    data[1, 500, 2] = 50
+    data[2, :10, 0] = np.nan
+    velocity = GenericDataArray(200, data=data)
+    velocity.adaptiveOutlierRemoval()
+    assert not velocity["goodIndices"][1, 500, 2]
+    assert not velocity["goodIndices"][2, :10, 0].any()
+    assert velocity["goodIndices"].mean() > 0.95
+    goodIndices = velocity["goodIndices"]
+    velocity.adaptiveOutlierRemoval(numberOfThreads=4)
+    assert np.array_equal(goodIndices, velocity["goodIndices"])
+    
+def test_temporal_spectrum():
+    from nortek.arrays import GenericDataArray
+    data = np.random.RandomState(0).normal(size=(2, 4096, 3))
+    velocity = GenericDataArray(64, data=data)
+    velocity.calculateTemporalSpectrum(7, overlap=0.5, taper="hann")
+    spectrum = velocity["spectrum"]
+    assert spectrum["psd"].shape == (2, 513, 3)
+    assert spectrum["f"][-1] == spectrum["nyquistFrequency"] == 32
+    assert np.allclose(spectrum["psdCheck"], 1, atol=0.1)
+    
+def test_gap_filling():
+    from nortek.arrays import GenericDataArray
+    data = np.arange(24, dtype=float).reshape(2, 6, 2)
+    velocity = GenericDataArray(1, data=data.copy())
+    velocity["goodIndices"] = np.ones(data.shape, bool)
+    velocity["goodIndices"][0, 2:4, 1] = False
+    velocity["goodIndices"][1, :2, 0] = False
+    velocity["data"][0, 2:4, 1] = np.nan
+    filled = velocity.gapFilledData()
+    assert np.array_equal(filled[0, :, 1], data[0, :, 1])
+    assert np.all(filled[1, :2, 0] == data[1, 2:, 0].mean())
+    assert velocity.gapFilledData() is filled
+    velocity["goodIndices"][0, 0, 0] = False
+    assert velocity.gapFilledData() is not filled
+    filled = velocity.gapFilledData()
+    velocity["data"] = velocity["data"] * 10
+    assert np.array_equal(velocity.gapFilledData()[0, :, 1], 10 * data[0, :, 1])
+
+def test_histogram():
+    from nortek.arrays import GenericDataArray
+    data = np.random.RandomState(0).randn(2, 1000, 3)
+    data[1, ::10, 2] = np.nan
+    velocity = GenericDataArray(1, data=data)
+    for bins in [20, np.linspace(-2, 2, 11)]:
+        velocity.calculateHistograms(bins)
+        histograms = velocity.histograms
+        assert histograms["densityInBin"].shape[::2] == (2, 3)
+        series = data[1, :, 2][np.isfinite(data[1, :, 2])]
+        density, edges = np.histogram(series, bins, density=True)
+        assert np.allclose(histograms["binEdges"][1, :, 2], edges)
+        assert np.allclose(histograms.densityInBin[1][2], density)
+    velocity.calculateHistograms()
+    histograms = velocity.histograms
+    edges = histograms["binEdges"]
+    assert np.all(edges[:, 0] <= np.nanmin(data, axis=1))
+    assert np.all(edges[:, -1] >= np.nanmax(data, axis=1))
+    assert np.allclose((histograms["densityInBin"] * np.diff(edges, axis=1)).sum(axis=1), 1)
+
+def test_streaming_statistics():
+    from nortek.arrays import StreamingStatistics
+    vec = VectrinoFile("examples/test.vno")
+    u = vec["velocity"]["data"]
+    stream = VectrinoFile("examples/test.vno", readData=False)
+    statistics = stream.stream_statistics(1000, sketchSize=u.shape[1])["velocity"]
+    assert np.allclose(statistics.mean, vec["velocity"].mean)
+    assert np.allclose(statistics.variance(), vec["velocity"].var)
+    assert np.allclose(statistics.median(), vec["velocity"].median)
+    first, second = StreamingStatistics(), StreamingStatistics()
+    first.update(u[:, :5000])
+    second.update(u[:, 5000:])
+    first.merge(second)
+    assert np.allclose(first.mean, vec["velocity"].mean)
+    assert np.allclose(first.variance(), vec["velocity"].var)
+    rank = (u < first.median()[:, np.newaxis]).mean(axis=1)
+    assert np.all(np.abs(rank - 0.5) < 0.01)
+
 def test_pdcontrol():
     vec = PdControl()
     print(vec.sound_speed_mode)